@@ -0,0 +1,59 @@
+import threading
+
+
+class AdaptiveBatchSizer:
+    """
+    Per-destination insert batch limits tuned from measured write latency (AIMD).
+
+    Every destination starts at `initial_rows`. After each full batch (one that
+    hit its row limit) written within `target_seconds`, the limit grows by
+    `increase_rows`; after any batch slower than the target it is multiplied by
+    `decrease_factor`. Narrow tables therefore climb to large batches while wide
+    LOB tables settle on small ones. `max_bytes` is a hard cap on the key and
+    value characters of a batch whatever the row limit, so a burst of huge rows
+    cannot build a batch hundreds of MB large.
+
+    `observe` may be called from writer threads; `on_change(destination, rows)`
+    is called whenever a limit changes.
+    """
+
+    def __init__(self, target_seconds, min_rows, max_rows, max_bytes,
+                 initial_rows=None, increase_rows=None, decrease_factor=0.5, on_change=None):
+        if not 0 < decrease_factor < 1:
+            raise ValueError(f"decrease_factor must be between 0 and 1, got {decrease_factor}")
+        if not 1 <= min_rows <= max_rows:
+            raise ValueError(f"Invalid row limits: min_rows={min_rows}, max_rows={max_rows}")
+        self.target_seconds = target_seconds
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.initial_rows = min(max(initial_rows or min_rows, min_rows), max_rows)
+        self.increase_rows = increase_rows or max(min_rows, max_rows // 100)
+        self.decrease_factor = decrease_factor
+        self._on_change = on_change
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def limits(self, destination):
+        """Return (max rows, max bytes) for the next batch of `destination`"""
+        return self._rows.get(destination, self.initial_rows), self.max_bytes
+
+    def observe(self, destination, rows, nbytes, seconds):
+        """Adjust the row limit of `destination` after a batch of `rows` took `seconds` to write"""
+        with self._lock:
+            current = self._rows.get(destination, self.initial_rows)
+            if seconds > self.target_seconds:
+                updated = max(self.min_rows, int(current * self.decrease_factor))
+            elif rows >= current and nbytes < self.max_bytes:
+                # Only a batch that filled its limit says anything about a larger one
+                updated = min(self.max_rows, current + self.increase_rows)
+            else:
+                return
+            self._rows[destination] = updated
+        if updated != current and self._on_change is not None:
+            self._on_change(destination, updated)
+
+    def snapshot(self):
+        """Current row limit per destination"""
+        with self._lock:
+            return dict(self._rows)
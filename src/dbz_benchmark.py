@@ -0,0 +1,382 @@
+"""
+Benchmark the change handlers with synthetic Debezium change events.
+
+Builds Oracle-style change event batches in memory (no Oracle or LogMiner
+needed) and feeds them straight to a handler's handleJsonBatch, then reports
+records/sec, MB/sec, p50/p99 batch latency and peak RSS.
+
+Handlers read their configuration from environment variables when their module
+is imported, so each run happens in a forked child process that sets the
+variables and imports the module. The peak RSS of a run is therefore its own,
+not the highest of the runs before it; every child starts from the memory of
+the generated events. Every combination of --load-modes and --batch-sizes is
+run with the same events, so the result lines are directly comparable.
+
+Examples:
+    python src/dbz_benchmark.py --handler postgres --load-modes insert,copy,copy_binary
+    python src/dbz_benchmark.py --handler mssql --target stub --batch-sizes 500,1000,5000
+    python src/dbz_benchmark.py --handler print --tables 20 --columns 50 --no-schemas
+"""
+import argparse
+import contextlib
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+import traceback
+
+HANDLER_MODULES = {
+    "print": ("dbz_custom_handler", "PrintChangeHandler", None, None),
+    "postgres": ("dbz_oracle_to_postgres_handler", "RawChangeHandler", "POSTGRESQL", "psycopg2"),
+    "mssql": ("dbz_oracle_to_mssql_handler", "RawChangeHandler", "MSSQL", "pyodbc"),
+}
+DEFAULT_LOAD_MODES = {"print": "-", "postgres": "insert", "mssql": "executemany"}
+
+TOPIC_PREFIX = "dwh"
+SOURCE_SCHEMA = "C##DBZUSER"
+
+
+class FakeChangeEvent:
+    """Stand-in for the engine's ChangeEvent with the methods the handlers call"""
+    __slots__ = ("_destination", "_key", "_value")
+
+    def __init__(self, destination, key, value):
+        self._destination = destination
+        self._key = key
+        self._value = value
+
+    def destination(self):
+        return self._destination
+
+    def key(self):
+        return self._key
+
+    def value(self):
+        return self._value
+
+    def partition(self):
+        return 0
+
+
+class NullCursor:
+    """Cursor of the in-process stand-in database: accepts every statement and discards it"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.fast_executemany = False
+        self.rowcount = 0
+
+    def execute(self, query, *params):
+        self.rowcount = 0
+        return self
+
+    def executemany(self, query, rows):
+        self.rowcount = len(rows)
+
+    def copy_expert(self, query, file, size=8192):
+        while file.read(size):
+            pass
+
+    def mogrify(self, query, params=None):
+        # psycopg2.extras.execute_values renders each row client side through mogrify
+        return repr(params).encode("utf-8")
+
+    def setinputsizes(self, sizes):
+        pass
+
+    def fetchone(self):
+        # The handlers only fetch single-value rows, e.g. whether a table exists
+        return (None,)
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class NullConnection:
+    """In-process stand-in for a psycopg2/pyodbc connection, to measure handler overhead alone"""
+    autocommit = False
+    encoding = "UTF8"
+
+    def cursor(self):
+        return NullCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _connect_schema(table, columns):
+    """Key and value schemas as emitted by the JSON converter for an Oracle table"""
+    name = f"{TOPIC_PREFIX}.{SOURCE_SCHEMA.replace('#', '_')}.{table}"
+    row_fields = [{"type": "int32", "optional": False, "field": "ID"}] + [
+        {"type": "string", "optional": True, "field": f"COL_{i}"} for i in range(1, columns)
+    ]
+    key_schema = {"type": "struct", "fields": row_fields[:1], "optional": False, "name": f"{name}.Key"}
+    row_schema = {"type": "struct", "fields": row_fields, "optional": True, "name": f"{name}.Value"}
+    source_fields = [
+        {"type": "string", "optional": False, "field": field}
+        for field in ("version", "connector", "name", "db", "schema", "table")
+    ] + [
+        {"type": "int64", "optional": False, "field": "ts_ms"},
+        {"type": "string", "optional": True, "field": "snapshot"},
+        {"type": "string", "optional": True, "field": "txId"},
+        {"type": "string", "optional": True, "field": "scn"},
+        {"type": "string", "optional": True, "field": "commit_scn"},
+        {"type": "string", "optional": True, "field": "rs_id"},
+        {"type": "int64", "optional": True, "field": "ssn"},
+        {"type": "int32", "optional": True, "field": "redo_thread"},
+    ]
+    value_schema = {
+        "type": "struct",
+        "fields": [
+            dict(row_schema, field="before"),
+            dict(row_schema, field="after"),
+            {"type": "struct", "fields": source_fields, "optional": False,
+             "name": "io.debezium.connector.oracle.Source", "field": "source"},
+            {"type": "string", "optional": False, "field": "op"},
+            {"type": "int64", "optional": True, "field": "ts_ms"},
+        ],
+        "optional": False,
+        "name": f"{name}.Envelope",
+        "version": 2,
+    }
+    return key_schema, value_schema
+
+
+def _dumps(document):
+    # Same compact layout as the JSON converter
+    return json.dumps(document, separators=(",", ":"))
+
+
+def generate_batches(records, batch_size, tables, columns, value_width, op_mix, schemas, seed=42):
+    """Build `records` synthetic change events split into engine batches of `batch_size`"""
+    rng = random.Random(seed)
+    table_names = [f"TABLE_{i}" for i in range(1, tables + 1)]
+    table_schemas = {table: _connect_schema(table, columns) for table in table_names}
+    live_ids = {table: [] for table in table_names}
+    next_id = {table: 1 for table in table_names}
+    ops, weights = zip(*op_mix.items())
+    scn = 10_000_000
+    alphabet = "abcdefghijklmnopqrstuvwxyz0123456789 "
+
+    def row(table, row_id):
+        values = {"ID": row_id}
+        for i in range(1, columns):
+            values[f"COL_{i}"] = "".join(rng.choices(alphabet, k=value_width))
+        return values
+
+    events = []
+    for _ in range(records):
+        table = rng.choice(table_names)
+        op = rng.choices(ops, weights)[0]
+        if op != "c" and not live_ids[table]:
+            op = "c"
+        if op == "c":
+            row_id = next_id[table]
+            next_id[table] += 1
+            live_ids[table].append(row_id)
+            before, after = None, row(table, row_id)
+        else:
+            index = rng.randrange(len(live_ids[table]))
+            row_id = live_ids[table][index]
+            before = row(table, row_id)
+            if op == "u":
+                after = row(table, row_id)
+            else:
+                after = None
+                live_ids[table][index] = live_ids[table][-1]
+                live_ids[table].pop()
+
+        scn += rng.randint(1, 5)
+        now_ms = int(time.time() * 1000)
+        payload = {
+            "before": before,
+            "after": after,
+            "source": {
+                "version": "2.7.0.Final", "connector": "oracle", "name": TOPIC_PREFIX,
+                "db": "ORCLPDB1", "schema": SOURCE_SCHEMA, "table": table, "ts_ms": now_ms,
+                "snapshot": "false", "txId": f"{scn:x}", "scn": str(scn), "commit_scn": str(scn + 1),
+                "rs_id": f"0x{scn:06x}.0001.0010", "ssn": 0, "redo_thread": 1,
+            },
+            "op": op,
+            "ts_ms": now_ms,
+        }
+        key = {"ID": row_id}
+        if schemas:
+            key_schema, value_schema = table_schemas[table]
+            key = {"schema": key_schema, "payload": key}
+            payload = {"schema": value_schema, "payload": payload}
+        events.append(FakeChangeEvent(f"{TOPIC_PREFIX}.{SOURCE_SCHEMA}.{table}", _dumps(key), _dumps(payload)))
+
+    return [events[i:i + batch_size] for i in range(0, len(events), batch_size)]
+
+
+def _percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _load_handler(name, load_mode, insert_batch_size, target):
+    module_name, class_name, env_prefix, driver = HANDLER_MODULES[name]
+    if env_prefix is not None:
+        os.environ[f"{env_prefix}_LOAD_MODE"] = load_mode
+        os.environ[f"{env_prefix}_INSERT_BATCH_SIZE"] = str(insert_batch_size)
+    if module_name in sys.modules:
+        module = importlib.reload(sys.modules[module_name])
+    else:
+        module = importlib.import_module(module_name)
+    if target == "stub" and driver is not None:
+        # Swap the driver's connect for the stand-in database in this module only
+        module_driver = getattr(module, driver)
+        original_connect = module_driver.connect
+        module_driver.connect = lambda *args, **kwargs: NullConnection()
+        try:
+            return getattr(module, class_name)()
+        finally:
+            module_driver.connect = original_connect
+    return getattr(module, class_name)()
+
+
+def run(name, batches, load_mode, insert_batch_size, target):
+    """Feed every batch to a fresh handler and return the measured figures"""
+    total_records = sum(len(batch) for batch in batches)
+    total_bytes = sum(len(event.key() or "") + len(event.value() or "") for batch in batches for event in batch)
+    latencies = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        handler = _load_handler(name, load_mode, insert_batch_size, target)
+        started = time.perf_counter()
+        for batch in batches:
+            batch_started = time.perf_counter()
+            handler.handleJsonBatch(batch)
+            latencies.append(time.perf_counter() - batch_started)
+        if hasattr(handler, "close"):
+            handler.close()
+        elapsed = time.perf_counter() - started
+    return {
+        "handler": name,
+        "target": target,
+        "load_mode": load_mode,
+        "insert_batch_size": insert_batch_size,
+        "records": total_records,
+        "records_per_sec": total_records / elapsed,
+        "mb_per_sec": total_bytes / elapsed / (1024 * 1024),
+        "p50_batch_ms": statistics.median(latencies) * 1000,
+        "p99_batch_ms": _percentile(latencies, 0.99) * 1000,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _run_in_child(sender, *args):
+    try:
+        sender.send(("ok", run(*args)))
+    except BaseException:
+        sender.send(("error", traceback.format_exc()))
+    finally:
+        sender.close()
+
+
+def run_isolated(*args):
+    """`run` in a forked child process, so the peak RSS is that of this run alone"""
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_in_child, args=(sender, *args))
+    process.start()
+    sender.close()
+    try:
+        status, result = receiver.recv()
+    except EOFError:
+        status, result = "error", "the benchmark process exited without a result"
+    finally:
+        receiver.close()
+        process.join()
+    if status != "ok":
+        raise RuntimeError(f"Benchmark run failed: {result}")
+    return result
+
+
+def parse_op_mix(text):
+    """Parse "c=70,u=25,d=5" into {"c": 70.0, "u": 25.0, "d": 5.0}"""
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        if op.strip() not in ("c", "u", "d"):
+            raise argparse.ArgumentTypeError(f"Unknown op in --op-mix: {op!r}")
+        mix[op.strip()] = float(weight)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark change handlers with synthetic change events")
+    parser.add_argument("--handler", choices=sorted(HANDLER_MODULES), default="postgres")
+    parser.add_argument("--target", choices=("db", "stub"), default="db",
+                        help="db: the database configured by the handler's env vars; "
+                             "stub: an in-process stand-in that discards writes")
+    parser.add_argument("--records", type=int, default=50_000, help="Total number of change events")
+    parser.add_argument("--engine-batch-size", type=int, default=2048,
+                        help="Records per handleJsonBatch call (Debezium max.batch.size)")
+    parser.add_argument("--batch-sizes", default=None,
+                        help="Comma separated *_INSERT_BATCH_SIZE values to compare (default: 1000)")
+    parser.add_argument("--load-modes", default=None,
+                        help="Comma separated *_LOAD_MODE values to compare (default: the handler's default)")
+    parser.add_argument("--tables", type=int, default=3, help="Number of distinct source tables")
+    parser.add_argument("--columns", type=int, default=10, help="Columns per row, including the ID")
+    parser.add_argument("--value-width", type=int, default=32, help="Characters per string column")
+    parser.add_argument("--op-mix", type=parse_op_mix, default=parse_op_mix("c=60,u=30,d=10"),
+                        help="Relative weights of creates, updates and deletes")
+    parser.add_argument("--no-schemas", dest="schemas", action="store_false",
+                        help="Generate events without embedded JSON converter schemas")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per run")
+    args = parser.parse_args(argv)
+
+    load_modes = args.load_modes.split(",") if args.load_modes else [DEFAULT_LOAD_MODES[args.handler]]
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")] if args.batch_sizes else [1000]
+
+    batches = generate_batches(
+        args.records, args.engine_batch_size, args.tables, args.columns,
+        args.value_width, args.op_mix, args.schemas, args.seed,
+    )
+
+    header = f"{'handler':<9} {'target':<6} {'load_mode':<17} {'batch':>6} {'rec/s':>10} {'MB/s':>8} " \
+             f"{'p50 ms':>9} {'p99 ms':>9} {'rss MB':>8}"
+    if not args.json:
+        print(header)
+    for load_mode in load_modes:
+        for batch_size in batch_sizes:
+            result = run_isolated(args.handler, batches, load_mode, batch_size, args.target)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f"{result['handler']:<9} {result['target']:<6} {result['load_mode']:<17} "
+                      f"{result['insert_batch_size']:>6} {result['records_per_sec']:>10.0f} "
+                      f"{result['mb_per_sec']:>8.2f} {result['p50_batch_ms']:>9.2f} "
+                      f"{result['p99_batch_ms']:>9.2f} {result['peak_rss_mb']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
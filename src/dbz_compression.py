@@ -0,0 +1,141 @@
+import collections
+import random
+
+try:
+    import zstandard
+except ImportError:  # Only needed for PAYLOAD_FORMAT=zstd
+    zstandard = None
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise RuntimeError("PAYLOAD_FORMAT=zstd needs the zstandard package: pip install zstandard")
+
+
+class PayloadCompressor:
+    """
+    Compresses raw_events keys and values with zstd, one trained dictionary per destination.
+
+    Debezium envelopes of a table repeat the same field names, source block and
+    (in full envelope mode) schema in every record, which a dictionary trained
+    on that table's records removes almost entirely. Until a destination has a
+    dictionary its records are compressed without one while `samples` of them
+    are collected; `train` then builds a `dict_bytes` dictionary for every
+    destination with enough samples. With `retrain_records` a destination is
+    retrained on its latest samples after that many records, so the dictionary
+    follows schema changes.
+
+    Every dictionary gets a new random id, which zstd writes into each frame
+    header, so any frame can be decoded with the dictionary it was written with.
+    Random ids cannot clash with dictionaries trained by an earlier run that
+    are still waiting in the spool. `dictionaries` maps every id ever used to
+    (destination, dictionary bytes), for storing in the raw_dictionaries side
+    table; pass the stored ones back in, oldest first, to keep using the latest
+    dictionary of each destination after a restart.
+    """
+
+    def __init__(self, level=3, dict_bytes=64 * 1024, samples=1000, retrain_records=0, dictionaries=()):
+        _require_zstandard()
+        self.level = level
+        self.dict_bytes = dict_bytes
+        self.sample_count = samples
+        self.retrain_records = retrain_records
+        self.dictionaries = {}
+        self._plain = zstandard.ZstdCompressor(level=level)
+        # destination -> ZstdCompressor using its latest dictionary
+        self._compressors = {}
+        self._samples = {}
+        self._since_training = {}
+        for dictionary_id, destination, data in dictionaries:
+            self._install(dictionary_id, destination, bytes(data))
+
+    def _install(self, dictionary_id, destination, data):
+        self.dictionaries[dictionary_id] = (destination, data)
+        dictionary = zstandard.ZstdCompressionDict(data)
+        self._compressors[destination] = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+        self._since_training[destination] = 0
+
+    def _wants_samples(self, destination):
+        if destination not in self._compressors:
+            return True
+        return self.retrain_records > 0 and self._since_training[destination] >= self.retrain_records
+
+    def compress(self, destination, text):
+        """Return the zstd frame of a key or value (None stays None)"""
+        if text is None:
+            return None
+        data = text.encode("utf-8")
+        if destination in self._since_training:
+            self._since_training[destination] += 1
+        if self._wants_samples(destination):
+            samples = self._samples.get(destination)
+            if samples is None:
+                samples = self._samples[destination] = collections.deque(maxlen=self.sample_count)
+            samples.append(data)
+        return self._compressors.get(destination, self._plain).compress(data)
+
+    def train(self):
+        """Train dictionaries for destinations that collected enough samples; returns the new ids"""
+        trained = []
+        for destination, samples in list(self._samples.items()):
+            if len(samples) < self.sample_count or not self._wants_samples(destination):
+                continue
+            dictionary_id = random.randrange(1 << 15, 1 << 31)
+            if dictionary_id in self.dictionaries:
+                continue
+            try:
+                dictionary = zstandard.train_dictionary(
+                    self.dict_bytes, list(samples), dict_id=dictionary_id, level=self.level
+                )
+            except zstandard.ZstdError as e:
+                # Typically too little or too uniform data; try again with fresh samples
+                print(f"Could not train a zstd dictionary for {destination}: {str(e)}")
+                samples.clear()
+                continue
+            self._install(dictionary_id, destination, dictionary.as_bytes())
+            del self._samples[destination]
+            trained.append(dictionary_id)
+            print(f"Trained zstd dictionary {dictionary_id} for {destination} from {len(samples)} samples")
+        return trained
+
+
+class PayloadDecoder:
+    """
+    Turns compressed raw_events keys and values back into JSON text.
+
+    `dictionaries` maps dictionary ids to dictionary bytes, e.g. the rows of
+    raw_dictionaries; see `load_dictionaries`. The dictionary of each frame is
+    found from the id in its header.
+    """
+
+    def __init__(self, dictionaries=None):
+        _require_zstandard()
+        self.dictionaries = {int(k): bytes(v) for k, v in (dictionaries or {}).items()}
+        self._decompressors = {}
+
+    def _decompressor(self, dictionary_id):
+        decompressor = self._decompressors.get(dictionary_id)
+        if decompressor is None:
+            if dictionary_id == 0:
+                decompressor = zstandard.ZstdDecompressor()
+            elif dictionary_id in self.dictionaries:
+                dictionary = zstandard.ZstdCompressionDict(self.dictionaries[dictionary_id])
+                decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+            else:
+                raise KeyError(f"Unknown zstd dictionary {dictionary_id}; reload raw_dictionaries")
+            self._decompressors[dictionary_id] = decompressor
+        return decompressor
+
+    def decode(self, blob):
+        """Return the JSON text of a compressed key or value (None stays None)"""
+        if blob is None:
+            return None
+        blob = bytes(blob)
+        dictionary_id = zstandard.get_frame_parameters(blob).dict_id
+        return self._decompressor(dictionary_id).decompress(blob).decode("utf-8")
+
+
+def load_dictionaries(cursor):
+    """Read raw_dictionaries through any DB-API cursor as {dictionary id: bytes}"""
+    cursor.execute("SELECT dictionary_id, dictionary FROM raw_dictionaries")
+    return {int(row[0]): bytes(row[1]) for row in cursor.fetchall()}
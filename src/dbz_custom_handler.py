@@ -5,6 +5,8 @@ from typing import List
 from pydbzengine import ChangeEvent, BasePythonChangeHandler
 from pydbzengine import Properties, DebeziumJsonEngine
 
+from dbz_records import read_batch
+
 OFFSET_FILE = "/app/storage/offsets.dat"
 HISTORY_FILE = "/app/storage/history.dat"
 ORACLE_HOST = os.getenv("ORACLE_HOST", "oracle")
@@ -14,6 +16,8 @@ ORACLE_PASSWORD = os.getenv("ORACLE_PASSWORD", "dbz")
 ORACLE_DBNAME = os.getenv("ORACLE_DBNAME", "ORCLCDB")
 ORACLE_PDB_NAME = os.getenv("ORACLE_PDB_NAME", "ORCLPDB1")
 ORACLE_TABLE_INCLUDE_LIST = os.getenv("ORACLE_TABLE_INCLUDE_LIST", "C##DBZUSER.CUSTOMERS")
+# Engine snapshot.mode, e.g. schema_only or initial
+SNAPSHOT_MODE = os.getenv("SNAPSHOT_MODE", "schema_only")
 POSTGRESQL_HOST = os.getenv("POSTGRESQL_HOST", "postgres")
 POSTGRESQL_PORT = os.getenv("POSTGRESQL_PORT", 5432)
 POSTGRESQL_USER = os.getenv("POSTGRESQL_USER", "postgres")
@@ -46,17 +50,18 @@ class PrintChangeHandler(BasePythonChangeHandler):
         """
         print("--------------------------------------")
         print(f"Received {len(records)} records")
-        for record in records:
-            print(f"destination: {record.destination()}")
-            print(f"key: {record.key()}")
-            print(f"value: {record.value()}")
+        batch = read_batch(records)
+        for destination, key, value in zip(batch.destinations, batch.keys, batch.values):
+            print(f"destination: {destination}")
+            print(f"key: {key}")
+            print(f"value: {value}")
         print("--------------------------------------")
 
 
 if __name__ == '__main__':
     props = Properties()
     props.setProperty("name", "engine")
-    props.setProperty("snapshot.mode", "schema_only")
+    props.setProperty("snapshot.mode", SNAPSHOT_MODE)
     props.setProperty("topic.prefix", "dwh")
     props.setProperty("tombstones.on.delete", "false")
     props.setProperty("log.mining.strategy", "online_catalog")
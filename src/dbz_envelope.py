@@ -0,0 +1,250 @@
+import hashlib
+import json
+import re
+
+
+def unwrap(document):
+    """
+    Split a JSON converter document into (payload, schema).
+
+    With `schemas.enable=true` (the JSON converter default) every key and value is
+    wrapped as {"schema": ..., "payload": ...}; without it the document is the
+    payload itself and the schema is None.
+    """
+    if isinstance(document, dict) and document.keys() == {"schema", "payload"}:
+        return document["payload"], document["schema"]
+    return document, None
+
+
+def parse_include_list(include_list):
+    """Normalize ORACLE_TABLE_INCLUDE_LIST into a set of upper case SCHEMA.TABLE names"""
+    return {entry.strip().upper() for entry in include_list.split(",") if entry.strip()}
+
+
+def flat_table_name(source_table):
+    """
+    Sink table name of a SCHEMA.TABLE source table, e.g. c__dbzuser__customers for C##DBZUSER.CUSTOMERS.
+
+    Keeping the schema keeps equal table names of different schemas apart.
+    Characters other than letters, digits and _ (Oracle allows # and $) become
+    _, so the name needs no quoting and can be part of a file URI.
+    """
+    schema, _, table = source_table.lower().rpartition(".")
+    return "__".join(re.sub(r"[^0-9a-z_]", "_", part) for part in (schema, table) if part)
+
+
+def source_ts_ms(value_json):
+    """Return `source.ts_ms` of a Debezium value (with or without embedded schema), or None"""
+    if not value_json or isinstance(value_json, bytes):
+        # Compressed values (PAYLOAD_FORMAT=zstd) are not parsed
+        return None
+    try:
+        envelope = unwrap(json.loads(value_json))[0]
+    except ValueError:
+        return None
+    source = envelope.get("source") if isinstance(envelope, dict) else None
+    return source.get("ts_ms") if isinstance(source, dict) else None
+
+
+def snapshot_phase(value_json):
+    """
+    Classify a Debezium value for the snapshot bulk load without parsing it.
+
+    Returns None for streaming events (incremental snapshot reads included,
+    since they interleave with streaming), "first" and "last" for the first and
+    last read event of an initial snapshot and "read" for the others.
+
+    The row images come first in the envelope and may have columns named `op`
+    or `snapshot`, so only the envelope's own fields are looked at: Debezium
+    writes `op` after `before`, `after` and `source`, which makes it the last
+    "op" key, and `source.snapshot` is the last "snapshot" key before it. Keys
+    inside string values are escaped and never match.
+    """
+    if not value_json or isinstance(value_json, bytes):
+        return None
+    op_at = value_json.rfind('"op":')
+    if op_at < 0 or not value_json.startswith('"op":"r"', op_at):
+        return None
+    snapshot_at = value_json.rfind('"snapshot":', 0, op_at)
+    if snapshot_at >= 0:
+        snapshot_at += len('"snapshot":')
+        if value_json.startswith('"first"', snapshot_at):
+            return "first"
+        if value_json.startswith('"last"', snapshot_at):
+            return "last"
+        if value_json.startswith('"incremental"', snapshot_at):
+            return None
+    return "read"
+
+
+def after_field_types(value_schema):
+    """Return {column: (type, logical name)} for the `after` struct of an envelope schema"""
+    if not value_schema:
+        return {}
+    for field in value_schema.get("fields", []):
+        if field.get("field") == "after":
+            return {f["field"]: (f.get("type"), f.get("name")) for f in field.get("fields", [])}
+    return {}
+
+
+def infer_field_type(value):
+    """Guess a Connect type for a column value when no schema is embedded"""
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "int64"
+    if isinstance(value, float):
+        return "float64"
+    if isinstance(value, (dict, list)):
+        return "struct"
+    return "string"
+
+
+class ReplicaChange:
+    """
+    The net effect of a Debezium change event on one replica row.
+
+    `row` is the `after` image, or None when the row was deleted. `op` is the
+    Debezium operation code ("c", "u", "d", "r" or "t" for truncate).
+    """
+    __slots__ = ("table", "op", "key", "row", "field_types")
+
+    def __init__(self, table, op, key, row, field_types):
+        self.table = table
+        self.op = op
+        self.key = key
+        self.row = row
+        self.field_types = field_types
+
+    @property
+    def key_values(self):
+        return tuple(self.key.values())
+
+
+def parse_change(key_json, value_json, tables=None, value_schema=None):
+    """
+    Parse a raw Debezium key/value pair into a ReplicaChange.
+
+    `value_schema` is used for column types when the value was stored without
+    its embedded schema. Returns None for tombstones, events of tables outside
+    `tables` and events without a primary key, which cannot be applied to a
+    replica.
+    """
+    if not value_json:
+        return None
+    envelope, embedded_schema = unwrap(json.loads(value_json))
+    value_schema = embedded_schema or value_schema
+    if not isinstance(envelope, dict) or "op" not in envelope:
+        return None
+
+    source = envelope.get("source") or {}
+    table = f"{source.get('schema')}.{source.get('table')}".upper()
+    if tables is not None and table not in tables:
+        return None
+
+    op = envelope["op"]
+    if op == "t":
+        return ReplicaChange(table, op, {}, None, {})
+
+    key = unwrap(json.loads(key_json))[0] if key_json else None
+    if not key:
+        return None
+
+    row = None if op == "d" else envelope.get("after")
+    field_types = after_field_types(value_schema)
+    if not field_types:
+        image = row or envelope.get("before") or key
+        field_types = {column: (infer_field_type(value), None) for column, value in image.items()}
+    return ReplicaChange(table, op, key, row, field_types)
+
+
+def coalesce_changes(changes):
+    """
+    Collapse a batch of changes to the final state of each primary key.
+
+    Returns {table: (truncated, [ReplicaChange, ...])}. Only the last change per
+    (table, key) is kept, so a row inserted, updated and deleted within the batch
+    turns into a single delete. A truncate drops every earlier change of its
+    table and is reported with `truncated=True` so it can be applied first.
+    """
+    latest = {}
+    truncated = set()
+    for change in changes:
+        if change is None:
+            continue
+        if change.op == "t":
+            truncated.add(change.table)
+            latest = {k: v for k, v in latest.items() if k[0] != change.table}
+            continue
+        latest.pop((change.table, change.key_values), None)
+        latest[(change.table, change.key_values)] = change
+
+    by_table = {table: (True, []) for table in truncated}
+    for (table, _), change in latest.items():
+        by_table.setdefault(table, (table in truncated, []))[1].append(change)
+    return by_table
+
+
+_SCHEMA_PREFIX = '{"schema":'
+_PAYLOAD_SEPARATOR = ',"payload":'
+_decoder = json.JSONDecoder()
+
+
+def schema_fingerprint(schema):
+    """Stable fingerprint of a Connect schema, independent of key order and whitespace"""
+    canonical = json.dumps(schema, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def restore_envelope(payload_json, schema_json):
+    """Inverse of `SchemaCompactor.compact`: wrap a stripped payload in its schema again"""
+    if schema_json is None:
+        return payload_json
+    return _SCHEMA_PREFIX + schema_json + _PAYLOAD_SEPARATOR + (payload_json or "null") + "}"
+
+
+class SchemaCompactor:
+    """
+    Strips the embedded schema from JSON converter documents.
+
+    `compact` returns the raw payload text and the fingerprint of the removed
+    schema; `schemas` maps every fingerprint seen so far to its schema JSON, so
+    the sink can store each schema once in a side table. The document text is
+    sliced rather than re-serialized, and the fingerprint is cached by the raw
+    schema text, so repeated schemas cost a dictionary lookup.
+    """
+
+    def __init__(self):
+        self.schemas = {}
+        self._fingerprints = {}
+
+    def _split(self, document):
+        """Return (schema text, payload text) or None if the document has no embedded schema"""
+        if not document.startswith(_SCHEMA_PREFIX) or not document.endswith("}"):
+            return None
+        # Fast path: a schema seen before, directly followed by the payload
+        separator = document.find(_PAYLOAD_SEPARATOR)
+        if separator != -1 and document[len(_SCHEMA_PREFIX):separator] in self._fingerprints:
+            return document[len(_SCHEMA_PREFIX):separator], document[separator + len(_PAYLOAD_SEPARATOR):-1]
+        try:
+            _, end = _decoder.raw_decode(document, len(_SCHEMA_PREFIX))
+        except ValueError:
+            return None
+        if not document.startswith(_PAYLOAD_SEPARATOR, end):
+            return None
+        return document[len(_SCHEMA_PREFIX):end], document[end + len(_PAYLOAD_SEPARATOR):-1]
+
+    def compact(self, document):
+        """Return (payload JSON, schema fingerprint); documents without a schema pass through"""
+        if not document:
+            return document, None
+        parts = self._split(document)
+        if parts is None:
+            return document, None
+        schema_text, payload_text = parts
+        fingerprint = self._fingerprints.get(schema_text)
+        if fingerprint is None:
+            fingerprint = schema_fingerprint(json.loads(schema_text))
+            self._fingerprints[schema_text] = fingerprint
+            self.schemas.setdefault(fingerprint, schema_text)
+        return (None if payload_text == "null" else payload_text), fingerprint
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+
+from dbz_envelope import unwrap
+
+# Oracle source block fields that together identify a change event in the redo stream
+SOURCE_POSITION_FIELDS = ("scn", "commit_scn", "txId", "rs_id", "ssn", "redo_thread", "row_id")
+
+
+class EventIdGenerator:
+    """
+    Generates raw_events primary keys.
+
+    Strategies:
+        uuid4: random ids (the original behaviour)
+        uuid7: time ordered ids, monotonic within the process
+        source: deterministic ids derived from the Debezium source position, so a
+            replayed event gets the same id as the first delivery. The commit SCN
+            is used as the ordered prefix, so ids still grow with the redo stream.
+            Events without a source block fall back to uuid7, and so do events
+            without a key or a source row_id: identical rows of a keyless table
+            share their position and images, e.g. in a snapshot.
+
+    `layout` decides where the ordered 64 bits go. "rfc" puts them first, which
+    matches the byte-wise ordering of PostgreSQL's uuid type. "mssql" puts them
+    in the last eight bytes, which SQL Server compares first for UNIQUEIDENTIFIER
+    (the same trick as NEWSEQUENTIALID), so inserts land at the end of the
+    clustered index instead of on random pages. The "mssql" layout does not set
+    RFC version bits.
+    """
+    STRATEGIES = ("uuid4", "uuid7", "source")
+    LAYOUTS = ("rfc", "mssql")
+
+    def __init__(self, strategy="uuid4", layout="rfc"):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unsupported event id strategy: {strategy}")
+        if layout not in self.LAYOUTS:
+            raise ValueError(f"Unsupported event id layout: {layout}")
+        self.strategy = strategy
+        self.layout = layout
+        self._last_ms = 0
+        self._counter = 0
+
+    @property
+    def deduplicates(self):
+        """True when a replayed event gets the same id as the original"""
+        return self.strategy == "source"
+
+    def _ordered_uuid(self, ordered, tail):
+        """Build a UUID string from a 64-bit ordered value and 8 less significant bytes"""
+        ordered = ordered.to_bytes(8, "big")
+        if self.layout == "mssql":
+            # SQL Server compares bytes 10-15 first, then 8-9, then the rest
+            data = tail + ordered[6:8] + ordered[0:6]
+        else:
+            data = ordered + tail
+        return str(uuid.UUID(bytes=data))
+
+    def _uuid7(self):
+        now_ms = time.time_ns() // 1_000_000
+        if now_ms > self._last_ms:
+            self._last_ms = now_ms
+            self._counter = 0
+        else:
+            # Same (or earlier) millisecond: keep counting so ids stay monotonic
+            self._counter += 1
+            if self._counter > 0xFFF:
+                self._last_ms += 1
+                self._counter = 0
+        if self.layout == "mssql":
+            return self._ordered_uuid((self._last_ms << 16) | self._counter, os.urandom(8))
+        rand = int.from_bytes(os.urandom(8), "big")
+        value = (
+            (self._last_ms << 80)
+            | (0x7 << 76)
+            | (self._counter << 64)
+            | (0b10 << 62)
+            | (rand & ((1 << 62) - 1))
+        )
+        return str(uuid.UUID(int=value))
+
+    def _source_id(self, destination, key, value):
+        if not value:
+            return None
+        envelope = unwrap(json.loads(value))[0]
+        source = envelope.get("source") if isinstance(envelope, dict) else None
+        if not source:
+            return None
+        scn = source.get("commit_scn") or source.get("scn")
+        try:
+            ordered = int(scn) & 0xFFFFFFFFFFFFFFFF
+        except (TypeError, ValueError):
+            return None
+        if key is None and source.get("row_id") is None:
+            return None
+        # Snapshot rows share their position and streaming rows may, so the
+        # row images are part of the id. The envelope's own ts_ms is not: it
+        # is set on each delivery.
+        position = [destination, key] + [source.get(field) for field in SOURCE_POSITION_FIELDS] + [
+            envelope.get("op"), envelope.get("before"), envelope.get("after")
+        ]
+        digest = hashlib.blake2b(json.dumps(position).encode("utf-8"), digest_size=8).digest()
+        return self._ordered_uuid(ordered, digest)
+
+    def new_id(self, destination, key, value):
+        """Return the id for one record as a string"""
+        if self.strategy == "uuid4":
+            return str(uuid.uuid4())
+        if self.strategy == "source":
+            event_id = self._source_id(destination, key, value)
+            if event_id is not None:
+                return event_id
+        return self._uuid7()
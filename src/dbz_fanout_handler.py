@@ -0,0 +1,218 @@
+import os
+import time
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import List
+from pydbzengine import ChangeEvent, BasePythonChangeHandler
+from pydbzengine import Properties, DebeziumJsonEngine
+
+import dbz_metrics as metrics
+from dbz_offsets import ENGINE_NAME, oldest_offsets, seed_offset_file
+from dbz_records import read_batch
+
+OFFSET_FILE = os.getenv("OFFSET_FILE", "/app/storage/offsets.dat")
+HISTORY_FILE = os.getenv("HISTORY_FILE", "/app/storage/history.dat")
+CLEAR_OFFSET_AND_HISTORY_FILE = os.getenv("CLEAR_OFFSET_AND_HISTORY_FILE", "False").lower() == "true"
+# See OFFSET_STORAGE in the sink handlers; the file is only a fallback when the sinks store offsets
+OFFSET_FLUSH_INTERVAL_MS = os.getenv("OFFSET_FLUSH_INTERVAL_MS", 1000)
+ORACLE_HOST = os.getenv("ORACLE_HOST", "oracle")
+ORACLE_PORT = os.getenv("ORACLE_PORT", 1521)
+ORACLE_USER = os.getenv("ORACLE_USER", "c##dbzuser")
+ORACLE_PASSWORD = os.getenv("ORACLE_PASSWORD", "dbz")
+ORACLE_DBNAME = os.getenv("ORACLE_DBNAME", "ORCLCDB")
+ORACLE_PDB_NAME = os.getenv("ORACLE_PDB_NAME", "ORCLPDB1")
+ORACLE_TABLE_INCLUDE_LIST = os.getenv("ORACLE_TABLE_INCLUDE_LIST", "C##DBZUSER.CUSTOMERS")
+# Engine snapshot.mode, e.g. schema_only or initial
+SNAPSHOT_MODE = os.getenv("SNAPSHOT_MODE", "schema_only")
+# Comma separated sinks fed from the single engine: print, postgres, mssql, iceberg or module:Class
+FANOUT_SINKS = os.getenv("FANOUT_SINKS", "postgres,mssql")
+print("FANOUT_SINKS: " + str(FANOUT_SINKS))
+# Sinks whose failures are logged instead of holding back the offset
+FANOUT_OPTIONAL_SINKS = os.getenv("FANOUT_OPTIONAL_SINKS", "")
+print("FANOUT_OPTIONAL_SINKS: " + str(FANOUT_OPTIONAL_SINKS))
+# Extra attempts for a failed required sink before the batch fails
+FANOUT_SINK_RETRIES = os.getenv("FANOUT_SINK_RETRIES", 2)
+print("FANOUT_SINK_RETRIES: " + str(FANOUT_SINK_RETRIES))
+METRICS_PORT = os.getenv("METRICS_PORT", 0)
+print("METRICS_PORT: " + str(METRICS_PORT))
+
+# Built-in sinks as (module, handler class); the modules are only imported when selected
+SINK_HANDLERS = {
+    "print": ("dbz_custom_handler", "PrintChangeHandler"),
+    "postgres": ("dbz_oracle_to_postgres_handler", "RawChangeHandler"),
+    "mssql": ("dbz_oracle_to_mssql_handler", "RawChangeHandler"),
+    "iceberg": ("dbz_oracle_to_iceberg_handler", "IcebergChangeHandler"),
+}
+
+
+def load_sink(spec):
+    """Create the handler for a sink name from SINK_HANDLERS or a `module:Class` spec"""
+    if ":" in spec:
+        module_name, class_name = spec.split(":", 1)
+    elif spec in SINK_HANDLERS:
+        module_name, class_name = SINK_HANDLERS[spec]
+    else:
+        raise ValueError(f"Unknown sink: {spec}. Use one of {sorted(SINK_HANDLERS)} or module:Class")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class SinkProgress:
+    """Progress of one fan-out sink: the last engine batch it committed and its failures"""
+
+    def __init__(self, name, handler, required):
+        self.name = name
+        self.handler = handler
+        self.required = required
+        self.committed_batch = 0
+        self.committed_records = 0
+        self.failures = 0
+        self.last_error = None
+
+    def __repr__(self):
+        return (f"SinkProgress({self.name}, required={self.required}, committed_batch={self.committed_batch}, "
+                f"committed_records={self.committed_records}, failures={self.failures})")
+
+
+class FanOutChangeHandler(BasePythonChangeHandler):
+    """
+    Feeds every engine batch to several sinks from a single Debezium engine.
+
+    One LogMiner session serves all sinks. Each batch is handed to every sink
+    concurrently, one thread per sink, and `handleJsonBatch` only returns (so
+    the engine only marks the batch processed and advances the offset) once
+    every required sink has committed it. A required sink that fails is retried
+    on its own, without writing the batch again to sinks that already committed
+    it. If it still fails, the error is raised and the engine replays the batch
+    after a restart. Optional sinks never hold back the offset; batches they
+    fail are logged and counted in their progress.
+    """
+
+    def __init__(self, sinks=FANOUT_SINKS, optional_sinks=FANOUT_OPTIONAL_SINKS, retries=FANOUT_SINK_RETRIES):
+        names = [name.strip() for name in sinks.split(",") if name.strip()]
+        optional = {name.strip() for name in optional_sinks.split(",") if name.strip()}
+        if not names:
+            raise ValueError("FANOUT_SINKS must name at least one sink")
+        unknown = optional - set(names)
+        if unknown:
+            raise ValueError(f"FANOUT_OPTIONAL_SINKS lists sinks not in FANOUT_SINKS: {sorted(unknown)}")
+        self.retries = int(retries)
+        self.batch_number = 0
+        self.sinks = []
+        try:
+            for name in names:
+                self.sinks.append(SinkProgress(name, load_sink(name), name not in optional))
+        except Exception:
+            self.close()
+            raise
+        self._executor = ThreadPoolExecutor(max_workers=len(self.sinks), thread_name_prefix="dbz-sink")
+
+    def load_offsets(self):
+        """
+        Offsets every required sink has committed, for seeding the engine's offset file.
+
+        Only sinks that store offsets (OFFSET_STORAGE=database) without a spool
+        take part; for each source partition the oldest of their offsets is
+        used, so no sink misses events.
+        """
+        sinks = [
+            sink for sink in self.sinks
+            if sink.required and getattr(sink.handler, "stores_offsets", False)
+            and getattr(sink.handler, "spool", None) is None
+        ]
+        if CLEAR_OFFSET_AND_HISTORY_FILE:
+            for sink in sinks:
+                sink.handler.clear_offsets()
+        return oldest_offsets([sink.handler.load_offsets() for sink in sinks])
+
+    def close(self):
+        """Close every sink handler that has a close() (background writers, connection pools)"""
+        executor = getattr(self, "_executor", None)
+        if executor is not None:
+            executor.shutdown(wait=True)
+        for sink in self.sinks:
+            close = getattr(sink.handler, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception as e:
+                    print(f"Error closing sink {sink.name}: {str(e)}")
+
+    def _deliver(self, sink, records):
+        """Hand the batch to one sink, retrying required sinks; returns the last error or None"""
+        attempts = 1 + (self.retries if sink.required else 0)
+        for attempt in range(1, attempts + 1):
+            try:
+                sink.handler.handleJsonBatch(records)
+            except Exception as e:
+                sink.failures += 1
+                sink.last_error = e
+                metrics.FANOUT_FAILURES.inc(sink=sink.name)
+                print(f"Sink {sink.name} failed batch {self.batch_number} (attempt {attempt}/{attempts}): {str(e)}")
+                if attempt < attempts:
+                    time.sleep(min(2 ** (attempt - 1), 30))
+                continue
+            sink.committed_batch = self.batch_number
+            sink.committed_records += len(records)
+            sink.last_error = None
+            metrics.FANOUT_BATCHES.inc(sink=sink.name)
+            return None
+        return sink.last_error
+
+    def handleJsonBatch(self, records: List[ChangeEvent]):
+        """Capture the batch once and wait until every required sink has committed it"""
+        self.batch_number += 1
+        # Read once from the engine; every sink gets the same ChangeBatch instead of crossing into the JVM itself
+        batch = read_batch(records)
+        futures = [(sink, self._executor.submit(self._deliver, sink, batch)) for sink in self.sinks]
+        failed = []
+        for sink, future in futures:
+            error = future.result()
+            if not sink.required:
+                metrics.FANOUT_BATCHES_BEHIND.set(self.batch_number - sink.committed_batch, sink=sink.name)
+            elif error is not None:
+                failed.append((sink.name, error))
+        if failed:
+            names = ", ".join(name for name, _ in failed)
+            raise RuntimeError(f"Batch {self.batch_number} was not committed by sink(s): {names}") from failed[0][1]
+
+
+if __name__ == '__main__':
+    props = Properties()
+    props.setProperty("name", ENGINE_NAME)
+    props.setProperty("snapshot.mode", SNAPSHOT_MODE)
+    props.setProperty("topic.prefix", "dwh")
+    props.setProperty("tombstones.on.delete", "false")
+    props.setProperty("log.mining.strategy", "online_catalog")
+    props.setProperty("database.connection.adapter", "logminer")
+    props.setProperty("connector.class", "io.debezium.connector.oracle.OracleConnector")
+    props.setProperty("offset.storage", "org.apache.kafka.connect.storage.FileOffsetBackingStore")
+    props.setProperty("offset.storage.file.filename", OFFSET_FILE)
+    props.setProperty("offset.flush.interval.ms", str(OFFSET_FLUSH_INTERVAL_MS))
+    props.setProperty("schema.history.internal", "io.debezium.storage.file.history.FileSchemaHistory")
+    props.setProperty("schema.history.internal.file.filename", HISTORY_FILE)
+    props.setProperty("tasks.max", "1")
+    props.setProperty("database.hostname", ORACLE_HOST)
+    props.setProperty("database.port", ORACLE_PORT)
+    props.setProperty("database.user", ORACLE_USER)
+    props.setProperty("database.password", ORACLE_PASSWORD)
+    props.setProperty("database.dbname", ORACLE_DBNAME)
+    props.setProperty("database.pdb.name", ORACLE_PDB_NAME)
+    props.setProperty("database.server.name", "server1")
+    props.setProperty("table.include.list", ORACLE_TABLE_INCLUDE_LIST)
+    props.setProperty("table.whitelist", ORACLE_TABLE_INCLUDE_LIST)
+    props.setProperty("poll.interval.ms", "1000")
+    props.setProperty("decimal.handling.mode", "string")
+
+    if int(METRICS_PORT):
+        metrics.start_http_server(int(METRICS_PORT))
+
+    # One engine (one LogMiner session) for all sinks
+    handler = FanOutChangeHandler()
+    seed_offset_file(OFFSET_FILE, handler.load_offsets())
+    engine = DebeziumJsonEngine(properties=props, handler=handler)
+
+    try:
+        engine.run()
+    finally:
+        handler.close()
@@ -0,0 +1,95 @@
+import time
+
+# Longest error text kept with a dead-lettered record
+MAX_ERROR_CHARS = 4000
+
+
+def describe_error(error):
+    """One line naming the error type and message, for the dead-letter table"""
+    text = f"{type(error).__name__}: {error}".strip()
+    return text[:MAX_ERROR_CHARS]
+
+
+def payload_bytes(payload):
+    """A key or value as stored in a dead-letter table: the exact bytes, even of text that is not valid UTF-8"""
+    if payload is None or isinstance(payload, bytes):
+        return payload
+    # Lone surrogates are kept instead of failing the dead-letter insert too
+    return payload.encode("utf-8", "surrogatepass")
+
+
+class TransientRetry:
+    """
+    Runs a write again when it failed with a transient error.
+
+    `is_transient(error)` decides which errors are worth retrying, typically a
+    lost connection, a failover or a deadlock. Those are retried up to `retries`
+    times with exponential backoff capped at `max_backoff` seconds; any other
+    error, or the last transient one, is raised. `on_retry(error, attempt)` runs
+    before every retry, e.g. to reconnect.
+    """
+
+    def __init__(self, is_transient, retries=3, max_backoff=30.0, on_retry=None):
+        self.is_transient = is_transient
+        self.retries = retries
+        self.max_backoff = max_backoff
+        self._on_retry = on_retry
+
+    def __call__(self, fn, on_retry=None):
+        """Return fn(), retrying transient failures; `on_retry` replaces the default callback"""
+        on_retry = on_retry or self._on_retry
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except Exception as e:
+                if attempt >= self.retries or not self.is_transient(e):
+                    raise
+                attempt += 1
+                print(f"Transient error, retrying ({attempt}/{self.retries}): {str(e)}")
+                time.sleep(min(2 ** (attempt - 1), self.max_backoff))
+                if on_retry is not None:
+                    on_retry(e, attempt)
+
+
+class BatchBisector:
+    """
+    Writes a batch in bulk and isolates the records that make it fail.
+
+    `write_fn(rows, offset)` must write and commit `rows`, rolling back on
+    failure. When it raises an error that `is_poison(error)` attributes to the
+    data (a value too large, bad encoding, a constraint violation), the rows are
+    split in two halves that are written in turn, recursively, so a few bad
+    records among n are found in about log2(n) writes each while the good rows
+    keep loading in large batches. A single record that still fails is handed
+    to `dead_letter_fn([(row, error text)], offset)`, which must store and commit
+    it. Any other error is raised unchanged, so a failure of the sink itself
+    never sends a whole batch to the dead-letter table.
+
+    The halves keep the order of the batch and only the last one carries
+    `offset`, so the offset is committed with the batch's last record whether
+    that record was written or dead-lettered.
+    """
+
+    def __init__(self, is_poison):
+        self.is_poison = is_poison
+
+    def write(self, rows, write_fn, dead_letter_fn, offset=None):
+        """Write `rows`; returns the number of dead-lettered records"""
+        if not rows:
+            return 0
+        try:
+            write_fn(rows, offset)
+            return 0
+        except Exception as e:
+            if not self.is_poison(e):
+                raise
+            error = e
+        if len(rows) == 1:
+            print(f"Dead-lettering a record of {rows[0][1]}: {str(error)}")
+            dead_letter_fn([(rows[0], describe_error(error))], offset)
+            return 1
+        middle = len(rows) // 2
+        print(f"Batch of {len(rows)} records failed, retrying in halves: {str(error)}")
+        return (self.write(rows[:middle], write_fn, dead_letter_fn)
+                + self.write(rows[middle:], write_fn, dead_letter_fn, offset))
@@ -0,0 +1,219 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))
+LAG_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over cumulative buckets"""
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time spent in the `with` block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """A set of metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+BATCH_RECORDS = REGISTRY.register(Histogram(
+    "dbz_batch_records", "Records per batch received from the engine", ["sink"], COUNT_BUCKETS))
+BATCH_BYTES = REGISTRY.register(Histogram(
+    "dbz_batch_bytes", "Key and value characters per batch received from the engine", ["sink"], BYTES_BUCKETS))
+RECORDS = REGISTRY.register(Counter(
+    "dbz_records_total", "Records received per destination", ["sink", "destination"]))
+CONVERT_SECONDS = REGISTRY.register(Histogram(
+    "dbz_convert_seconds", "Time spent converting engine records into rows", ["sink"]))
+INSERT_SECONDS = REGISTRY.register(Histogram(
+    "dbz_insert_seconds", "Time spent executing the statements of one insert batch", ["sink"]))
+COMMIT_SECONDS = REGISTRY.register(Histogram(
+    "dbz_commit_seconds", "Time spent committing one insert batch", ["sink"]))
+ROWS_WRITTEN = REGISTRY.register(Counter(
+    "dbz_rows_written_total", "Rows committed to the sink", ["sink"]))
+BATCH_ERRORS = REGISTRY.register(Counter(
+    "dbz_batch_errors_total", "Insert batches that failed and were rolled back", ["sink"]))
+SOURCE_LAG_SECONDS = REGISTRY.register(Histogram(
+    "dbz_source_lag_seconds", "Time from the source change (source.ts_ms) to the sink commit", ["sink"], LAG_BUCKETS))
+LAST_SOURCE_LAG_SECONDS = REGISTRY.register(Gauge(
+    "dbz_last_source_lag_seconds", "Source-to-sink lag of the most recently committed batch", ["sink"]))
+BATCH_SIZE_LIMIT = REGISTRY.register(Gauge(
+    "dbz_batch_size_limit_rows", "Row limit chosen by adaptive batch sizing per destination", ["sink", "destination"]))
+SPOOL_PENDING_BYTES = REGISTRY.register(Gauge(
+    "dbz_spool_pending_bytes", "Bytes in the local spool not yet loaded into the sink", ["sink"]))
+SPOOL_LOAD_FAILURES = REGISTRY.register(Counter(
+    "dbz_spool_load_failures_total", "Failed attempts to load a spooled batch into the sink", ["sink"]))
+FANOUT_BATCHES = REGISTRY.register(Counter(
+    "dbz_fanout_batches_total", "Engine batches handled by each fan-out sink", ["sink"]))
+FANOUT_FAILURES = REGISTRY.register(Counter(
+    "dbz_fanout_failures_total", "Failed attempts to hand an engine batch to a fan-out sink", ["sink"]))
+FANOUT_BATCHES_BEHIND = REGISTRY.register(Gauge(
+    "dbz_fanout_batches_behind", "Engine batches an optional fan-out sink has missed", ["sink"]))
+TABLE_COMPACTIONS = REGISTRY.register(Counter(
+    "dbz_table_compactions_total", "Small-file compactions of columnar sink tables", ["sink", "destination"]))
+DEAD_LETTERS = REGISTRY.register(Counter(
+    "dbz_dead_letters_total", "Records that failed on their own and went to the dead-letter table", ["sink", "destination"]))
+WRITE_RETRIES = REGISTRY.register(Counter(
+    "dbz_write_retries_total", "Writes retried after a transient error, e.g. a lost connection", ["sink"]))
+
+
+def observe_source_lag(sink, source_ts_ms):
+    """Record the lag between a source change timestamp (ms) and now"""
+    if source_ts_ms is None:
+        return
+    lag = max(time.time() - source_ts_ms / 1000.0, 0.0)
+    SOURCE_LAG_SECONDS.observe(lag, sink=sink)
+    LAST_SOURCE_LAG_SECONDS.set(lag, sink=sink)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise print a line to stderr every few seconds
+        pass
+
+
+def start_http_server(port, host="0.0.0.0"):
+    """Serve REGISTRY on http://host:port/metrics from a daemon thread"""
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name="dbz-metrics", daemon=True)
+    thread.start()
+    print(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
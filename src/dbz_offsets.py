@@ -0,0 +1,129 @@
+import json
+import os
+
+# Value of the engine's `name` property; Kafka Connect uses it as the offset namespace
+ENGINE_NAME = "engine"
+
+_INTEGER_CLASSES = ("java.lang.Long", "java.lang.Integer", "java.lang.Short", "java.lang.Byte")
+_FLOAT_CLASSES = ("java.lang.Double", "java.lang.Float")
+
+
+def _to_python(value):
+    """Convert a Kafka Connect offset value (Java map, list or boxed scalar) to plain Python"""
+    if value is None or isinstance(value, (bool, str)) or not hasattr(value, "getClass"):
+        return value
+    if hasattr(value, "entrySet"):
+        return {str(entry.getKey()): _to_python(entry.getValue()) for entry in value.entrySet()}
+    if hasattr(value, "toArray"):
+        return [_to_python(item) for item in value.toArray()]
+    class_name = value.getClass().getName()
+    if class_name == "java.lang.Boolean":
+        return bool(value)
+    if class_name in _INTEGER_CLASSES:
+        return int(value)
+    if class_name in _FLOAT_CLASSES:
+        return float(value)
+    return str(value)
+
+
+def _dumps(document):
+    # Sorted keys so the same partition always maps to the same dbz_offsets row
+    return json.dumps(document, sort_keys=True, separators=(",", ":"))
+
+
+def record_offset(record):
+    """
+    Return (source partition JSON, source offset JSON) of an engine record, or None.
+
+    The engine's records expose the connector's SourceRecord; resuming from its
+    offset continues after that record. Records that already carry the pair
+    (see BatchEvent in dbz_records) provide `source_offset()`.
+    """
+    source_offset = getattr(record, "source_offset", None)
+    if source_offset is not None:
+        return source_offset()
+    try:
+        source_record = record.sourceRecord()
+    except AttributeError:
+        return None
+    if source_record is None:
+        return None
+    offset = _to_python(source_record.sourceOffset())
+    if not offset:
+        return None
+    return _dumps(_to_python(source_record.sourcePartition()) or {}), _dumps(offset)
+
+
+def offset_scn(offset_json):
+    """Resume SCN of an Oracle connector offset, or None"""
+    try:
+        return int(json.loads(offset_json).get("scn"))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def oldest_offsets(offsets_per_sink):
+    """
+    Combine the stored offsets of several sinks into the ones every sink has reached.
+
+    `offsets_per_sink` is a list of {partition JSON: offset JSON}. A partition
+    is only kept when every sink has an offset for it with a resume SCN, and the
+    lowest one wins; otherwise the engine's own offset file is left to decide.
+    """
+    if not offsets_per_sink:
+        return {}
+    combined = {}
+    for partition in set.intersection(*(set(offsets) for offsets in offsets_per_sink)):
+        candidates = [offsets[partition] for offsets in offsets_per_sink]
+        if any(offset_scn(offset) is None for offset in candidates):
+            continue
+        combined[partition] = min(candidates, key=offset_scn)
+    return combined
+
+
+def seed_offset_file(path, offsets, engine_name=ENGINE_NAME):
+    """
+    Write `offsets` ({partition JSON: offset JSON}) to a FileOffsetBackingStore file.
+
+    The file is what the engine reads on start, so seeding it from the sink's
+    dbz_offsets table makes the engine resume exactly after the last committed
+    batch. Keys and values are serialized with the same schemaless JsonConverter
+    and Java serialization the engine uses. Needs the JVM started by pydbzengine.
+    Returns False (leaving the file alone) when there is nothing to seed.
+    """
+    if not offsets:
+        return False
+    import jpype
+
+    JsonConverter = jpype.JClass("org.apache.kafka.connect.json.JsonConverter")
+    HashMap = jpype.JClass("java.util.HashMap")
+    Arrays = jpype.JClass("java.util.Arrays")
+    ObjectOutputStream = jpype.JClass("java.io.ObjectOutputStream")
+    FileOutputStream = jpype.JClass("java.io.FileOutputStream")
+    ByteArray = jpype.JArray(jpype.JByte)
+
+    config = HashMap()
+    config.put("schemas.enable", "false")
+    key_converter = JsonConverter()
+    key_converter.configure(config, True)
+    value_converter = JsonConverter()
+    value_converter.configure(config, False)
+
+    raw = HashMap()
+    for partition_json, offset_json in offsets.items():
+        partition = key_converter.toConnectData(engine_name, ByteArray(partition_json.encode("utf-8"))).value()
+        offset = value_converter.toConnectData(engine_name, ByteArray(offset_json.encode("utf-8"))).value()
+        raw.put(
+            key_converter.fromConnectData(engine_name, None, Arrays.asList(engine_name, partition)),
+            value_converter.fromConnectData(engine_name, None, offset),
+        )
+
+    tmp_path = f"{path}.tmp"
+    stream = ObjectOutputStream(FileOutputStream(tmp_path))
+    try:
+        stream.writeObject(raw)
+    finally:
+        stream.close()
+    os.replace(tmp_path, path)
+    print(f"Seeded {len(offsets)} offset(s) from the sink into {path}")
+    return True
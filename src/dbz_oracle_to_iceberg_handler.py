@@ -0,0 +1,571 @@
+import os
+import time
+import json
+import uuid
+import threading
+
+from typing import List
+from pydbzengine import ChangeEvent, BasePythonChangeHandler
+from pydbzengine import Properties, DebeziumJsonEngine
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyiceberg.catalog import load_catalog
+from pyiceberg.exceptions import NamespaceAlreadyExistsError, NoSuchTableError, ResolveError, ValidationError
+
+from dbz_envelope import unwrap, after_field_types, infer_field_type, flat_table_name
+from dbz_spool import Spool
+from dbz_isolation import describe_error
+from dbz_offsets import ENGINE_NAME
+from dbz_records import read_batch
+import dbz_metrics as metrics
+
+OFFSET_FILE = os.getenv("OFFSET_FILE", "/app/storage/offsets.dat")
+HISTORY_FILE = os.getenv("HISTORY_FILE", "/app/storage/history.dat")
+CLEAR_OFFSET_AND_HISTORY_FILE = os.getenv("CLEAR_OFFSET_AND_HISTORY_FILE", "False").lower() == "true"
+print("CLEAR_OFFSET_AND_HISTORY_FILE: " + str(CLEAR_OFFSET_AND_HISTORY_FILE))
+
+if CLEAR_OFFSET_AND_HISTORY_FILE:
+    try:
+        os.remove(OFFSET_FILE)
+        print(f"Successfully removed offset file: {OFFSET_FILE}")
+    except OSError as e:
+        print(f"Error removing offset file {OFFSET_FILE}: {e}")
+
+    try:
+        os.remove(HISTORY_FILE)
+        print(f"Successfully removed history file: {HISTORY_FILE}")
+    except OSError as e:
+        print(f"Error removing history file {HISTORY_FILE}: {e}")
+
+OFFSET_FLUSH_INTERVAL_MS = os.getenv("OFFSET_FLUSH_INTERVAL_MS", 1000)
+ORACLE_HOST = os.getenv("ORACLE_HOST", "oracle")
+ORACLE_PORT = os.getenv("ORACLE_PORT", 1521)
+ORACLE_USER = os.getenv("ORACLE_USER", "c##dbzuser")
+ORACLE_PASSWORD = os.getenv("ORACLE_PASSWORD", "dbz")
+ORACLE_DBNAME = os.getenv("ORACLE_DBNAME", "ORCLCDB")
+ORACLE_PDB_NAME = os.getenv("ORACLE_PDB_NAME", "ORCLPDB1")
+ORACLE_TABLE_INCLUDE_LIST = os.getenv("ORACLE_TABLE_INCLUDE_LIST", "C##DBZUSER.CUSTOMERS")
+# Engine snapshot.mode, e.g. schema_only or initial
+SNAPSHOT_MODE = os.getenv("SNAPSHOT_MODE", "schema_only")
+# Local filesystem warehouse holding the Parquet data and Iceberg metadata files
+ICEBERG_WAREHOUSE = os.getenv("ICEBERG_WAREHOUSE", "/app/storage/iceberg")
+print("ICEBERG_WAREHOUSE: " + ICEBERG_WAREHOUSE)
+# SQL catalog database; any SQLAlchemy URL, SQLite inside the warehouse by default
+ICEBERG_CATALOG_URI = os.getenv("ICEBERG_CATALOG_URI", f"sqlite:///{ICEBERG_WAREHOUSE}/catalog.db")
+ICEBERG_NAMESPACE = os.getenv("ICEBERG_NAMESPACE", "dbz")
+# A new set of files is written once this much Arrow data is buffered...
+ICEBERG_ROLL_MB = os.getenv("ICEBERG_ROLL_MB", 64)
+# ...or the oldest buffered batch is this old
+ICEBERG_ROLL_SECONDS = os.getenv("ICEBERG_ROLL_SECONDS", 300)
+print("ICEBERG_ROLL_MB: " + str(ICEBERG_ROLL_MB) + ", ICEBERG_ROLL_SECONDS: " + str(ICEBERG_ROLL_SECONDS))
+# Parquet file and row group sizes of new tables
+ICEBERG_TARGET_FILE_MB = os.getenv("ICEBERG_TARGET_FILE_MB", 128)
+ICEBERG_ROW_GROUP_ROWS = os.getenv("ICEBERG_ROW_GROUP_ROWS", 131072)
+# How often tables are checked for small files, 0 disables compaction
+ICEBERG_COMPACT_INTERVAL_SECONDS = os.getenv("ICEBERG_COMPACT_INTERVAL_SECONDS", 3600)
+# A table is rewritten once it has this many files under half the target size...
+ICEBERG_COMPACT_MIN_FILES = os.getenv("ICEBERG_COMPACT_MIN_FILES", 16)
+# ...and is no larger than this, since compaction rewrites it in memory
+ICEBERG_COMPACT_MAX_MB = os.getenv("ICEBERG_COMPACT_MAX_MB", 2048)
+# Converted batches wait in $SPOOL_DIR/iceberg until their files are committed
+SPOOL_DIR = os.getenv("SPOOL_DIR", "") or "/app/storage/spool"
+SPOOL_SEGMENT_MB = os.getenv("SPOOL_SEGMENT_MB", 64)
+SPOOL_FSYNC = os.getenv("SPOOL_FSYNC", "True").lower() == "true"
+METRICS_PORT = os.getenv("METRICS_PORT", 0)
+
+# Connect schema type -> Arrow column type; Iceberg has no 8 or 16 bit integers
+ARROW_COLUMN_TYPES = {
+    "int8": pa.int32(),
+    "int16": pa.int32(),
+    "int32": pa.int32(),
+    "int64": pa.int64(),
+    "float32": pa.float32(),
+    "float64": pa.float64(),
+    "boolean": pa.bool_(),
+    "string": pa.string(),
+}
+# Columns added to every row ahead of the table's own
+CHANGE_COLUMNS = [
+    ("_op", pa.string()),
+    ("_source_ts", pa.timestamp("us", tz="UTC")),
+    ("_scn", pa.int64()),
+]
+# Side column holding, as a JSON object, the values of a row that do not fit their column's type
+INVALID_COLUMN = "_invalid"
+# Snapshot summary property recording the last spool frame a commit covers
+SPOOL_POSITION_PROPERTY = "dbz.spool-position"
+# (table type, batch type) pairs Iceberg can promote the table column to
+PROMOTIONS = {(pa.int32(), pa.int64()), (pa.float32(), pa.float64())}
+
+
+def flatten_change(value_json):
+    """
+    Flatten a Debezium value into (table, {column: (type, logical name)}, row).
+
+    The row is the `after` image, or the `before` image for deletes, plus the
+    CHANGE_COLUMNS. Truncates produce a row with only the change columns.
+    Returns None for tombstones and documents that are not change events.
+    """
+    if not value_json:
+        return None
+    envelope, value_schema = unwrap(json.loads(value_json))
+    if not isinstance(envelope, dict) or "op" not in envelope:
+        return None
+    source = envelope.get("source") or {}
+    table = f"{source.get('schema')}.{source.get('table')}".upper()
+    op = envelope["op"]
+    image = (envelope.get("before") if op == "d" else envelope.get("after")) or {}
+    field_types = after_field_types(value_schema)
+    if not field_types:
+        field_types = {column: (infer_field_type(value), None) for column, value in image.items()}
+    scn = source.get("commit_scn") or source.get("scn")
+    row = dict(image)
+    row["_op"] = op
+    row["_source_ts"] = source.get("ts_ms")
+    row["_scn"] = int(scn) if isinstance(scn, (int, str)) and str(scn).isdigit() else None
+    return table, field_types, row
+
+
+def _reject(invalid, index, column, value):
+    """Record a value of row `index` that does not fit its column"""
+    if invalid[index] is None:
+        invalid[index] = {}
+    invalid[index][column] = value
+
+
+def _invalid_array(invalid):
+    return pa.array(
+        [None if values is None else json.dumps(values, default=str) for values in invalid], type=pa.string()
+    )
+
+
+def _column(name, values, arrow_type, invalid):
+    """Build an Arrow array of `arrow_type`; values that do not fit are left null and recorded in `invalid`"""
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        pass
+    fitted = []
+    for index, value in enumerate(values):
+        try:
+            pa.scalar(value, type=arrow_type)
+            fitted.append(value)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            fitted.append(None)
+            _reject(invalid, index, name, value)
+    return pa.array(fitted, type=arrow_type)
+
+
+def to_record_batch(destination, table, field_types, rows):
+    """Turn the flattened rows of one destination into an Arrow record batch"""
+    arrays = []
+    fields = []
+    for name, arrow_type in CHANGE_COLUMNS:
+        values = [row[name] for row in rows]
+        if name == "_source_ts":
+            values = [None if value is None else value * 1000 for value in values]
+        arrays.append(pa.array(values, type=arrow_type))
+        fields.append(pa.field(name, arrow_type))
+    invalid = [None] * len(rows)
+    for name, (field_type, _) in field_types.items():
+        arrow_type = ARROW_COLUMN_TYPES.get(field_type)
+        values = [row.get(name) for row in rows]
+        if arrow_type is None:
+            # Nested values are kept as JSON text, bytes as the converter's base64 text
+            arrow_type = pa.string()
+            values = [value if value is None or isinstance(value, str) else json.dumps(value) for value in values]
+        arrays.append(_column(name, values, arrow_type, invalid))
+        fields.append(pa.field(name, arrow_type))
+    arrays.append(_invalid_array(invalid))
+    fields.append(pa.field(INVALID_COLUMN, pa.string()))
+    schema = pa.schema(fields, metadata={"dbz.destination": destination, "dbz.table": table})
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def conform(data, types):
+    """
+    Cast the columns of `data` to `types` ({column: Arrow type}), e.g. the table's.
+
+    Columns missing from `types` and types the table can be promoted to are
+    kept. Values that do not fit are left null and added to INVALID_COLUMN, so
+    one bad value never blocks a table.
+    """
+    invalid = None
+    for name in data.column_names:
+        target = types.get(name)
+        column = data.column(name)
+        if name == INVALID_COLUMN or target is None or column.type == target or (target, column.type) in PROMOTIONS:
+            continue
+        try:
+            cast = column.cast(target)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            if invalid is None:
+                invalid = [None if values is None else json.loads(values) for values in data.column(INVALID_COLUMN).to_pylist()] \
+                    if INVALID_COLUMN in data.column_names else [None] * data.num_rows
+            fitted = []
+            for index, value in enumerate(column.to_pylist()):
+                try:
+                    fitted.append(None if value is None else pa.scalar(value, type=column.type).cast(target).as_py())
+                except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, OverflowError):
+                    fitted.append(None)
+                    _reject(invalid, index, name, value)
+            cast = pa.array(fitted, type=target)
+        data = data.set_column(data.schema.get_field_index(name), pa.field(name, target), cast)
+    if invalid is not None:
+        if INVALID_COLUMN in data.column_names:
+            data = data.set_column(data.schema.get_field_index(INVALID_COLUMN), INVALID_COLUMN, _invalid_array(invalid))
+        else:
+            data = data.append_column(INVALID_COLUMN, _invalid_array(invalid))
+    return data
+
+
+def is_data_error(error):
+    """Errors a retry cannot fix: the rows do not fit the table or its schema cannot take them"""
+    return isinstance(error, (ValueError, TypeError, pa.ArrowNotImplementedError, ResolveError, ValidationError))
+
+
+def encode_batch(batch):
+    """Serialize a record batch or table for the spool (Arrow IPC stream)"""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def decode_batch(payload):
+    """Inverse of `encode_batch`, as a pyarrow Table"""
+    return pa.ipc.open_stream(payload).read_all()
+
+
+class IcebergChangeHandler(BasePythonChangeHandler):
+    """
+    A change event handler that appends flattened row images to Iceberg tables.
+
+    Each engine batch is converted into one Arrow record batch per destination
+    and appended to a local spool before `handleJsonBatch` returns, so the
+    engine can acknowledge it. A writer thread collects spooled batches until
+    ICEBERG_ROLL_MB of Arrow data is buffered or the oldest is
+    ICEBERG_ROLL_SECONDS old, then appends each destination's rows to its
+    table (one Iceberg commit per table, Parquet files of up to
+    ICEBERG_TARGET_FILE_MB) and only then acknowledges the spool. Every commit
+    records the last spool frame it covers, so batches replayed from the spool
+    after a crash are not appended twice.
+
+    Tables live in ICEBERG_NAMESPACE, named after the source schema and
+    table (see `table_name`), with the change columns `_op`, `_source_ts` and
+    `_scn` ahead of the row image. Columns that appear later are added to the
+    table schema. Values that do not fit their column's type are kept as JSON
+    in the `_invalid` column. Batches a table cannot take at all (schema or
+    validation errors) are moved to the quarantine spool in
+    $SPOOL_DIR/iceberg-quarantine instead of being retried forever. Tables
+    that pile up small files are periodically rewritten into target-size files.
+    """
+    ROLL_BYTES = int(float(ICEBERG_ROLL_MB) * 1024 * 1024)
+    ROLL_SECONDS = float(ICEBERG_ROLL_SECONDS)
+    TARGET_FILE_BYTES = int(float(ICEBERG_TARGET_FILE_MB) * 1024 * 1024)
+    ROW_GROUP_ROWS = int(ICEBERG_ROW_GROUP_ROWS)
+    COMPACT_INTERVAL_SECONDS = float(ICEBERG_COMPACT_INTERVAL_SECONDS)
+    COMPACT_MIN_FILES = int(ICEBERG_COMPACT_MIN_FILES)
+    COMPACT_MAX_BYTES = int(float(ICEBERG_COMPACT_MAX_MB) * 1024 * 1024)
+
+    def __init__(self):
+        super().__init__()
+        os.makedirs(ICEBERG_WAREHOUSE, exist_ok=True)
+        self.catalog = load_catalog(
+            "dbz", type="sql", uri=ICEBERG_CATALOG_URI, warehouse=f"file://{os.path.abspath(ICEBERG_WAREHOUSE)}"
+        )
+        try:
+            self.catalog.create_namespace(ICEBERG_NAMESPACE)
+        except NamespaceAlreadyExistsError:
+            pass
+        # Iceberg table name -> loaded table, and the last Arrow schema merged into it
+        self._tables = {}
+        self._schemas = {}
+
+        self.spool = Spool(
+            os.path.join(SPOOL_DIR, "iceberg"),
+            int(float(SPOOL_SEGMENT_MB) * 1024 * 1024),
+            fsync=SPOOL_FSYNC,
+        )
+        self.spool_id = self._spool_id(self.spool.directory)
+        # Batches that could not be written, kept for inspection and replay; nothing reads it
+        self.quarantine = Spool(
+            os.path.join(SPOOL_DIR, "iceberg-quarantine"),
+            int(float(SPOOL_SEGMENT_MB) * 1024 * 1024),
+            fsync=SPOOL_FSYNC,
+        )
+        metrics.SPOOL_PENDING_BYTES.set(self.spool.pending_bytes(), sink="iceberg")
+        self._stop = threading.Event()
+        self._next_compaction = time.monotonic() + self.COMPACT_INTERVAL_SECONDS
+        self._thread = threading.Thread(target=self._run, name="iceberg-writer", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _spool_id(directory):
+        """Random id of the spool directory, so positions of a recreated spool are not mistaken for old ones"""
+        path = os.path.join(directory, "spool.id")
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            spool_id = uuid.uuid4().hex
+            with open(path, "w") as f:
+                f.write(spool_id)
+            return spool_id
+
+    def close(self):
+        """Write everything still in the spool and stop the writer thread"""
+        if getattr(self, '_thread', None) is not None:
+            thread, self._thread = self._thread, None
+            self._stop.set()
+            thread.join()
+            self.spool.close()
+            self.quarantine.close()
+
+    def _load_table(self, name):
+        """Return the Iceberg table `name`, or None if it does not exist yet"""
+        table = self._tables.get(name)
+        if table is None:
+            try:
+                table = self._tables[name] = self.catalog.load_table(f"{ICEBERG_NAMESPACE}.{name}")
+            except NoSuchTableError:
+                return None
+        return table
+
+    def _table(self, name, schema):
+        """Load or create the Iceberg table `name`, adding columns of `schema` it does not have"""
+        table = self._load_table(name)
+        if table is None:
+            identifier = f"{ICEBERG_NAMESPACE}.{name}"
+            table = self.catalog.create_table(identifier, schema=schema, properties={
+                "write.target-file-size-bytes": str(self.TARGET_FILE_BYTES),
+                "write.parquet.row-group-limit": str(self.ROW_GROUP_ROWS),
+                "write.parquet.compression-codec": "zstd",
+            })
+            print(f"Created Iceberg table {identifier}")
+            self._tables[name] = table
+        if self._schemas.get(name) != schema:
+            # New columns, or a wider type (e.g. int64 inferred for an int32 column)
+            with table.update_schema() as update:
+                update.union_by_name(schema)
+            self._schemas[name] = schema
+        return table
+
+    @staticmethod
+    def _committed_position(table):
+        snapshot = table.current_snapshot()
+        return snapshot.summary.get(SPOOL_POSITION_PROPERTY) if snapshot is not None else None
+
+    def _position(self, frame):
+        # Zero padded, so positions of the same spool compare as strings
+        return f"{self.spool_id}:{frame.segment:012d}:{frame.end:012d}"
+
+    def _write(self, buffers, last):
+        """Append the buffered batches of every destination, skipping frames a table already has"""
+        position = self._position(last)
+        for destination, entries in buffers.items():
+            name = flat_table_name(entries[0][1].schema.metadata[b"dbz.table"].decode("utf-8"))
+            table = self._load_table(name)
+            committed = self._committed_position(table) if table is not None else None
+            if committed is not None and committed.startswith(self.spool_id):
+                # Frames appended before a crash, when the spool was not acknowledged yet
+                entries = [(frame_position, data) for frame_position, data in entries if frame_position > committed]
+                if not entries:
+                    continue
+            try:
+                self._append(name, table, entries, position)
+            except Exception as e:
+                if not is_data_error(e):
+                    raise
+                self._quarantine(destination, entries, e)
+                # The cached table may be behind a schema update that did commit
+                self._tables.pop(name, None)
+                self._schemas.pop(name, None)
+
+    def _append(self, name, table, entries, position):
+        """Append the buffered batches of one table in one commit"""
+        # Existing columns keep their type; new ones take the type of their first batch
+        types = {} if table is None else {field.name: field.type for field in table.schema().as_arrow()}
+        conformed = []
+        for _, data in entries:
+            data = conform(data.replace_schema_metadata(None), types)
+            for field in data.schema:
+                types.setdefault(field.name, field.type)
+            conformed.append(data)
+        data = pa.concat_tables(conformed, promote_options="permissive")
+        table = self._table(name, data.schema)
+        table_schema = table.schema().as_arrow()
+        data = data.cast(pa.schema([table_schema.field(column) for column in data.column_names]))
+        with metrics.INSERT_SECONDS.time(sink="iceberg"):
+            table.append(data, snapshot_properties={SPOOL_POSITION_PROPERTY: position})
+        metrics.ROWS_WRITTEN.inc(data.num_rows, sink="iceberg")
+        source_ts = pc.max(data["_source_ts"]).value
+        if source_ts is not None:
+            metrics.observe_source_lag("iceberg", source_ts / 1000.0)
+        print(f"Appended {data.num_rows} rows to {ICEBERG_NAMESPACE}.{name}")
+
+    def _quarantine(self, destination, entries, error):
+        """Move batches a table cannot take to the quarantine spool, with the error in their metadata"""
+        destination = destination.decode("utf-8") if isinstance(destination, bytes) else destination
+        rows = 0
+        for _, data in entries:
+            metadata = dict(data.schema.metadata or {})
+            metadata[b"dbz.error"] = describe_error(error).encode("utf-8")
+            self.quarantine.append(encode_batch(data.replace_schema_metadata(metadata)))
+            rows += data.num_rows
+        metrics.DEAD_LETTERS.inc(rows, sink="iceberg", destination=destination)
+        print(f"Quarantined {rows} rows of {destination}: {str(error)}")
+
+    def _compact(self):
+        """Rewrite tables with too many small files into target-size files"""
+        # Every table in the catalog; the cache is emptied after errors and only holds tables written since
+        for identifier in self.catalog.list_tables(ICEBERG_NAMESPACE):
+            name = identifier[-1]
+            try:
+                self._compact_table(name, identifier)
+            except Exception as e:
+                print(f"Error compacting {ICEBERG_NAMESPACE}.{name}: {str(e)}")
+                self._tables.pop(name, None)
+                self._schemas.pop(name, None)
+
+    def _compact_table(self, name, identifier):
+        """Rewrite one table if it has too many small files"""
+        table = self._tables[name] = self.catalog.load_table(identifier)
+        sizes = table.inspect.files()["file_size_in_bytes"].to_pylist()
+        small = [size for size in sizes if size < self.TARGET_FILE_BYTES // 2]
+        if len(small) < self.COMPACT_MIN_FILES:
+            return
+        if sum(sizes) > self.COMPACT_MAX_BYTES:
+            print(f"Skipping compaction of {ICEBERG_NAMESPACE}.{name}: larger than ICEBERG_COMPACT_MAX_MB")
+            return
+        properties = {}
+        position = self._committed_position(table)
+        if position is not None:
+            properties[SPOOL_POSITION_PROPERTY] = position
+        data = table.scan().to_arrow()
+        table.overwrite(data, snapshot_properties=properties)
+        metrics.TABLE_COMPACTIONS.inc(sink="iceberg", destination=name)
+        print(f"Compacted {len(sizes)} files of {ICEBERG_NAMESPACE}.{name}")
+
+    def _write_with_retry(self, buffers, last):
+        """Retry a failed write with backoff; returns False if stopped first"""
+        attempt = 0
+        while True:
+            try:
+                self._write(buffers, last)
+                return True
+            except Exception as e:
+                attempt += 1
+                print(f"Error writing Iceberg files (attempt {attempt}), retrying: {str(e)}")
+                metrics.SPOOL_LOAD_FAILURES.inc(sink="iceberg")
+                # The cached table may be behind a commit that failed halfway
+                self._tables.clear()
+                self._schemas.clear()
+                if self._stop.wait(min(2 ** (attempt - 1), 60)):
+                    return False
+
+    def _run(self):
+        # Destination -> Arrow tables read from the spool but not written yet
+        buffers = {}
+        buffered_bytes = 0
+        first_read = None
+        last = None
+        while True:
+            stopping = self._stop.is_set()
+            frame = self.spool.peek(timeout=0 if stopping else 1.0, after=last)
+            if frame is not None:
+                data = decode_batch(frame.payload)
+                buffers.setdefault(data.schema.metadata[b"dbz.destination"], []).append((self._position(frame), data))
+                buffered_bytes += data.nbytes
+                first_read = first_read or time.monotonic()
+                last = frame
+            due = last is not None and (
+                (stopping and frame is None)
+                or buffered_bytes >= self.ROLL_BYTES
+                or time.monotonic() - first_read >= self.ROLL_SECONDS
+            )
+            if due:
+                if not self._write_with_retry(buffers, last):
+                    return
+                self.spool.ack(last)
+                metrics.SPOOL_PENDING_BYTES.set(self.spool.pending_bytes(), sink="iceberg")
+                buffers, buffered_bytes, first_read, last = {}, 0, None, None
+            if stopping and frame is None:
+                return
+            if self.COMPACT_INTERVAL_SECONDS > 0 and time.monotonic() >= self._next_compaction:
+                self._next_compaction = time.monotonic() + self.COMPACT_INTERVAL_SECONDS
+                try:
+                    self._compact()
+                except Exception as e:
+                    print(f"Error compacting Iceberg tables: {str(e)}")
+                    self._tables.clear()
+                    self._schemas.clear()
+
+    def handleJsonBatch(self, records: List[ChangeEvent]):
+        """
+        Converts a batch of Debezium change events into Arrow record batches and spools them.
+        """
+
+        print(f"Processing {len(records)} records")
+
+        metrics.BATCH_RECORDS.observe(len(records), sink="iceberg")
+        started = time.perf_counter()
+        # Destination -> (source table, field types, rows)
+        images = {}
+        batch = read_batch(records)
+        for destination, value in zip(batch.destinations, batch.values):
+            change = flatten_change(value)
+            if change is None:
+                continue
+            table, field_types, row = change
+            _, destination_types, rows = images.setdefault(destination, (table, {}, []))
+            for column, field_type in field_types.items():
+                destination_types.setdefault(column, field_type)
+            rows.append(row)
+
+        for destination, (table, field_types, rows) in images.items():
+            self.spool.append(encode_batch(to_record_batch(destination, table, field_types, rows)))
+            metrics.RECORDS.inc(len(rows), sink="iceberg", destination=destination)
+        metrics.SPOOL_PENDING_BYTES.set(self.spool.pending_bytes(), sink="iceberg")
+        metrics.CONVERT_SECONDS.observe(time.perf_counter() - started, sink="iceberg")
+
+
+if __name__ == '__main__':
+    props = Properties()
+    props.setProperty("name", ENGINE_NAME)
+    props.setProperty("snapshot.mode", SNAPSHOT_MODE)
+    props.setProperty("topic.prefix", "dwh")
+    props.setProperty("tombstones.on.delete", "false")
+    props.setProperty("log.mining.strategy", "online_catalog")
+    props.setProperty("database.connection.adapter", "logminer")
+    props.setProperty("connector.class", "io.debezium.connector.oracle.OracleConnector")
+    props.setProperty("offset.storage", "org.apache.kafka.connect.storage.FileOffsetBackingStore")
+    props.setProperty("offset.storage.file.filename", OFFSET_FILE)
+    props.setProperty("offset.flush.interval.ms", str(OFFSET_FLUSH_INTERVAL_MS))
+    props.setProperty("schema.history.internal", "io.debezium.storage.file.history.FileSchemaHistory")
+    props.setProperty("schema.history.internal.file.filename", HISTORY_FILE)
+    props.setProperty("tasks.max", "1")
+    props.setProperty("database.hostname", ORACLE_HOST)
+    props.setProperty("database.port", ORACLE_PORT)
+    props.setProperty("database.user", ORACLE_USER)
+    props.setProperty("database.password", ORACLE_PASSWORD)
+    props.setProperty("database.dbname", ORACLE_DBNAME)
+    props.setProperty("database.pdb.name", ORACLE_PDB_NAME)
+    props.setProperty("database.server.name", "server1")
+    props.setProperty("table.include.list", ORACLE_TABLE_INCLUDE_LIST)
+    props.setProperty("table.whitelist", ORACLE_TABLE_INCLUDE_LIST)
+    props.setProperty("poll.interval.ms", "1000")
+    props.setProperty("decimal.handling.mode", "string")
+
+    if int(METRICS_PORT):
+        metrics.start_http_server(int(METRICS_PORT))
+
+    handler = IcebergChangeHandler()
+    engine = DebeziumJsonEngine(properties=props, handler=handler)
+
+    try:
+        engine.run()
+    finally:
+        # Write what is still in the spool
+        handler.close()
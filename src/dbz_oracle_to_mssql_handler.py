@@ -1,6 +1,6 @@
 import os
+import time
 from pathlib import Path
-import uuid
 import json
 import pyodbc
 
@@ -8,6 +8,19 @@ from typing import List
 from pydbzengine import ChangeEvent, BasePythonChangeHandler
 from pydbzengine import Properties, DebeziumJsonEngine
 
+from dbz_pipeline import BackgroundWriter
+from dbz_envelope import parse_change, coalesce_changes, parse_include_list, flat_table_name, SchemaCompactor, source_ts_ms, snapshot_phase
+from dbz_event_id import EventIdGenerator
+from dbz_sharding import ConnectionPool, ShardedWriter
+from dbz_batching import AdaptiveBatchSizer
+from dbz_spool import Spool, SpoolDrainer, encode_json, decode_json
+from dbz_compression import PayloadCompressor
+from dbz_offsets import ENGINE_NAME, seed_offset_file
+from dbz_records import read_batch
+from dbz_reader import SEQ_LOCK
+from dbz_isolation import TransientRetry, BatchBisector, payload_bytes
+import dbz_metrics as metrics
+
 OFFSET_FILE = os.getenv("OFFSET_FILE", "/app/storage/offsets.dat")
 HISTORY_FILE = os.getenv("HISTORY_FILE", "/app/storage/history.dat")
 CLEAR_OFFSET_AND_HISTORY_FILE = os.getenv("CLEAR_OFFSET_AND_HISTORY_FILE", "False").lower() == "true"
@@ -39,8 +52,128 @@ MSSQL_USER = os.getenv("MSSQL_USER", "SA")
 MSSQL_PASSWORD = os.getenv("MSSQL_PASSWORD", "mssql123AA")
 MSSQL_DB = os.getenv("MSSQL_DB", "raw_db")
 MSSQL_INSERT_BATCH_SIZE = os.getenv("MSSQL_INSERT_BATCH_SIZE", 1000)
+# Upper bound on the key/value characters of one insert batch, whatever its row count
+MSSQL_INSERT_BATCH_MB = os.getenv("MSSQL_INSERT_BATCH_MB", 64)
+# fixed: batches of MSSQL_INSERT_BATCH_SIZE rows
+# adaptive: one row limit per destination, tuned toward MSSQL_BATCH_TARGET_MS
+MSSQL_BATCH_SIZING = os.getenv("MSSQL_BATCH_SIZING", "fixed").lower()
+print("MSSQL_BATCH_SIZING: " + MSSQL_BATCH_SIZING)
+MSSQL_BATCH_TARGET_MS = os.getenv("MSSQL_BATCH_TARGET_MS", 500)
+MSSQL_BATCH_MIN_SIZE = os.getenv("MSSQL_BATCH_MIN_SIZE", 100)
+MSSQL_BATCH_MAX_SIZE = os.getenv("MSSQL_BATCH_MAX_SIZE", 50000)
+# Number of batches that may wait for the background writer thread. 0 writes
+# synchronously on the engine thread.
+MSSQL_WRITER_QUEUE_DEPTH = os.getenv("MSSQL_WRITER_QUEUE_DEPTH", 0)
+# Number of connections each batch is sharded across. 1 writes on a single connection.
+MSSQL_WRITER_CONNECTIONS = os.getenv("MSSQL_WRITER_CONNECTIONS", 1)
+# Shard by destination and record key instead of destination only
+WRITER_SHARD_BY_KEY = os.getenv("WRITER_SHARD_BY_KEY", "False").lower() == "true"
+# executemany: plain cursor.executemany (one ODBC round trip per row)
+# fast_executemany: parameter-array binding with explicit type/size hints
+# openjson: whole batch sent as one JSON parameter and inserted with OPENJSON
+MSSQL_LOAD_MODE = os.getenv("MSSQL_LOAD_MODE", "executemany").lower()
+print("MSSQL_LOAD_MODE: " + MSSQL_LOAD_MODE)
+# Upper bound for the parameter array buffer used by fast_executemany. Batches whose
+# key/value columns would need more than this fall back to NVARCHAR(MAX) streaming.
+MSSQL_BIND_BUFFER_MB = os.getenv("MSSQL_BIND_BUFFER_MB", 256)
+# raw: append envelopes to raw_events
+# replica: maintain one replica table per ORACLE_TABLE_INCLUDE_LIST entry
+# both: do both in the same transaction
+MSSQL_SINK_MODE = os.getenv("MSSQL_SINK_MODE", "raw").lower()
+print("MSSQL_SINK_MODE: " + MSSQL_SINK_MODE)
+REPLICA_TABLE_PREFIX = os.getenv("REPLICA_TABLE_PREFIX", "replica_")
+# uuid4: random ids, uuid7: time ordered ids, source: derived from the Debezium
+# source position so replayed events are deduplicated by the primary key
+EVENT_ID_STRATEGY = os.getenv("EVENT_ID_STRATEGY", "uuid4").lower()
+print("EVENT_ID_STRATEGY: " + EVENT_ID_STRATEGY)
+# full: store key/value as received
+# compact: store only the payload, with the schema deduplicated into raw_schemas
+ENVELOPE_MODE = os.getenv("ENVELOPE_MODE", "full").lower()
+print("ENVELOPE_MODE: " + ENVELOPE_MODE)
+# json: store key/value as NVARCHAR JSON text
+# zstd: store them zstd compressed in key_zstd/value_zstd (VARBINARY), with one
+# trained dictionary per destination kept in raw_dictionaries
+PAYLOAD_FORMAT = os.getenv("PAYLOAD_FORMAT", "json").lower()
+print("PAYLOAD_FORMAT: " + PAYLOAD_FORMAT)
+PAYLOAD_ZSTD_LEVEL = os.getenv("PAYLOAD_ZSTD_LEVEL", 3)
+PAYLOAD_DICT_KB = os.getenv("PAYLOAD_DICT_KB", 64)
+# Records sampled per destination to train its dictionary
+PAYLOAD_DICT_SAMPLES = os.getenv("PAYLOAD_DICT_SAMPLES", 1000)
+# Retrain a destination's dictionary after this many records, 0 never retrains
+PAYLOAD_DICT_RETRAIN_RECORDS = os.getenv("PAYLOAD_DICT_RETRAIN_RECORDS", 0)
+# Port of the Prometheus metrics endpoint, 0 disables it
+METRICS_PORT = os.getenv("METRICS_PORT", 0)
+# file: the engine's offset file only
+# database: also store the offset in dbz_offsets in the same transaction as each
+# batch, and seed the offset file from it on start
+OFFSET_STORAGE = os.getenv("OFFSET_STORAGE", "file").lower()
+print("OFFSET_STORAGE: " + OFFSET_STORAGE)
+# How often the engine flushes its offset file. With OFFSET_STORAGE=database the
+# file is only a fallback, so it can be flushed rarely.
+OFFSET_FLUSH_INTERVAL_MS = os.getenv("OFFSET_FLUSH_INTERVAL_MS", 1000)
+# Directory of the local spool; batches are appended there and loaded into the
+# database by a drainer thread. Empty writes to the database directly.
+SPOOL_DIR = os.getenv("SPOOL_DIR", "")
+print("SPOOL_DIR: " + SPOOL_DIR)
+SPOOL_SEGMENT_MB = os.getenv("SPOOL_SEGMENT_MB", 64)
+SPOOL_FSYNC = os.getenv("SPOOL_FSYNC", "True").lower() == "true"
+# Engine snapshot.mode, e.g. schema_only or initial
+SNAPSHOT_MODE = os.getenv("SNAPSHOT_MODE", "schema_only")
+print("SNAPSHOT_MODE: " + SNAPSHOT_MODE)
+# Bulk load the read events of an initial snapshot into a heap staging table
+# without indexes, moved into raw_events when the snapshot completes
+SNAPSHOT_BULK_LOAD = os.getenv("SNAPSHOT_BULK_LOAD", "True").lower() == "true"
+MSSQL_SNAPSHOT_BATCH_SIZE = os.getenv("MSSQL_SNAPSHOT_BATCH_SIZE", 50000)
+# Split a batch that fails because of its data until the bad records are found,
+# and store those in raw_events_dead_letter instead of stopping the engine
+DEAD_LETTER_ENABLED = os.getenv("DEAD_LETTER_ENABLED", "True").lower() == "true"
+print("DEAD_LETTER_ENABLED: " + str(DEAD_LETTER_ENABLED))
+# Retries of a write that lost its connection, with backoff up to WRITE_RETRY_MAX_SECONDS
+WRITE_RETRIES = os.getenv("WRITE_RETRIES", 3)
+WRITE_RETRY_MAX_SECONDS = os.getenv("WRITE_RETRY_MAX_SECONDS", 30)
+
+# Connect schema type -> SQL Server column type for replica tables
+REPLICA_COLUMN_TYPES = {
+    "int8": "SMALLINT",
+    "int16": "SMALLINT",
+    "int32": "INT",
+    "int64": "BIGINT",
+    "float32": "REAL",
+    "float64": "FLOAT",
+    "boolean": "BIT",
+    "string": "NVARCHAR(MAX)",
+}
+# Index keys are limited to 900 bytes, so string primary key columns can't be MAX
+REPLICA_KEY_STRING_TYPE = "NVARCHAR(450)"
+
+
+# Errors caused by the rows of a batch rather than by the database
+POISON_ERRORS = (pyodbc.DataError, pyodbc.IntegrityError, ValueError)
+# Deadlock victim; pyodbc raises it as a plain pyodbc.Error
+TRANSIENT_SQLSTATES = ("40001",)
+
+
+def is_poison_error(error):
+    """True if retrying the same rows can't succeed: bad values, truncation, constraint violations"""
+    return isinstance(error, POISON_ERRORS)
 
 
+def is_transient_error(error):
+    """True for lost connections, timeouts and deadlocks"""
+    if isinstance(error, pyodbc.OperationalError):
+        return True
+    return (isinstance(error, pyodbc.Error) and not is_poison_error(error)
+            and bool(error.args) and error.args[0] in TRANSIENT_SQLSTATES)
+
+
+def quote_identifier(name):
+    """Quote a SQL Server identifier"""
+    return "[" + name.replace("]", "]]") + "]"
+
+
+
+RAW_EVENT_COLUMNS = ("uuid", "destination", "[key]", "[value]", "key_schema_id", "value_schema_id")
+RAW_EVENT_ZSTD_COLUMNS = ("uuid", "destination", "key_zstd", "value_zstd", "key_schema_id", "value_schema_id")
 
 class RawChangeHandler(BasePythonChangeHandler):
     """
@@ -48,9 +181,72 @@ class RawChangeHandler(BasePythonChangeHandler):
     The target table has columns: uuid, destination, key, value.
     """
     BATCH_SIZE = int(MSSQL_INSERT_BATCH_SIZE)
+    BATCH_BYTES = int(float(MSSQL_INSERT_BATCH_MB) * 1024 * 1024)
+    SNAPSHOT_BATCH_SIZE = int(MSSQL_SNAPSHOT_BATCH_SIZE)
+    WRITER_QUEUE_DEPTH = int(MSSQL_WRITER_QUEUE_DEPTH)
+    WRITER_CONNECTIONS = int(MSSQL_WRITER_CONNECTIONS)
+    LOAD_MODES = ("executemany", "fast_executemany", "openjson")
+    SINK_MODES = ("raw", "replica", "both")
+    ENVELOPE_MODES = ("full", "compact")
+    OFFSET_STORAGES = ("file", "database")
+    BATCH_SIZINGS = ("fixed", "adaptive")
+    PAYLOAD_FORMATS = ("json", "zstd")
+    BIND_BUFFER_BYTES = int(MSSQL_BIND_BUFFER_MB) * 1024 * 1024
 
     def __init__(self):
         super().__init__()
+        if MSSQL_LOAD_MODE not in self.LOAD_MODES:
+            raise ValueError(f"Unsupported MSSQL_LOAD_MODE: {MSSQL_LOAD_MODE}")
+        self.load_mode = MSSQL_LOAD_MODE
+        if MSSQL_SINK_MODE not in self.SINK_MODES:
+            raise ValueError(f"Unsupported MSSQL_SINK_MODE: {MSSQL_SINK_MODE}")
+        self.sink_mode = MSSQL_SINK_MODE
+        self.replica_tables = parse_include_list(ORACLE_TABLE_INCLUDE_LIST)
+        # Replica table name -> columns known to exist
+        self._replica_columns = {}
+        self.event_ids = EventIdGenerator(EVENT_ID_STRATEGY, layout="mssql")
+        if ENVELOPE_MODE not in self.ENVELOPE_MODES:
+            raise ValueError(f"Unsupported ENVELOPE_MODE: {ENVELOPE_MODE}")
+        self.compactor = SchemaCompactor() if ENVELOPE_MODE == "compact" else None
+        # Schema fingerprints already committed to raw_schemas
+        self._stored_schemas = set()
+        self._parsed_schemas = {}
+        # Connection id -> insert cursor, so each pooled connection keeps its prepared statement
+        self._cursors = {}
+        if OFFSET_STORAGE not in self.OFFSET_STORAGES:
+            raise ValueError(f"Unsupported OFFSET_STORAGE: {OFFSET_STORAGE}")
+        self.stores_offsets = OFFSET_STORAGE == "database"
+        # Replica tables are kept up to date by upserts, so only raw mode stages snapshots
+        self.snapshot_bulk_load = SNAPSHOT_BULK_LOAD and self.sink_mode == "raw"
+        # True while raw_events_snapshot holds rows not yet moved into raw_events
+        self._snapshot_pending = False
+        if PAYLOAD_FORMAT not in self.PAYLOAD_FORMATS:
+            raise ValueError(f"Unsupported PAYLOAD_FORMAT: {PAYLOAD_FORMAT}")
+        if PAYLOAD_FORMAT == "zstd" and self.sink_mode != "raw":
+            raise ValueError("PAYLOAD_FORMAT=zstd needs MSSQL_SINK_MODE=raw")
+        if PAYLOAD_FORMAT == "zstd" and self.load_mode == "openjson":
+            # Binary values cannot travel inside the JSON parameter
+            raise ValueError("PAYLOAD_FORMAT=zstd does not support MSSQL_LOAD_MODE=openjson")
+        self.raw_columns = RAW_EVENT_ZSTD_COLUMNS if PAYLOAD_FORMAT == "zstd" else RAW_EVENT_COLUMNS
+        self.payload_compressor = None
+        # Dictionary ids already committed to raw_dictionaries
+        self._stored_dictionaries = set()
+        if MSSQL_BATCH_SIZING not in self.BATCH_SIZINGS:
+            raise ValueError(f"Unsupported MSSQL_BATCH_SIZING: {MSSQL_BATCH_SIZING}")
+        self.batch_sizer = None
+        if MSSQL_BATCH_SIZING == "adaptive":
+            self.batch_sizer = AdaptiveBatchSizer(
+                target_seconds=int(MSSQL_BATCH_TARGET_MS) / 1000.0,
+                min_rows=int(MSSQL_BATCH_MIN_SIZE),
+                max_rows=int(MSSQL_BATCH_MAX_SIZE),
+                max_bytes=self.BATCH_BYTES,
+                initial_rows=self.BATCH_SIZE,
+                on_change=self._batch_size_changed,
+            )
+        self.retry = TransientRetry(
+            is_transient_error, int(WRITE_RETRIES), float(WRITE_RETRY_MAX_SECONDS), on_retry=self._write_retried
+        )
+        self.bisector = BatchBisector(is_poison_error) if DEAD_LETTER_ENABLED else None
         # Initialize MSSQL connection
         self.conn_str = (
             f"DRIVER={{ODBC Driver 18 for SQL Server}};"
@@ -62,18 +258,125 @@ class RawChangeHandler(BasePythonChangeHandler):
         )
         
         try:
-            self.mssql_conn = pyodbc.connect(self.conn_str)
-            self.mssql_conn.autocommit = False  # Enable transactions
-            self.mssql_cursor = self.mssql_conn.cursor()
+            self.mssql_conn = self._connect()
+            self.mssql_cursor = self._writer_cursor(self.mssql_conn)
             
             # Ensure the raw_events table exists
             self._create_raw_events_table()
+            if self.snapshot_bulk_load:
+                # A snapshot staged before a restart is moved once streaming starts
+                self.mssql_cursor.execute("SELECT CASE WHEN OBJECT_ID('raw_events_snapshot', 'U') IS NULL THEN 0 ELSE 1 END")
+                self._snapshot_pending = bool(self.mssql_cursor.fetchone()[0])
+                self.mssql_conn.commit()
+            if PAYLOAD_FORMAT == "zstd":
+                self._load_payload_compressor()
         except pyodbc.Error as e:
             print(f"Error connecting to MSSQL: {str(e)}")
             raise
+
+        # Optionally write shards of each batch concurrently on a connection pool
+        self.writer_pool = None
+        self.sharded_writer = None
+        if self.WRITER_CONNECTIONS > 1:
+            self.writer_pool = ConnectionPool(self._connect, self.WRITER_CONNECTIONS)
+            self.sharded_writer = ShardedWriter(
+                self._write_isolated,
+                self.writer_pool,
+                destination=lambda row: row[1],
+                key=lambda row: row[2],
+                shard_by_key=WRITER_SHARD_BY_KEY,
+            )
+
+        # Optionally move inserts and commits off the engine thread
+        self.writer = None
+        if self.WRITER_QUEUE_DEPTH > 0:
+            self.writer = BackgroundWriter(
+                lambda item: self._write_batch(*item), self.WRITER_QUEUE_DEPTH, name="mssql-writer"
+            )
+
+        # Optionally append batches to a local spool that a drainer thread loads
+        self.spool = None
+        self.spool_drainer = None
+        if SPOOL_DIR:
+            if self.writer is not None:
+                raise ValueError("SPOOL_DIR and MSSQL_WRITER_QUEUE_DEPTH cannot be combined")
+            self.spool = Spool(
+                os.path.join(SPOOL_DIR, "mssql"),
+                int(float(SPOOL_SEGMENT_MB) * 1024 * 1024),
+                fsync=SPOOL_FSYNC,
+            )
+            metrics.SPOOL_PENDING_BYTES.set(self.spool.pending_bytes(), sink="mssql")
+            self.spool_drainer = SpoolDrainer(
+                self.spool, self._load_spooled_batch, name="mssql-spool", on_error=self._spool_load_failed
+            )
     
+    def _connect(self):
+        conn = pyodbc.connect(self.conn_str)
+        conn.autocommit = False  # Enable transactions
+        return conn
+
+    def _writer_cursor(self, conn):
+        """Return the cursor used for raw_events inserts on `conn`"""
+        cursor = self._cursors.get(id(conn))
+        if cursor is None:
+            cursor = self._cursors[id(conn)] = conn.cursor()
+            cursor.fast_executemany = self.load_mode == "fast_executemany"
+        return cursor
+
+    def _connection_alive(self, conn):
+        """Roll back `conn` and check that the server still answers on it"""
+        try:
+            conn.rollback()
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT 1").fetchall()
+            finally:
+                cursor.close()
+            conn.rollback()
+            return True
+        except pyodbc.Error as e:
+            print(f"MSSQL connection is broken: {str(e)}")
+            self._cursors.pop(id(conn), None)
+            return False
+
+    def _reconnect_if_broken(self):
+        """Replace the handler's connection if the server closed it or it stopped answering"""
+        if self._connection_alive(self.mssql_conn):
+            return
+        print("Reconnecting to MSSQL")
+        try:
+            self.mssql_conn.close()
+        except pyodbc.Error:
+            pass
+        try:
+            self.mssql_conn = self._connect()
+        except pyodbc.Error as e:
+            # Still unreachable; the next attempt tries again
+            print(f"Error reconnecting to MSSQL: {str(e)}")
+            return
+        self.mssql_cursor = self._writer_cursor(self.mssql_conn)
+
+    def _write_retried(self, error, attempt):
+        metrics.WRITE_RETRIES.inc(sink="mssql")
+        self._reconnect_if_broken()
+
+    def close(self):
+        """Flush pending batches and stop the spool drainer, background and shard writers, if any"""
+        if getattr(self, 'spool_drainer', None) is not None:
+            spool_drainer, self.spool_drainer = self.spool_drainer, None
+            # Give the drainer a moment to catch up; the rest is loaded on the next start
+            spool_drainer.drain(timeout=30)
+            spool_drainer.close()
+        if getattr(self, 'writer', None) is not None:
+            writer, self.writer = self.writer, None
+            writer.close()
+        if getattr(self, 'sharded_writer', None) is not None:
+            sharded_writer, self.sharded_writer = self.sharded_writer, None
+            sharded_writer.close()
+
     def __del__(self):
         # Clean up MSSQL connection when the handler is destroyed
+        self.close()
         if hasattr(self, 'mssql_cursor'):
             self.mssql_cursor.close()
         if hasattr(self, 'mssql_conn'):
@@ -93,34 +396,784 @@ class RawChangeHandler(BasePythonChangeHandler):
             )
         END
         """
+        # Replayed events carry the id of their first delivery; let the primary key
+        # drop them instead of failing the whole insert
+        ignore_dup_key_query = """
+        DECLARE @pk SYSNAME = (
+            SELECT name FROM sys.indexes
+            WHERE object_id = OBJECT_ID('raw_events') AND is_primary_key = 1 AND ignore_dup_key = 0
+        );
+        IF @pk IS NOT NULL
+            EXEC('ALTER INDEX ' + QUOTENAME(@pk) + ' ON raw_events SET (IGNORE_DUP_KEY = ON)');
+        """
+        # Compact mode stores each schema once and references it from raw_events;
+        # raw_events_full rebuilds the original envelopes
+        create_schemas_query = """
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'raw_schemas')
+        BEGIN
+            CREATE TABLE raw_schemas (
+                fingerprint CHAR(64) PRIMARY KEY,
+                [schema] NVARCHAR(MAX),
+                created_at DATETIME DEFAULT GETDATE()
+            )
+        END
+        IF COL_LENGTH('raw_events', 'value_schema_id') IS NULL
+            ALTER TABLE raw_events ADD key_schema_id CHAR(64) NULL, value_schema_id CHAR(64) NULL
+        IF COL_LENGTH('raw_events', 'value_zstd') IS NULL
+            ALTER TABLE raw_events ADD key_zstd VARBINARY(MAX) NULL, value_zstd VARBINARY(MAX) NULL
+        """
+        # zstd dictionaries of PAYLOAD_FORMAT=zstd; every version is kept so old rows stay readable
+        create_dictionaries_query = """
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'raw_dictionaries')
+        BEGIN
+            CREATE TABLE raw_dictionaries (
+                dictionary_id BIGINT PRIMARY KEY,
+                destination NVARCHAR(255),
+                dictionary VARBINARY(MAX),
+                created_at DATETIME DEFAULT GETDATE()
+            )
+        END
+        """
+        create_view_query = """
+        CREATE OR ALTER VIEW raw_events_full AS
+        SELECT e.uuid, e.destination,
+            CASE WHEN e.key_schema_id IS NULL THEN e.[key]
+                 ELSE CONCAT(N'{"schema":', ks.[schema], N',"payload":', COALESCE(e.[key], N'null'), N'}') END AS [key],
+            CASE WHEN e.value_schema_id IS NULL THEN e.[value]
+                 ELSE CONCAT(N'{"schema":', vs.[schema], N',"payload":', COALESCE(e.[value], N'null'), N'}') END AS [value],
+            e.processed_at, e.seq
+        FROM raw_events e
+        LEFT JOIN raw_schemas ks ON ks.fingerprint = e.key_schema_id
+        LEFT JOIN raw_schemas vs ON vs.fingerprint = e.value_schema_id
+        """
+        # Engine offsets, committed together with the rows they cover
+        create_offsets_query = """
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'dbz_offsets')
+        BEGIN
+            CREATE TABLE dbz_offsets (
+                engine_name NVARCHAR(255) NOT NULL,
+                source_partition NVARCHAR(450) NOT NULL,
+                source_offset NVARCHAR(MAX) NOT NULL,
+                updated_at DATETIME DEFAULT GETDATE(),
+                PRIMARY KEY (engine_name, source_partition)
+            )
+        END
+        """
+        # seq orders rows by insertion for incremental readers (dbz_reader). The
+        # sequence is a separate object, so it survives the snapshot swap. Rows
+        # from before the column existed are numbered in their physical order
+        create_sequence_query = """
+        IF OBJECT_ID('raw_events_seq', 'SO') IS NULL
+            CREATE SEQUENCE raw_events_seq AS BIGINT START WITH 1
+        """
+        create_seq_query = """
+        IF COL_LENGTH('raw_events', 'seq') IS NULL
+        BEGIN
+            ALTER TABLE raw_events ADD seq BIGINT NULL DEFAULT (NEXT VALUE FOR raw_events_seq)
+            EXEC('UPDATE raw_events SET seq = NEXT VALUE FOR raw_events_seq WHERE seq IS NULL')
+        END
+        """
+        create_seq_indexes_query = """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE object_id = OBJECT_ID('raw_events') AND name = 'raw_events_seq_idx')
+            CREATE INDEX raw_events_seq_idx ON raw_events (seq)
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE object_id = OBJECT_ID('raw_events') AND name = 'raw_events_destination_seq_idx')
+            CREATE INDEX raw_events_destination_seq_idx ON raw_events (destination, seq)
+        """
+        # Watermarks of incremental readers
+        create_consumers_query = """
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'raw_events_consumers')
+        BEGIN
+            CREATE TABLE raw_events_consumers (
+                consumer NVARCHAR(255) PRIMARY KEY,
+                seq BIGINT NOT NULL,
+                updated_at DATETIME DEFAULT GETDATE()
+            )
+        END
+        """
+        # Records that failed on their own; key and value are kept as the exact bytes received
+        create_dead_letter_query = """
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'raw_events_dead_letter')
+        BEGIN
+            CREATE TABLE raw_events_dead_letter (
+                uuid UNIQUEIDENTIFIER,
+                destination NVARCHAR(MAX),
+                [key] VARBINARY(MAX),
+                [value] VARBINARY(MAX),
+                key_schema_id CHAR(64),
+                value_schema_id CHAR(64),
+                error NVARCHAR(MAX),
+                failed_at DATETIME DEFAULT GETDATE()
+            )
+        END
+        """
         try:
             self.mssql_cursor.execute(create_table_query)
+            self.mssql_cursor.execute(create_schemas_query)
+            self.mssql_cursor.execute(create_dictionaries_query)
+            # Separate batches: objects have to exist before the batches using them are compiled
+            self.mssql_cursor.execute(create_sequence_query)
+            self.mssql_cursor.execute(create_seq_query)
+            self.mssql_cursor.execute(create_seq_indexes_query)
+            self.mssql_cursor.execute(create_consumers_query)
+            self.mssql_cursor.execute(create_dead_letter_query)
+            # CREATE VIEW must be the only statement in its batch
+            self.mssql_cursor.execute(create_view_query)
+            if self.event_ids.deduplicates:
+                self.mssql_cursor.execute(ignore_dup_key_query)
+            if self.stores_offsets:
+                self.mssql_cursor.execute(create_offsets_query)
             self.mssql_conn.commit()
         except pyodbc.Error as e:
             print(f"Error creating table: {str(e)}")
             self.mssql_conn.rollback()
             raise
 
-    def _insert_batch(self, batch_data):
-        """Helper method to insert a batch of records"""
+    def load_offsets(self):
+        """Return the committed offsets as {source partition JSON: source offset JSON}"""
+        self.mssql_cursor.execute(
+            "SELECT source_partition, source_offset FROM dbz_offsets WHERE engine_name = ?", ENGINE_NAME
+        )
+        offsets = {row[0]: row[1] for row in self.mssql_cursor.fetchall()}
+        self.mssql_conn.commit()
+        return offsets
+
+    def clear_offsets(self):
+        """Forget the committed offsets, e.g. when the offset and history files are reset"""
+        self.mssql_cursor.execute("DELETE FROM dbz_offsets WHERE engine_name = ?", ENGINE_NAME)
+        self.mssql_conn.commit()
+
+    def _store_offset(self, cursor, offset):
+        """Upsert the offset of the last record of a batch, in the batch's transaction"""
+        if offset is None:
+            return
+        source_partition, source_offset = offset
+        cursor.execute("""
+        UPDATE dbz_offsets SET source_offset = ?, updated_at = GETDATE()
+        WHERE engine_name = ? AND source_partition = ?;
+        IF @@ROWCOUNT = 0
+            INSERT INTO dbz_offsets (engine_name, source_partition, source_offset) VALUES (?, ?, ?);
+        """, source_offset, ENGINE_NAME, source_partition, ENGINE_NAME, source_partition, source_offset)
+
+    def _nvarchar_size_hint(self, batch_data, column):
+        """
+        Return the bound size (in characters) for an NVARCHAR(MAX) column of the batch.
+
+        fast_executemany allocates rows * size for every column, so the size is
+        rounded up to a power of two to keep the prepared statement stable across
+        batches. 0 means NVARCHAR(MAX), which pyodbc streams row by row, and is
+        only used when the array would not fit in MSSQL_BIND_BUFFER_MB.
+        """
+        longest = max((len(row[column]) for row in batch_data if row[column] is not None), default=1)
+        # Leave room for characters outside the BMP, which take two UTF-16 code units
+        size = 1 << (2 * longest - 1).bit_length()
+        if size * 2 * len(batch_data) > self.BIND_BUFFER_BYTES:
+            return 0
+        return size
+
+    def _varbinary_size_hint(self, batch_data, column):
+        """Like `_nvarchar_size_hint`, in bytes, for the VARBINARY(MAX) columns of compressed payloads"""
+        longest = max((len(row[column]) for row in batch_data if row[column] is not None), default=1)
+        size = 1 << (longest - 1).bit_length()
+        if size * len(batch_data) > self.BIND_BUFFER_BYTES:
+            return 0
+        return size
+
+    def _fast_executemany_batch(self, cursor, insert_query, batch_data):
+        """Insert a batch with parameter-array binding"""
+        if self.payload_compressor is not None:
+            payload_sizes = [
+                (pyodbc.SQL_VARBINARY, self._varbinary_size_hint(batch_data, 2), 0),
+                (pyodbc.SQL_VARBINARY, self._varbinary_size_hint(batch_data, 3), 0),
+            ]
+        else:
+            payload_sizes = [
+                (pyodbc.SQL_WVARCHAR, self._nvarchar_size_hint(batch_data, 2), 0),
+                (pyodbc.SQL_WVARCHAR, self._nvarchar_size_hint(batch_data, 3), 0),
+            ]
+        cursor.setinputsizes([
+            (pyodbc.SQL_WVARCHAR, 36, 0),
+            (pyodbc.SQL_WVARCHAR, 255, 0),
+            *payload_sizes,
+            (pyodbc.SQL_VARCHAR, 64, 0),
+            (pyodbc.SQL_VARCHAR, 64, 0),
+        ])
+        try:
+            cursor.executemany(insert_query, batch_data)
+        finally:
+            # The sizes stay on the cursor until reset, and would truncate the
+            # offset, schema and dictionary statements after it, in this batch
+            # or, when the insert failed, in the retried one
+            cursor.setinputsizes(None)
+
+    def _openjson_batch(self, cursor, batch_data):
+        """Insert a batch in one round trip by shredding a single JSON parameter server side"""
+        openjson_query = """
+        INSERT INTO raw_events (uuid, destination, [key], [value], key_schema_id, value_schema_id)
+        SELECT j.uuid, j.destination, j.[key], j.[value], j.key_schema_id, j.value_schema_id
+        FROM OPENJSON(?) WITH (
+            uuid UNIQUEIDENTIFIER '$[0]',
+            destination NVARCHAR(255) '$[1]',
+            [key] NVARCHAR(MAX) '$[2]',
+            [value] NVARCHAR(MAX) '$[3]',
+            key_schema_id CHAR(64) '$[4]',
+            value_schema_id CHAR(64) '$[5]'
+        ) AS j
+        """
+        cursor.setinputsizes([(pyodbc.SQL_WLONGVARCHAR, 0, 0)])
+        try:
+            cursor.execute(openjson_query, json.dumps(batch_data, ensure_ascii=False))
+        finally:
+            cursor.setinputsizes(None)
+
+    def _ensure_replica_table(self, cursor, table_name, changes):
+        """Create the replica table, or add columns that appeared since it was created"""
+        field_types = {}
+        for change in changes:
+            field_types.update(change.field_types)
+        known = self._replica_columns.get(table_name)
+        if known is not None and known.issuperset(field_types):
+            return
+
+        key_columns = list(changes[0].key)
+
+        def column_type(column):
+            connect_type = field_types[column][0]
+            if column in key_columns and connect_type == "string":
+                return REPLICA_KEY_STRING_TYPE
+            return REPLICA_COLUMN_TYPES.get(connect_type, "NVARCHAR(MAX)")
+
+        quoted_table = quote_identifier(table_name)
+        if known is None:
+            create_query = (
+                f"IF OBJECT_ID(?, 'U') IS NULL CREATE TABLE {quoted_table} ("
+                + ", ".join(f"{quote_identifier(column)} {column_type(column)}" for column in field_types)
+                + ", PRIMARY KEY (" + ", ".join(map(quote_identifier, key_columns)) + "))"
+            )
+            cursor.execute(create_query, table_name)
+            known = set()
+        for column in field_types.keys() - known:
+            cursor.execute(
+                f"IF COL_LENGTH(?, ?) IS NULL ALTER TABLE {quoted_table} "
+                f"ADD {quote_identifier(column)} {column_type(column)}",
+                table_name, column,
+            )
+        self._replica_columns[table_name] = known | field_types.keys()
+
+    def _apply_batch(self, cursor, batch_data, ensure_tables=True):
+        """
+        Apply a batch to the replica tables with set-based statements.
+
+        Changes are collapsed to the final state per primary key first, then each
+        table's changes are bulk loaded into a #temp staging table and applied with
+        a single MERGE. The caller commits.
+
+        Without `ensure_tables` the tables must exist already, as on the shard
+        threads, which leave creating them and `_replica_columns` to
+        `_prepare_shared_objects`.
+        """
+        changes = (
+            parse_change(key, value, self.replica_tables, self._value_schema(value_schema_id))
+            for _, _, key, value, _, value_schema_id in batch_data
+        )
+        for table, (truncated, table_changes) in coalesce_changes(changes).items():
+            table_name = REPLICA_TABLE_PREFIX + flat_table_name(table)
+            quoted_table = quote_identifier(table_name)
+            if table_changes and ensure_tables:
+                self._ensure_replica_table(cursor, table_name, table_changes)
+            if truncated:
+                cursor.execute(
+                    f"IF OBJECT_ID(?, 'U') IS NOT NULL TRUNCATE TABLE {quoted_table}", table_name
+                )
+            if not table_changes:
+                continue
+
+            key_columns = list(table_changes[0].key)
+            columns = list(dict.fromkeys(
+                key_columns + [column for change in table_changes if change.row for column in change.row]
+            ))
+            non_key_columns = [column for column in columns if column not in key_columns]
+            column_list = ", ".join(map(quote_identifier, columns))
+
+            # Staging table with the target's column types plus a delete marker
+            cursor.execute(
+                f"SELECT TOP 0 CAST(0 AS BIT) AS __dbz_deleted, {column_list} INTO #dbz_stage FROM {quoted_table}"
+            )
+            rows = []
+            for change in table_changes:
+                image = change.row if change.row is not None else change.key
+                rows.append((change.row is None,) + tuple(
+                    json.dumps(value) if isinstance(value, (dict, list)) else value
+                    for value in (image.get(column) for column in columns)
+                ))
+            stage_cursor = cursor.connection.cursor()
+            stage_cursor.fast_executemany = True
+            stage_cursor.executemany(
+                f"INSERT INTO #dbz_stage (__dbz_deleted, {column_list}) VALUES (?, {', '.join('?' * len(columns))})",
+                rows,
+            )
+            stage_cursor.close()
+
+            merge_query = (
+                f"MERGE {quoted_table} AS t USING #dbz_stage AS s ON "
+                + " AND ".join(f"t.{quote_identifier(c)} = s.{quote_identifier(c)}" for c in key_columns)
+                + " WHEN MATCHED AND s.__dbz_deleted = 1 THEN DELETE"
+            )
+            if non_key_columns:
+                merge_query += " WHEN MATCHED THEN UPDATE SET " + ", ".join(
+                    f"t.{quote_identifier(c)} = s.{quote_identifier(c)}" for c in non_key_columns
+                )
+            merge_query += (
+                f" WHEN NOT MATCHED AND s.__dbz_deleted = 0 THEN INSERT ({column_list}) VALUES ("
+                + ", ".join(f"s.{quote_identifier(c)}" for c in columns) + ");"
+            )
+            cursor.execute(merge_query)
+            cursor.execute("DROP TABLE #dbz_stage")
+
+    def _value_schema(self, fingerprint):
+        """Look up a schema stripped in compact mode"""
+        if fingerprint is None or self.compactor is None:
+            return None
+        schema = self._parsed_schemas.get(fingerprint)
+        if schema is None:
+            schema = self._parsed_schemas[fingerprint] = json.loads(self.compactor.schemas[fingerprint])
+        return schema
+
+    def _load_payload_compressor(self):
+        """Create the payload compressor, continuing with the stored dictionaries"""
+        self.mssql_cursor.execute(
+            "SELECT dictionary_id, destination, dictionary FROM raw_dictionaries ORDER BY created_at, dictionary_id"
+        )
+        dictionaries = [(row[0], row[1], bytes(row[2])) for row in self.mssql_cursor.fetchall()]
+        self.mssql_conn.commit()
+        self.payload_compressor = PayloadCompressor(
+            level=int(PAYLOAD_ZSTD_LEVEL),
+            dict_bytes=int(PAYLOAD_DICT_KB) * 1024,
+            samples=int(PAYLOAD_DICT_SAMPLES),
+            retrain_records=int(PAYLOAD_DICT_RETRAIN_RECORDS),
+            dictionaries=dictionaries,
+        )
+        self._stored_dictionaries = {dictionary_id for dictionary_id, _, _ in dictionaries}
+
+    def _store_dictionaries(self, cursor):
+        """Insert trained dictionaries that are not in raw_dictionaries yet"""
+        if self.payload_compressor is None:
+            return set()
+        # copy() is atomic, the capture thread may train a dictionary meanwhile
+        dictionary_ids = set(self.payload_compressor.dictionaries.copy()) - self._stored_dictionaries
+        for dictionary_id in dictionary_ids:
+            destination, dictionary = self.payload_compressor.dictionaries[dictionary_id]
+            cursor.execute(
+                "IF NOT EXISTS (SELECT 1 FROM raw_dictionaries WHERE dictionary_id = ?) "
+                "INSERT INTO raw_dictionaries (dictionary_id, destination, dictionary) VALUES (?, ?, ?)",
+                dictionary_id, dictionary_id, destination, dictionary,
+            )
+        return dictionary_ids
+
+    def _store_schemas(self, cursor, batch_data):
+        """Insert schemas referenced by the batch that are not in raw_schemas yet"""
+        fingerprints = {fp for row in batch_data for fp in row[4:6] if fp is not None} - self._stored_schemas
+        for fp in fingerprints:
+            cursor.execute(
+                "IF NOT EXISTS (SELECT 1 FROM raw_schemas WHERE fingerprint = ?) "
+                "INSERT INTO raw_schemas (fingerprint, [schema]) VALUES (?, ?)",
+                fp, fp, self.compactor.schemas[fp],
+            )
+        return fingerprints
+
+    def _lock_seq(self, cursor):
+        """Hold SEQ_LOCK shared until commit, so readers do not pass the seq drawn by this transaction (see dbz_reader)"""
+        cursor.execute("EXEC sp_getapplock @Resource = ?, @LockMode = 'Shared', @LockOwner = 'Transaction'", SEQ_LOCK)
+
+    def _insert_batch(self, batch_data, conn=None, offset=None):
+        """
+        Helper method to insert a batch of records on `conn` (the handler's connection by default).
+
+        `offset` is the (partition, offset) of the batch's last record, stored in
+        the same transaction when OFFSET_STORAGE=database.
+        """
         if not batch_data:
             return
+        if conn is None:
+            conn = self.mssql_conn
+        # Pooled connections belong to shard threads
+        own = conn is self.mssql_conn
+        cursor = self.mssql_cursor if own else self._writer_cursor(conn)
         
         # Using parameterized query with pyodbc's parameter style
-        insert_query = """
-        INSERT INTO raw_events (uuid, destination, [key], [value])
-        VALUES (?, ?, ?, ?)
+        insert_query = f"""
+        INSERT INTO raw_events ({", ".join(self.raw_columns)})
+        VALUES (?, ?, ?, ?, ?, ?)
         """
         
         try:
-            self.mssql_cursor.executemany(insert_query, batch_data)
-            self.mssql_conn.commit()
+            with metrics.INSERT_SECONDS.time(sink="mssql"):
+                new_schemas = new_dictionaries = set()
+                if self.sink_mode != "replica":
+                    new_schemas = self._store_schemas(cursor, batch_data)
+                    new_dictionaries = self._store_dictionaries(cursor)
+                    self._lock_seq(cursor)
+                    if self.load_mode == "fast_executemany":
+                        self._fast_executemany_batch(cursor, insert_query, batch_data)
+                    elif self.load_mode == "openjson":
+                        self._openjson_batch(cursor, batch_data)
+                    else:
+                        cursor.executemany(insert_query, batch_data)
+                if self.sink_mode != "raw":
+                    self._apply_batch(cursor, batch_data, ensure_tables=own)
+                self._store_offset(cursor, offset)
+            with metrics.COMMIT_SECONDS.time(sink="mssql"):
+                conn.commit()
+            self._stored_schemas |= new_schemas
+            self._stored_dictionaries |= new_dictionaries
+            metrics.ROWS_WRITTEN.inc(len(batch_data), sink="mssql")
             print(f"Successfully stored {len(batch_data)} records")
-        except pyodbc.Error as e:
+        except (pyodbc.Error, ValueError) as e:
             print(f"Error processing batch: {str(e)}")
+            metrics.BATCH_ERRORS.inc(sink="mssql")
+            conn.rollback()
+            if own:
+                # DDL issued in this transaction was rolled back too
+                self._replica_columns.clear()
+            raise
+
+    def _store_dead_letters(self, failures, conn=None, offset=None):
+        """Insert (row, error) pairs into raw_events_dead_letter, with the offset in the same transaction"""
+        if conn is None:
+            conn = self.mssql_conn
+        rows = [row for row, _ in failures]
+        # A cursor of its own, with the input sizes of raw_events_dead_letter
+        cursor = conn.cursor()
+        try:
+            new_schemas = self._store_schemas(cursor, rows)
+            new_dictionaries = self._store_dictionaries(cursor)
+            cursor.setinputsizes([
+                (pyodbc.SQL_WVARCHAR, 36, 0),
+                (pyodbc.SQL_WVARCHAR, 0, 0),
+                (pyodbc.SQL_VARBINARY, 0, 0),
+                (pyodbc.SQL_VARBINARY, 0, 0),
+                (pyodbc.SQL_VARCHAR, 64, 0),
+                (pyodbc.SQL_VARCHAR, 64, 0),
+                (pyodbc.SQL_WVARCHAR, 0, 0),
+            ])
+            cursor.executemany(
+                "INSERT INTO raw_events_dead_letter "
+                "(uuid, destination, [key], [value], key_schema_id, value_schema_id, error) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (row[0], row[1], payload_bytes(row[2]), payload_bytes(row[3]), row[4], row[5], error)
+                    for row, error in failures
+                ],
+            )
+            cursor.setinputsizes(None)
+            self._store_offset(cursor, offset)
+            conn.commit()
+        except (pyodbc.Error, ValueError):
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        self._stored_schemas |= new_schemas
+        self._stored_dictionaries |= new_dictionaries
+        for row in rows:
+            metrics.DEAD_LETTERS.inc(sink="mssql", destination=row[1])
+
+    def _write_isolated(self, batch_data, conn=None, offset=None):
+        """
+        Insert a batch on `conn` (the handler's connection by default).
+
+        Records that fail on their own go to raw_events_dead_letter. Transient
+        errors are retried after reconnecting, one committed piece at a time,
+        so pieces that are already committed are not written again.
+        """
+        # A pooled connection that broke is replaced in its slot
+        pooled = [conn]
+
+        def reconnect(error, attempt):
+            if conn is None:
+                self._write_retried(error, attempt)
+                return
+            metrics.WRITE_RETRIES.inc(sink="mssql")
+            if not self._connection_alive(pooled[0]):
+                try:
+                    pooled[0] = self.writer_pool.reconnect(pooled[0])
+                except pyodbc.Error as e:
+                    # Still unreachable; the next attempt tries again
+                    print(f"Error reconnecting to MSSQL: {str(e)}")
+
+        def insert(rows, rows_offset):
+            self.retry(lambda: self._insert_batch(rows, pooled[0], rows_offset), on_retry=reconnect)
+
+        def dead_letter(failures, failures_offset):
+            self.retry(lambda: self._store_dead_letters(failures, pooled[0], failures_offset), on_retry=reconnect)
+
+        if self.bisector is None:
+            insert(batch_data, offset)
+        else:
+            self.bisector.write(batch_data, insert, dead_letter, offset)
+
+    def _prepare_shared_objects(self, batch_data):
+        """
+        Create the raw_schemas rows and replica tables a batch needs, before it is sharded.
+
+        Concurrent transactions creating the same table or schema row would
+        conflict, so this runs on the handler's own connection and commits
+        before the shards start.
+        """
+        try:
+            new_schemas = new_dictionaries = set()
+            if self.sink_mode != "replica":
+                new_schemas = self._store_schemas(self.mssql_cursor, batch_data)
+                new_dictionaries = self._store_dictionaries(self.mssql_cursor)
+            if self.sink_mode != "raw":
+                changes = (
+                    parse_change(key, value, self.replica_tables, self._value_schema(value_schema_id))
+                    for _, _, key, value, _, value_schema_id in batch_data
+                )
+                for table, (_, table_changes) in coalesce_changes(changes).items():
+                    if table_changes:
+                        table_name = REPLICA_TABLE_PREFIX + flat_table_name(table)
+                        self._ensure_replica_table(self.mssql_cursor, table_name, table_changes)
+            self.mssql_conn.commit()
+            self._stored_schemas |= new_schemas
+            self._stored_dictionaries |= new_dictionaries
+        except Exception:
+            self.mssql_conn.rollback()
+            self._replica_columns.clear()
+            raise
+
+    def _batch_size_changed(self, destination, rows):
+        metrics.BATCH_SIZE_LIMIT.set(rows, sink="mssql", destination=destination)
+        print(f"Batch size for {destination}: {rows} rows")
+
+    def _batch_limits(self, destination):
+        """Return (max rows, max bytes) of an insert batch; `destination` is None for mixed batches"""
+        if self.batch_sizer is None:
+            return self.BATCH_SIZE, self.BATCH_BYTES
+        return self.batch_sizer.limits(destination)
+
+    def _write_batch(self, batch_data, offset=None, source_ts=None):
+        """
+        Write a batch on the handler's connection, or split across the shard writers.
+
+        `source_ts` is the source.ts_ms of the batch's newest event, read in
+        handleJsonBatch before the value is compressed.
+        """
+        started = time.perf_counter()
+        if self.sharded_writer is None:
+            self._write_isolated(batch_data, offset=offset)
+        else:
+            self._write_sharded_batch(batch_data, offset)
+        metrics.observe_source_lag("mssql", source_ts)
+        if self.batch_sizer is not None:
+            # Adaptive batches hold a single destination
+            self.batch_sizer.observe(
+                batch_data[0][1],
+                len(batch_data),
+                sum(len(row[2] or "") + len(row[3] or "") for row in batch_data),
+                time.perf_counter() - started,
+            )
+
+    def _write_sharded_batch(self, batch_data, offset=None):
+        """Write the shards of a batch concurrently, then commit its offset"""
+        self.retry(lambda: self._prepare_shared_objects(batch_data))
+        self.sharded_writer.write(batch_data)
+        if offset is not None:
+            # Shards commit separately, so the offset follows once all of them have
+            self.retry(lambda: self._commit_offset(offset))
+
+    def _commit_offset(self, offset):
+        """Store an offset on the handler's connection in a transaction of its own"""
+        try:
+            self._store_offset(self.mssql_cursor, offset)
+            self.mssql_conn.commit()
+        except pyodbc.Error:
             self.mssql_conn.rollback()
             raise
 
+    def _spool_batch(self, batch_data, offset, source_ts=None):
+        """Append a batch, with the schemas it needs that are not in raw_schemas yet, to the spool"""
+        schemas = {}
+        if self.compactor is not None:
+            schemas = {
+                fp: self.compactor.schemas[fp]
+                for row in batch_data for fp in row[4:6]
+                if fp is not None and fp not in self._stored_schemas
+            }
+        dictionaries = {}
+        if self.payload_compressor is not None:
+            dictionaries = {
+                str(dictionary_id): entry
+                for dictionary_id, entry in self.payload_compressor.dictionaries.copy().items()
+                if dictionary_id not in self._stored_dictionaries
+            }
+        payload = encode_json({
+            "rows": batch_data, "offset": offset, "source_ts": source_ts,
+            "schemas": schemas, "dictionaries": dictionaries,
+        })
+        self.spool.append(payload)
+        metrics.SPOOL_PENDING_BYTES.set(self.spool.pending_bytes(), sink="mssql")
+
+    def _load_spooled_batch(self, payload):
+        """Write one spooled batch; runs on the drainer thread"""
+        batch = decode_json(payload)
+        if batch["schemas"] and self.compactor is not None:
+            for fp, schema in batch["schemas"].items():
+                self.compactor.schemas.setdefault(fp, schema)
+        if batch.get("dictionaries") and self.payload_compressor is not None:
+            # Dictionaries trained before a restart; stored with the batch that needs them
+            for dictionary_id, (destination, dictionary) in batch["dictionaries"].items():
+                self.payload_compressor.dictionaries.setdefault(int(dictionary_id), (destination, dictionary))
+        offset = batch["offset"]
+        self._write_batch(
+            [tuple(row) for row in batch["rows"]], tuple(offset) if offset else None, batch.get("source_ts")
+        )
+        metrics.SPOOL_PENDING_BYTES.set(self.spool.pending_bytes(), sink="mssql")
+
+    def _spool_load_failed(self, error, attempt):
+        print(f"Error loading spooled batch (attempt {attempt}), retrying: {str(error)}")
+        metrics.SPOOL_LOAD_FAILURES.inc(sink="mssql")
+        self._reconnect_if_broken()
+
+    def _stage_snapshot_batch(self, batch_data, offset=None, restart=False):
+        """
+        Insert read events of an initial snapshot into raw_events_snapshot.
+
+        The staging table is a heap without primary key or indexes, loaded with
+        parameter arrays under a table lock, so no index pages are maintained
+        row by row. `restart` empties it first: an interrupted snapshot is
+        started over by the engine. Runs on the engine thread once everything
+        queued before the snapshot has been written. Records that fail on
+        their own go to raw_events_dead_letter.
+        """
+        if not self._snapshot_pending:
+            self._drain_pipeline()
+        if restart or not self._snapshot_pending:
+            self.retry(lambda: self._prepare_snapshot_table(restart))
+            self._snapshot_pending = True
+
+        def insert(rows, rows_offset):
+            self.retry(lambda: self._insert_snapshot_rows(rows, rows_offset))
+
+        def dead_letter(failures, failures_offset):
+            self.retry(lambda: self._store_dead_letters(failures, offset=failures_offset))
+
+        if self.bisector is None:
+            insert(batch_data, offset)
+        else:
+            self.bisector.write(batch_data, insert, dead_letter, offset)
+
+    def _prepare_snapshot_table(self, restart):
+        """Create raw_events_snapshot, emptied when the snapshot started over"""
+        cursor = self.mssql_cursor
+        try:
+            # Same columns as raw_events, without its constraints and indexes
+            cursor.execute(
+                "IF OBJECT_ID('raw_events_snapshot', 'U') IS NULL "
+                "SELECT TOP 0 * INTO raw_events_snapshot FROM raw_events"
+            )
+            # SELECT INTO copies no defaults
+            cursor.execute("""
+            IF NOT EXISTS (SELECT 1 FROM sys.default_constraints WHERE parent_object_id = OBJECT_ID('raw_events_snapshot'))
+            BEGIN
+                ALTER TABLE raw_events_snapshot ADD DEFAULT GETDATE() FOR processed_at
+                ALTER TABLE raw_events_snapshot ADD DEFAULT (NEXT VALUE FOR raw_events_seq) FOR seq
+            END
+            """)
+            if restart:
+                cursor.execute("TRUNCATE TABLE raw_events_snapshot")
+            self.mssql_conn.commit()
+        except pyodbc.Error:
+            self.mssql_conn.rollback()
+            raise
+
+    def _insert_snapshot_rows(self, batch_data, offset=None):
+        """Insert rows into raw_events_snapshot and commit them with their offset"""
+        insert_query = f"""
+        INSERT INTO raw_events_snapshot WITH (TABLOCK) ({", ".join(self.raw_columns)})
+        VALUES (?, ?, ?, ?, ?, ?)
+        """
+        cursor = self.mssql_conn.cursor()
+        cursor.fast_executemany = True
+        try:
+            with metrics.INSERT_SECONDS.time(sink="mssql"):
+                new_schemas = self._store_schemas(cursor, batch_data)
+                new_dictionaries = self._store_dictionaries(cursor)
+                self._fast_executemany_batch(cursor, insert_query, batch_data)
+                self._store_offset(cursor, offset)
+            with metrics.COMMIT_SECONDS.time(sink="mssql"):
+                self.mssql_conn.commit()
+        except (pyodbc.Error, ValueError):
+            metrics.BATCH_ERRORS.inc(sink="mssql")
+            self.mssql_conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        self._stored_schemas |= new_schemas
+        self._stored_dictionaries |= new_dictionaries
+        metrics.ROWS_WRITTEN.inc(len(batch_data), sink="mssql")
+        print(f"Staged {len(batch_data)} snapshot records")
+
+    def _finish_snapshot(self):
+        """
+        Move the staged snapshot into raw_events once the snapshot is complete.
+
+        An empty raw_events is replaced by the staging table, which only now
+        gets its clustered primary key, built in one sorted pass instead of
+        row by row. Otherwise the staged rows are merged with one INSERT ... SELECT.
+        """
+        started = time.perf_counter()
+        self.retry(self._move_snapshot)
+        self._snapshot_pending = False
+        # Recreate the view and everything else built on raw_events
+        self.retry(self._create_raw_events_table)
+        print(f"Moved the snapshot into raw_events in {time.perf_counter() - started:.1f}s")
+
+    def _move_snapshot(self):
+        """Merge or swap raw_events_snapshot into raw_events in one transaction"""
+        cursor = self.mssql_cursor
+        columns = ", ".join(self.raw_columns)
+        try:
+            self._lock_seq(cursor)
+            cursor.execute("SELECT CASE WHEN EXISTS (SELECT 1 FROM raw_events WITH (TABLOCKX, HOLDLOCK)) THEN 1 ELSE 0 END")
+            if cursor.fetchone()[0]:
+                cursor.execute(f"""
+                INSERT INTO raw_events WITH (TABLOCK) ({columns})
+                SELECT {columns} FROM raw_events_snapshot s
+                WHERE NOT EXISTS (SELECT 1 FROM raw_events e WHERE e.uuid = s.uuid)
+                """)
+                cursor.execute("DROP TABLE raw_events_snapshot")
+            else:
+                if self.event_ids.deduplicates:
+                    # Source ids repeat if the engine replayed part of the snapshot
+                    cursor.execute("""
+                    WITH d AS (SELECT ROW_NUMBER() OVER (PARTITION BY uuid ORDER BY (SELECT NULL)) AS n FROM raw_events_snapshot)
+                    DELETE FROM d WHERE n > 1
+                    """)
+                cursor.execute("DROP VIEW IF EXISTS raw_events_full")
+                cursor.execute("DROP TABLE raw_events")
+                cursor.execute("EXEC sp_rename 'raw_events_snapshot', 'raw_events'")
+                cursor.execute("ALTER TABLE raw_events ADD PRIMARY KEY (uuid)")
+            self.mssql_conn.commit()
+        except pyodbc.Error:
+            self.mssql_conn.rollback()
+            raise
+
+    def _drain_pipeline(self):
+        """Wait until the background writer and spool drainer have written everything handed to them"""
+        if self.writer is not None:
+            self.writer.flush()
+        if self.spool_drainer is not None:
+            self.spool_drainer.drain()
+
+    def _submit_batch(self, batch_data, offset=None, source_ts=None):
+        """Insert a batch now, or hand it to the spool or background writer"""
+        if self.spool is not None:
+            self._spool_batch(batch_data, offset, source_ts)
+        elif self.writer is not None:
+            self.writer.submit((batch_data, offset, source_ts))
+        else:
+            self._write_batch(batch_data, offset, source_ts)
+
     def handleJsonBatch(self, records: List[ChangeEvent]):
         """
         Handles a batch of Debezium change events by storing them raw in MSSQL.
@@ -128,48 +1181,141 @@ class RawChangeHandler(BasePythonChangeHandler):
         """
         print(f"Processing {len(records)} records")
         
+        metrics.BATCH_RECORDS.observe(len(records), sink="mssql")
+        started = time.perf_counter()
+        submit_seconds = 0.0
+        batch_bytes = 0
+        destination_counts = {}
+
         try:
-            batch_data = []
-            for record in records:
-                # Generate a unique UUID for each record
-                record_uuid = str(uuid.uuid4())  # MSSQL expects string representation
-                
-                # Get the raw data from the ChangeEvent
-                destination = record.destination()
-                # key = json.dumps(record.key()) if record.key() else None
-                # value = json.dumps(record.value()) if record.value() else None
+            if self.payload_compressor is not None:
+                # Between engine batches, so every record of a batch uses the same dictionary
+                self.payload_compressor.train()
+
+            # Insert batches being filled: one per destination with adaptive
+            # sizing, otherwise a single mixed one under the key None
+            pending = {}
+            # Snapshot read events waiting for the staging table: rows, bytes, restart
+            snapshot = [[], 0, False]
+            # Destinations, keys and values read from the engine once, empty ones as None
+            batch = read_batch(records)
+            for index, (destination, key, value) in enumerate(zip(batch.destinations, batch.keys, batch.values)):
+                batch_bytes += len(key or "") + len(value or "")
+                destination_counts[destination] = destination_counts.get(destination, 0) + 1
 
-                key = record.key() if record.key() else None
-                value = record.value() if record.value() else None
+                phase = snapshot_phase(value) if self.snapshot_bulk_load else None
+                if phase is None and self._snapshot_pending:
+                    # The first streaming event: the snapshot is complete
+                    submit_started = time.perf_counter()
+                    if snapshot[0]:
+                        self._stage_snapshot_batch(snapshot[0], None, snapshot[2])
+                        snapshot = [[], 0, False]
+                    self._finish_snapshot()
+                    submit_seconds += time.perf_counter() - submit_started
+
+                # Generate the primary key according to EVENT_ID_STRATEGY
+                # (MSSQL expects string representation)
+                record_uuid = self.event_ids.new_id(destination, key, value)
+
+                # source.ts_ms can no longer be read once the value is compressed
+                source_value = value
+
+                # Strip the embedded schemas in compact mode
+                key_schema_id = value_schema_id = None
+                if self.compactor is not None:
+                    key, key_schema_id = self.compactor.compact(key)
+                    value, value_schema_id = self.compactor.compact(value)
+                if self.payload_compressor is not None:
+                    key = self.payload_compressor.compress(destination, key)
+                    value = self.payload_compressor.compress(destination, value)
                 
-                batch_data.append((
+                row = (
                     record_uuid,
                     destination,
                     key,
-                    value
-                ))
-                
-                # If batch size reached, insert
-                if len(batch_data) >= self.BATCH_SIZE:
-                    self._insert_batch(batch_data)
-                    batch_data = []  # Reset batch
+                    value,
+                    key_schema_id,
+                    value_schema_id
+                )
+                if phase is not None:
+                    snapshot[0].append(row)
+                    snapshot[1] += len(key or "") + len(value or "")
+                    snapshot[2] = snapshot[2] or phase == "first"
+                    if len(snapshot[0]) >= self.SNAPSHOT_BATCH_SIZE or snapshot[1] >= self.BATCH_BYTES \
+                            or phase == "last":
+                        submit_started = time.perf_counter()
+                        self._stage_snapshot_batch(
+                            snapshot[0], batch.offset(index) if self.stores_offsets else None, snapshot[2]
+                        )
+                        snapshot = [[], 0, False]
+                        if phase == "last":
+                            self._finish_snapshot()
+                        submit_seconds += time.perf_counter() - submit_started
+                    continue
+                chunk_key = destination if self.batch_sizer is not None else None
+                # Rows, bytes and the uncompressed value of the newest row
+                chunk = pending.setdefault(chunk_key, [[], 0, None])
+                chunk[0].append(row)
+                chunk[1] += len(key or "") + len(value or "")
+                chunk[2] = source_value
+
+                # If the batch's row or byte limit is reached, insert
+                max_rows, max_bytes = self._batch_limits(chunk_key)
+                if len(chunk[0]) >= max_rows or chunk[1] >= max_bytes:
+                    del pending[chunk_key]
+                    # Other destinations may still hold earlier records, so the
+                    # offset may only advance once nothing else is pending
+                    offset = batch.offset(index) if self.stores_offsets and not pending else None
+                    submit_started = time.perf_counter()
+                    self._submit_batch(chunk[0], offset, source_ts_ms(chunk[2]))
+                    submit_seconds += time.perf_counter() - submit_started
             
-            # Insert remaining records
-            if batch_data:
-                self._insert_batch(batch_data)
+            if snapshot[0]:
+                submit_started = time.perf_counter()
+                self._stage_snapshot_batch(
+                    snapshot[0], batch.offset(-1) if self.stores_offsets else None, snapshot[2]
+                )
+                submit_seconds += time.perf_counter() - submit_started
+
+            # Insert remaining records; the last batch carries the engine batch's offset
+            remaining = list(pending.values())
+            for index, (batch_data, _, source_value) in enumerate(remaining):
+                last = index == len(remaining) - 1
+                submit_started = time.perf_counter()
+                self._submit_batch(
+                    batch_data, batch.offset(-1) if self.stores_offsets and last else None, source_ts_ms(source_value)
+                )
+                submit_seconds += time.perf_counter() - submit_started
+
+            if self.writer is not None:
+                # The engine acknowledges the records once this returns, so they must be committed by then
+                submit_started = time.perf_counter()
+                self.writer.flush()
+                submit_seconds += time.perf_counter() - submit_started
+
+            metrics.CONVERT_SECONDS.observe(time.perf_counter() - started - submit_seconds, sink="mssql")
+            metrics.BATCH_BYTES.observe(batch_bytes, sink="mssql")
+            for destination, count in destination_counts.items():
+                metrics.RECORDS.inc(count, sink="mssql", destination=destination)
             
         except Exception as e:
             print(f"Error processing records: {str(e)}")
-            # Rollback on error
-            if hasattr(self, 'mssql_conn'):
+            if self.writer is not None:
+                # Wait for the batches already queued, so none is written after the engine sees the failure
+                try:
+                    self.writer.flush()
+                except Exception:
+                    pass
+            # Rollback on error, unless the connection belongs to the writer or drainer thread
+            if hasattr(self, 'mssql_conn') and self.writer is None and self.spool is None:
                 self.mssql_conn.rollback()
             raise
 
 
 if __name__ == '__main__':
     props = Properties()
-    props.setProperty("name", "engine")
-    props.setProperty("snapshot.mode", "schema_only")
+    props.setProperty("name", ENGINE_NAME)
+    props.setProperty("snapshot.mode", SNAPSHOT_MODE)
     props.setProperty("topic.prefix", "dwh")
     props.setProperty("tombstones.on.delete", "false")
     props.setProperty("log.mining.strategy", "online_catalog")
@@ -180,7 +1326,7 @@ if __name__ == '__main__':
     props.setProperty("connector.class", "io.debezium.connector.oracle.OracleConnector")
     props.setProperty("offset.storage", "org.apache.kafka.connect.storage.FileOffsetBackingStore")
     props.setProperty("offset.storage.file.filename", OFFSET_FILE)
-    props.setProperty("offset.flush.interval.ms", "1000")
+    props.setProperty("offset.flush.interval.ms", str(OFFSET_FLUSH_INTERVAL_MS))
     props.setProperty("schema.history.internal", "io.debezium.storage.file.history.FileSchemaHistory")
     props.setProperty("schema.history.internal.file.filename", HISTORY_FILE)
     props.setProperty("tasks.max", "1")
@@ -204,6 +1350,20 @@ if __name__ == '__main__':
     # props.setProperty("transforms.unwrap.delete.handling.mode", "rewrite")
 
     # Create a DebeziumJsonEngine instance, passing the configuration properties and the custom change event handler.
-    engine = DebeziumJsonEngine(properties=props, handler=RawChangeHandler())
+    if int(METRICS_PORT):
+        metrics.start_http_server(int(METRICS_PORT))
+
+    handler = RawChangeHandler()
+    if handler.stores_offsets and handler.spool is None:
+        # The sink is the source of truth: resume right after its last committed batch.
+        # With a spool the offset file is, since the spool already holds what follows.
+        if CLEAR_OFFSET_AND_HISTORY_FILE:
+            handler.clear_offsets()
+        seed_offset_file(OFFSET_FILE, handler.load_offsets())
+    engine = DebeziumJsonEngine(properties=props, handler=handler)
     # Start the Debezium engine to begin consuming and processing change events.
-    engine.run()
+    try:
+        engine.run()
+    finally:
+        # Drain batches still queued for the background writer
+        handler.close()
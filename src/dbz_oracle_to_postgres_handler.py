@@ -1,7 +1,13 @@
 import os
+import time
+import io
+import struct
+from contextlib import contextmanager
 from pathlib import Path
 import psycopg2
 from psycopg2 import sql
+from psycopg2 import errors as pg_errors
+from psycopg2.extras import execute_values
 import uuid
 import json
 
@@ -9,6 +15,19 @@ from typing import List
 from pydbzengine import ChangeEvent, BasePythonChangeHandler
 from pydbzengine import Properties, DebeziumJsonEngine
 
+from dbz_pipeline import BackgroundWriter
+from dbz_envelope import parse_change, coalesce_changes, parse_include_list, flat_table_name, SchemaCompactor, source_ts_ms, snapshot_phase
+from dbz_event_id import EventIdGenerator
+from dbz_sharding import ConnectionPool, ShardedWriter
+from dbz_batching import AdaptiveBatchSizer
+from dbz_spool import Spool, SpoolDrainer, encode_json, decode_json
+from dbz_compression import PayloadCompressor
+from dbz_offsets import ENGINE_NAME, seed_offset_file
+from dbz_records import read_batch
+from dbz_reader import SEQ_LOCK
+from dbz_isolation import TransientRetry, BatchBisector, payload_bytes
+import dbz_metrics as metrics
+
 OFFSET_FILE = os.getenv("OFFSET_FILE", "/app/storage/offsets.dat")
 HISTORY_FILE = os.getenv("HISTORY_FILE", "/app/storage/history.dat")
 CLEAR_OFFSET_AND_HISTORY_FILE = os.getenv("CLEAR_OFFSET_AND_HISTORY_FILE", "False").lower() == "true"
@@ -40,6 +59,120 @@ POSTGRESQL_USER = os.getenv("POSTGRESQL_USER", "postgres")
 POSTGRESQL_PASSWORD = os.getenv("POSTGRESQL_PASSWORD", "postgres123AA")
 POSTGRESQL_DB = os.getenv("POSTGRESQL_DB", "postgres")
 POSTGRESQL_INSERT_BATCH_SIZE = os.getenv("POSTGRESQL_INSERT_BATCH_SIZE", 1000)
+# Upper bound on the key/value characters of one insert batch, whatever its row count
+POSTGRESQL_INSERT_BATCH_MB = os.getenv("POSTGRESQL_INSERT_BATCH_MB", 64)
+# fixed: batches of POSTGRESQL_INSERT_BATCH_SIZE rows
+# adaptive: one row limit per destination, tuned toward POSTGRESQL_BATCH_TARGET_MS
+POSTGRESQL_BATCH_SIZING = os.getenv("POSTGRESQL_BATCH_SIZING", "fixed").lower()
+print("POSTGRESQL_BATCH_SIZING: " + POSTGRESQL_BATCH_SIZING)
+POSTGRESQL_BATCH_TARGET_MS = os.getenv("POSTGRESQL_BATCH_TARGET_MS", 500)
+POSTGRESQL_BATCH_MIN_SIZE = os.getenv("POSTGRESQL_BATCH_MIN_SIZE", 100)
+POSTGRESQL_BATCH_MAX_SIZE = os.getenv("POSTGRESQL_BATCH_MAX_SIZE", 50000)
+# Number of batches that may wait for the background writer thread. 0 writes
+# synchronously on the engine thread.
+POSTGRESQL_WRITER_QUEUE_DEPTH = os.getenv("POSTGRESQL_WRITER_QUEUE_DEPTH", 0)
+# Number of connections each batch is sharded across. 1 writes on a single connection.
+POSTGRESQL_WRITER_CONNECTIONS = os.getenv("POSTGRESQL_WRITER_CONNECTIONS", 1)
+# Shard by destination and record key instead of destination only
+WRITER_SHARD_BY_KEY = os.getenv("WRITER_SHARD_BY_KEY", "False").lower() == "true"
+# insert: executemany INSERT (one round trip per row)
+# copy: COPY FROM STDIN in text format
+# copy_binary: COPY FROM STDIN in binary format
+POSTGRESQL_LOAD_MODE = os.getenv("POSTGRESQL_LOAD_MODE", "insert").lower()
+print("POSTGRESQL_LOAD_MODE: " + POSTGRESQL_LOAD_MODE)
+# raw: append envelopes to raw_events
+# replica: maintain one replica table per ORACLE_TABLE_INCLUDE_LIST entry
+# both: do both in the same transaction
+POSTGRESQL_SINK_MODE = os.getenv("POSTGRESQL_SINK_MODE", "raw").lower()
+print("POSTGRESQL_SINK_MODE: " + POSTGRESQL_SINK_MODE)
+REPLICA_TABLE_PREFIX = os.getenv("REPLICA_TABLE_PREFIX", "replica_")
+# uuid4: random ids, uuid7: time ordered ids, source: derived from the Debezium
+# source position so replayed events are deduplicated by the primary key
+EVENT_ID_STRATEGY = os.getenv("EVENT_ID_STRATEGY", "uuid4").lower()
+print("EVENT_ID_STRATEGY: " + EVENT_ID_STRATEGY)
+# full: store key/value as received
+# compact: store only the payload, with the schema deduplicated into raw_schemas
+ENVELOPE_MODE = os.getenv("ENVELOPE_MODE", "full").lower()
+print("ENVELOPE_MODE: " + ENVELOPE_MODE)
+# json: store key/value as JSONB
+# zstd: store them zstd compressed in key_zstd/value_zstd (BYTEA), with one
+# trained dictionary per destination kept in raw_dictionaries
+PAYLOAD_FORMAT = os.getenv("PAYLOAD_FORMAT", "json").lower()
+print("PAYLOAD_FORMAT: " + PAYLOAD_FORMAT)
+PAYLOAD_ZSTD_LEVEL = os.getenv("PAYLOAD_ZSTD_LEVEL", 3)
+PAYLOAD_DICT_KB = os.getenv("PAYLOAD_DICT_KB", 64)
+# Records sampled per destination to train its dictionary
+PAYLOAD_DICT_SAMPLES = os.getenv("PAYLOAD_DICT_SAMPLES", 1000)
+# Retrain a destination's dictionary after this many records, 0 never retrains
+PAYLOAD_DICT_RETRAIN_RECORDS = os.getenv("PAYLOAD_DICT_RETRAIN_RECORDS", 0)
+# Port of the Prometheus metrics endpoint, 0 disables it
+METRICS_PORT = os.getenv("METRICS_PORT", 0)
+# file: the engine's offset file only
+# database: also store the offset in dbz_offsets in the same transaction as each
+# batch, and seed the offset file from it on start
+OFFSET_STORAGE = os.getenv("OFFSET_STORAGE", "file").lower()
+print("OFFSET_STORAGE: " + OFFSET_STORAGE)
+# How often the engine flushes its offset file. With OFFSET_STORAGE=database the
+# file is only a fallback, so it can be flushed rarely.
+OFFSET_FLUSH_INTERVAL_MS = os.getenv("OFFSET_FLUSH_INTERVAL_MS", 1000)
+# Directory of the local spool; batches are appended there and loaded into the
+# database by a drainer thread. Empty writes to the database directly.
+SPOOL_DIR = os.getenv("SPOOL_DIR", "")
+print("SPOOL_DIR: " + SPOOL_DIR)
+SPOOL_SEGMENT_MB = os.getenv("SPOOL_SEGMENT_MB", 64)
+SPOOL_FSYNC = os.getenv("SPOOL_FSYNC", "True").lower() == "true"
+# Engine snapshot.mode, e.g. schema_only or initial
+SNAPSHOT_MODE = os.getenv("SNAPSHOT_MODE", "schema_only")
+print("SNAPSHOT_MODE: " + SNAPSHOT_MODE)
+# Bulk load the read events of an initial snapshot into an unlogged staging
+# table without indexes, moved into raw_events when the snapshot completes
+SNAPSHOT_BULK_LOAD = os.getenv("SNAPSHOT_BULK_LOAD", "True").lower() == "true"
+POSTGRESQL_SNAPSHOT_BATCH_SIZE = os.getenv("POSTGRESQL_SNAPSHOT_BATCH_SIZE", 50000)
+# Split a batch that fails because of its data until the bad records are found,
+# and store those in raw_events_dead_letter instead of stopping the engine
+DEAD_LETTER_ENABLED = os.getenv("DEAD_LETTER_ENABLED", "True").lower() == "true"
+print("DEAD_LETTER_ENABLED: " + str(DEAD_LETTER_ENABLED))
+# Retries of a write that lost its connection, with backoff up to WRITE_RETRY_MAX_SECONDS
+WRITE_RETRIES = os.getenv("WRITE_RETRIES", 3)
+WRITE_RETRY_MAX_SECONDS = os.getenv("WRITE_RETRY_MAX_SECONDS", 30)
+
+RAW_EVENT_COLUMNS = ("uuid", "destination", "key", "value", "key_schema_id", "value_schema_id")
+RAW_EVENT_ZSTD_COLUMNS = ("uuid", "destination", "key_zstd", "value_zstd", "key_schema_id", "value_schema_id")
+
+# Connect schema type -> PostgreSQL column type for replica tables
+REPLICA_COLUMN_TYPES = {
+    "int8": "SMALLINT",
+    "int16": "SMALLINT",
+    "int32": "INTEGER",
+    "int64": "BIGINT",
+    "float32": "REAL",
+    "float64": "DOUBLE PRECISION",
+    "boolean": "BOOLEAN",
+    "string": "TEXT",
+    "struct": "JSONB",
+    "array": "JSONB",
+    "map": "JSONB",
+}
+
+# Errors caused by the rows of a batch rather than by the database
+POISON_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError, pg_errors.ProgramLimitExceeded, ValueError)
+
+
+def is_poison_error(error):
+    """True if retrying the same rows can't succeed: bad values, encoding, constraint violations"""
+    return isinstance(error, POISON_ERRORS)
+
+
+def is_transient_error(error):
+    """True for lost connections, server restarts, serialization failures and deadlocks"""
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)) and not is_poison_error(error)
+
+
+# Escape table for the COPY text format: backslash and the row/column delimiters
+COPY_TEXT_ESCAPES = str.maketrans({"\\": "\\\\", "\n": "\\n", "\r": "\\r", "\t": "\\t"})
+COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_BINARY_TRAILER = struct.pack("!h", -1)
+JSONB_BINARY_VERSION = b"\x01"
 
 
 
@@ -49,24 +182,199 @@ class RawChangeHandler(BasePythonChangeHandler):
     The target table has columns: uuid, destination, key, value.
     """
     BATCH_SIZE = int(POSTGRESQL_INSERT_BATCH_SIZE)
+    BATCH_BYTES = int(float(POSTGRESQL_INSERT_BATCH_MB) * 1024 * 1024)
+    SNAPSHOT_BATCH_SIZE = int(POSTGRESQL_SNAPSHOT_BATCH_SIZE)
+    WRITER_QUEUE_DEPTH = int(POSTGRESQL_WRITER_QUEUE_DEPTH)
+    WRITER_CONNECTIONS = int(POSTGRESQL_WRITER_CONNECTIONS)
+    LOAD_MODES = ("insert", "copy", "copy_binary")
+    SINK_MODES = ("raw", "replica", "both")
+    ENVELOPE_MODES = ("full", "compact")
+    OFFSET_STORAGES = ("file", "database")
+    BATCH_SIZINGS = ("fixed", "adaptive")
+    PAYLOAD_FORMATS = ("json", "zstd")
 
     def __init__(self):
         super().__init__()
+        if POSTGRESQL_LOAD_MODE not in self.LOAD_MODES:
+            raise ValueError(f"Unsupported POSTGRESQL_LOAD_MODE: {POSTGRESQL_LOAD_MODE}")
+        self.load_mode = POSTGRESQL_LOAD_MODE
+        if POSTGRESQL_SINK_MODE not in self.SINK_MODES:
+            raise ValueError(f"Unsupported POSTGRESQL_SINK_MODE: {POSTGRESQL_SINK_MODE}")
+        self.sink_mode = POSTGRESQL_SINK_MODE
+        self.replica_tables = parse_include_list(ORACLE_TABLE_INCLUDE_LIST)
+        # Replica table name -> columns known to exist
+        self._replica_columns = {}
+        self.event_ids = EventIdGenerator(EVENT_ID_STRATEGY, layout="rfc")
+        if ENVELOPE_MODE not in self.ENVELOPE_MODES:
+            raise ValueError(f"Unsupported ENVELOPE_MODE: {ENVELOPE_MODE}")
+        self.compactor = SchemaCompactor() if ENVELOPE_MODE == "compact" else None
+        # Schema fingerprints already committed to raw_schemas
+        self._stored_schemas = set()
+        self._parsed_schemas = {}
+        # Reused across batches so COPY does not allocate a new buffer every time
+        self._copy_buffers = {}
+        if OFFSET_STORAGE not in self.OFFSET_STORAGES:
+            raise ValueError(f"Unsupported OFFSET_STORAGE: {OFFSET_STORAGE}")
+        self.stores_offsets = OFFSET_STORAGE == "database"
+        # Replica tables are kept up to date by upserts, so only raw mode stages snapshots
+        self.snapshot_bulk_load = SNAPSHOT_BULK_LOAD and self.sink_mode == "raw"
+        # True while raw_events_snapshot holds rows not yet moved into raw_events
+        self._snapshot_pending = False
+        if PAYLOAD_FORMAT not in self.PAYLOAD_FORMATS:
+            raise ValueError(f"Unsupported PAYLOAD_FORMAT: {PAYLOAD_FORMAT}")
+        if PAYLOAD_FORMAT == "zstd" and self.sink_mode != "raw":
+            raise ValueError("PAYLOAD_FORMAT=zstd needs POSTGRESQL_SINK_MODE=raw")
+        self.raw_columns = RAW_EVENT_ZSTD_COLUMNS if PAYLOAD_FORMAT == "zstd" else RAW_EVENT_COLUMNS
+        self.payload_compressor = None
+        # Dictionary ids already committed to raw_dictionaries
+        self._stored_dictionaries = set()
+        if POSTGRESQL_BATCH_SIZING not in self.BATCH_SIZINGS:
+            raise ValueError(f"Unsupported POSTGRESQL_BATCH_SIZING: {POSTGRESQL_BATCH_SIZING}")
+        self.batch_sizer = None
+        if POSTGRESQL_BATCH_SIZING == "adaptive":
+            self.batch_sizer = AdaptiveBatchSizer(
+                target_seconds=int(POSTGRESQL_BATCH_TARGET_MS) / 1000.0,
+                min_rows=int(POSTGRESQL_BATCH_MIN_SIZE),
+                max_rows=int(POSTGRESQL_BATCH_MAX_SIZE),
+                max_bytes=self.BATCH_BYTES,
+                initial_rows=self.BATCH_SIZE,
+                on_change=self._batch_size_changed,
+            )
+        self.retry = TransientRetry(
+            is_transient_error, int(WRITE_RETRIES), float(WRITE_RETRY_MAX_SECONDS), on_retry=self._write_retried
+        )
+        self.bisector = BatchBisector(is_poison_error) if DEAD_LETTER_ENABLED else None
+
         # Initialize PostgreSQL connection
-        self.pg_conn = psycopg2.connect(
+        self.pg_conn = self._connect()
+        self.pg_cursor = self.pg_conn.cursor()
+        
+        # Ensure the raw_events table exists
+        self._create_raw_events_table()
+        self._prepare_session(self.pg_conn)
+        if self.snapshot_bulk_load:
+            # A snapshot staged before a restart is moved once streaming starts
+            self.pg_cursor.execute("SELECT to_regclass('raw_events_snapshot') IS NOT NULL")
+            self._snapshot_pending = self.pg_cursor.fetchone()[0]
+            self.pg_conn.commit()
+        if PAYLOAD_FORMAT == "zstd":
+            self._load_payload_compressor()
+
+        # Optionally write shards of each batch concurrently on a connection pool
+        self.writer_pool = None
+        self.sharded_writer = None
+        if self.WRITER_CONNECTIONS > 1:
+            self.writer_pool = ConnectionPool(self._connect_writer, self.WRITER_CONNECTIONS)
+            self.sharded_writer = ShardedWriter(
+                self._write_isolated,
+                self.writer_pool,
+                destination=lambda row: row[1],
+                key=lambda row: row[2],
+                shard_by_key=WRITER_SHARD_BY_KEY,
+            )
+
+        # Optionally move inserts and commits off the engine thread
+        self.writer = None
+        if self.WRITER_QUEUE_DEPTH > 0:
+            self.writer = BackgroundWriter(
+                lambda item: self._write_batch(*item), self.WRITER_QUEUE_DEPTH, name="postgres-writer"
+            )
+
+        # Optionally append batches to a local spool that a drainer thread loads
+        self.spool = None
+        self.spool_drainer = None
+        if SPOOL_DIR:
+            if self.writer is not None:
+                raise ValueError("SPOOL_DIR and POSTGRESQL_WRITER_QUEUE_DEPTH cannot be combined")
+            self.spool = Spool(
+                os.path.join(SPOOL_DIR, "postgres"),
+                int(float(SPOOL_SEGMENT_MB) * 1024 * 1024),
+                fsync=SPOOL_FSYNC,
+            )
+            metrics.SPOOL_PENDING_BYTES.set(self.spool.pending_bytes(), sink="postgres")
+            self.spool_drainer = SpoolDrainer(
+                self.spool, self._load_spooled_batch, name="postgres-spool", on_error=self._spool_load_failed
+            )
+    
+    def _connect(self):
+        return psycopg2.connect(
             host=POSTGRESQL_HOST,
             port=POSTGRESQL_PORT,
             database=POSTGRESQL_DB,
             user=POSTGRESQL_USER,
             password=POSTGRESQL_PASSWORD
         )
+
+    def _connect_writer(self):
+        """Open a pooled connection for a shard writer"""
+        conn = self._connect()
+        self._prepare_session(conn)
+        return conn
+
+    def _prepare_session(self, conn):
+        """Create the session-local objects the load path needs"""
+        if self.event_ids.deduplicates and self.load_mode != "insert":
+            # COPY can't skip duplicates, so it loads a session-local staging table
+            # that is merged into raw_events with ON CONFLICT DO NOTHING
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS raw_events_stage
+                (LIKE raw_events INCLUDING DEFAULTS) ON COMMIT DELETE ROWS
+                """)
+            conn.commit()
+
+    def _connection_alive(self, conn):
+        """Roll back `conn` and check that the server still answers on it"""
+        try:
+            conn.rollback()
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            print(f"PostgreSQL connection is broken: {str(e)}")
+            self._copy_buffers.pop(id(conn), None)
+            return False
+
+    def _reconnect_if_broken(self):
+        """Replace the handler's connection if the server closed it or it stopped answering"""
+        if self._connection_alive(self.pg_conn):
+            return
+        print("Reconnecting to PostgreSQL")
+        try:
+            self.pg_conn.close()
+        except psycopg2.Error:
+            pass
+        try:
+            self.pg_conn = self._connect()
+        except psycopg2.Error as e:
+            # Still unreachable; the next attempt tries again
+            print(f"Error reconnecting to PostgreSQL: {str(e)}")
+            return
         self.pg_cursor = self.pg_conn.cursor()
-        
-        # Ensure the raw_events table exists
-        self._create_raw_events_table()
-    
+        self._prepare_session(self.pg_conn)
+
+    def _write_retried(self, error, attempt):
+        metrics.WRITE_RETRIES.inc(sink="postgres")
+        self._reconnect_if_broken()
+
+    def close(self):
+        """Flush pending batches and stop the spool drainer, background and shard writers, if any"""
+        if getattr(self, 'spool_drainer', None) is not None:
+            spool_drainer, self.spool_drainer = self.spool_drainer, None
+            # Give the drainer a moment to catch up; the rest is loaded on the next start
+            spool_drainer.drain(timeout=30)
+            spool_drainer.close()
+        if getattr(self, 'writer', None) is not None:
+            writer, self.writer = self.writer, None
+            writer.close()
+        if getattr(self, 'sharded_writer', None) is not None:
+            sharded_writer, self.sharded_writer = self.sharded_writer, None
+            sharded_writer.close()
+
     def __del__(self):
         # Clean up PostgreSQL connection when the handler is destroyed
+        self.close()
         if hasattr(self, 'pg_cursor'):
             self.pg_cursor.close()
         if hasattr(self, 'pg_conn'):
@@ -84,27 +392,705 @@ class RawChangeHandler(BasePythonChangeHandler):
         )
         """
         self.pg_cursor.execute(create_table_query)
+        # Compact mode stores each schema once and references it from raw_events;
+        # raw_events_full rebuilds the original envelopes
+        self.pg_cursor.execute("""
+        CREATE TABLE IF NOT EXISTS raw_schemas (
+            fingerprint CHAR(64) PRIMARY KEY,
+            schema JSONB,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        # seq orders rows by insertion for incremental readers (dbz_reader). The
+        # sequence is not owned by the table, so it survives the snapshot swap
+        self.pg_cursor.execute("CREATE SEQUENCE IF NOT EXISTS raw_events_seq")
+        self.pg_cursor.execute("""
+        ALTER TABLE raw_events
+            ADD COLUMN IF NOT EXISTS key_schema_id CHAR(64),
+            ADD COLUMN IF NOT EXISTS value_schema_id CHAR(64),
+            ADD COLUMN IF NOT EXISTS key_zstd BYTEA,
+            ADD COLUMN IF NOT EXISTS value_zstd BYTEA,
+            ADD COLUMN IF NOT EXISTS seq BIGINT DEFAULT nextval('raw_events_seq')
+        """)
+        self.pg_cursor.execute("CREATE INDEX IF NOT EXISTS raw_events_seq_idx ON raw_events (seq)")
+        self.pg_cursor.execute(
+            "CREATE INDEX IF NOT EXISTS raw_events_destination_seq_idx ON raw_events (destination, seq)"
+        )
+        # Watermarks of incremental readers
+        self.pg_cursor.execute("""
+        CREATE TABLE IF NOT EXISTS raw_events_consumers (
+            consumer TEXT PRIMARY KEY,
+            seq BIGINT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        # zstd dictionaries of PAYLOAD_FORMAT=zstd; every version is kept so old rows stay readable
+        self.pg_cursor.execute("""
+        CREATE TABLE IF NOT EXISTS raw_dictionaries (
+            dictionary_id BIGINT PRIMARY KEY,
+            destination TEXT,
+            dictionary BYTEA,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        # Records that failed on their own; key and value are kept as the exact bytes received
+        self.pg_cursor.execute("""
+        CREATE TABLE IF NOT EXISTS raw_events_dead_letter (
+            uuid UUID,
+            destination TEXT,
+            key BYTEA,
+            value BYTEA,
+            key_schema_id CHAR(64),
+            value_schema_id CHAR(64),
+            error TEXT,
+            failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        self.pg_cursor.execute("""
+        CREATE OR REPLACE VIEW raw_events_full AS
+        SELECT e.uuid, e.destination,
+            CASE WHEN e.key_schema_id IS NULL THEN e.key
+                 ELSE jsonb_build_object('schema', ks.schema, 'payload', e.key) END AS key,
+            CASE WHEN e.value_schema_id IS NULL THEN e.value
+                 ELSE jsonb_build_object('schema', vs.schema, 'payload', e.value) END AS value,
+            e.processed_at, e.seq
+        FROM raw_events e
+        LEFT JOIN raw_schemas ks ON ks.fingerprint = e.key_schema_id
+        LEFT JOIN raw_schemas vs ON vs.fingerprint = e.value_schema_id
+        """)
+        if self.stores_offsets:
+            # Engine offsets, committed together with the rows they cover
+            self.pg_cursor.execute("""
+            CREATE TABLE IF NOT EXISTS dbz_offsets (
+                engine_name TEXT NOT NULL,
+                source_partition TEXT NOT NULL,
+                source_offset TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (engine_name, source_partition)
+            )
+            """)
+        self.pg_conn.commit()
+
+    def load_offsets(self):
+        """Return the committed offsets as {source partition JSON: source offset JSON}"""
+        self.pg_cursor.execute(
+            "SELECT source_partition, source_offset FROM dbz_offsets WHERE engine_name = %s", (ENGINE_NAME,)
+        )
+        offsets = dict(self.pg_cursor.fetchall())
+        self.pg_conn.commit()
+        return offsets
+
+    def clear_offsets(self):
+        """Forget the committed offsets, e.g. when the offset and history files are reset"""
+        self.pg_cursor.execute("DELETE FROM dbz_offsets WHERE engine_name = %s", (ENGINE_NAME,))
+        self.pg_conn.commit()
+
+    def _store_offset(self, cursor, offset):
+        """Upsert the offset of the last record of a batch, in the batch's transaction"""
+        if offset is None:
+            return
+        source_partition, source_offset = offset
+        cursor.execute("""
+        INSERT INTO dbz_offsets (engine_name, source_partition, source_offset)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (engine_name, source_partition)
+        DO UPDATE SET source_offset = EXCLUDED.source_offset, updated_at = CURRENT_TIMESTAMP
+        """, (ENGINE_NAME, source_partition, source_offset))
+
+    def _write_copy_text(self, buf, batch_data):
+        """Serialize a batch into the reusable buffer using the COPY text format"""
+        for row in batch_data:
+            line = "\t".join([
+                "\\N" if column is None
+                # bytea hex input, with the backslash escaped for COPY
+                else "\\\\x" + column.hex() if isinstance(column, bytes)
+                else column.translate(COPY_TEXT_ESCAPES)
+                for column in row
+            ])
+            buf.write(line.encode("utf-8"))
+            buf.write(b"\n")
+
+    def _write_copy_binary(self, buf, batch_data):
+        """Serialize a batch into the reusable buffer using the COPY binary format"""
+        pack = struct.pack
+        buf.write(COPY_BINARY_HEADER)
+        for record_uuid, destination, key, value, key_schema_id, value_schema_id in batch_data:
+            buf.write(pack("!hi", len(self.raw_columns), 16))
+            buf.write(uuid.UUID(record_uuid).bytes)
+            for column, is_json in (
+                (destination, False), (key, True), (value, True), (key_schema_id, False), (value_schema_id, False)
+            ):
+                if column is None:
+                    buf.write(pack("!i", -1))
+                    continue
+                if isinstance(column, bytes):
+                    # bytea binary input is the raw bytes
+                    buf.write(pack("!i", len(column)))
+                    buf.write(column)
+                    continue
+                data = column.encode("utf-8")
+                if is_json:
+                    # jsonb binary input is a version byte followed by the json text
+                    buf.write(pack("!i", len(data) + 1))
+                    buf.write(JSONB_BINARY_VERSION)
+                else:
+                    buf.write(pack("!i", len(data)))
+                buf.write(data)
+        buf.write(COPY_BINARY_TRAILER)
+
+    def _copy_rows(self, cursor, target, batch_data, binary):
+        """Stream a batch into `target` with COPY FROM STDIN"""
+        # One reusable buffer per connection
+        buf = self._copy_buffers.setdefault(id(cursor.connection), io.BytesIO())
+        buf.seek(0)
+        buf.truncate()
+        columns = ", ".join(self.raw_columns)
+        if binary:
+            self._write_copy_binary(buf, batch_data)
+            copy_query = f"COPY {target} ({columns}) FROM STDIN WITH (FORMAT binary)"
+        else:
+            self._write_copy_text(buf, batch_data)
+            copy_query = f"COPY {target} ({columns}) FROM STDIN"
+        buf.seek(0)
+        cursor.copy_expert(copy_query, buf, size=1 << 20)
+
+    def _copy_batch(self, cursor, batch_data):
+        """Stream a batch into raw_events with COPY FROM STDIN"""
+        target = "raw_events_stage" if self.event_ids.deduplicates else "raw_events"
+        columns = ", ".join(self.raw_columns)
+        self._copy_rows(cursor, target, batch_data, self.load_mode == "copy_binary")
+        if self.event_ids.deduplicates:
+            cursor.execute(f"""
+            INSERT INTO raw_events ({columns})
+            SELECT {columns} FROM raw_events_stage
+            ON CONFLICT (uuid) DO NOTHING
+            """)
+            cursor.execute("TRUNCATE raw_events_stage")
+
+    def _ensure_replica_table(self, cursor, table_name, changes):
+        """Create the replica table, or add columns that appeared since it was created"""
+        field_types = {}
+        for change in changes:
+            field_types.update(change.field_types)
+        known = self._replica_columns.get(table_name)
+        if known is not None and known.issuperset(field_types):
+            return
+
+        def column_type(column):
+            return sql.SQL(REPLICA_COLUMN_TYPES.get(field_types[column][0], "TEXT"))
+
+        if known is None:
+            key_columns = list(changes[0].key)
+            create_query = sql.SQL("CREATE TABLE IF NOT EXISTS {} ({}, PRIMARY KEY ({}))").format(
+                sql.Identifier(table_name),
+                sql.SQL(", ").join(
+                    sql.SQL("{} {}").format(sql.Identifier(column), column_type(column))
+                    for column in field_types
+                ),
+                sql.SQL(", ").join(map(sql.Identifier, key_columns)),
+            )
+            cursor.execute(create_query)
+            known = set()
+        for column in field_types.keys() - known:
+            cursor.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}").format(
+                sql.Identifier(table_name), sql.Identifier(column), column_type(column)
+            ))
+        self._replica_columns[table_name] = known | field_types.keys()
+
+    def _apply_batch(self, cursor, batch_data, ensure_tables=True):
+        """
+        Apply a batch to the replica tables with set-based statements.
+
+        Changes are collapsed to the final state per primary key first, then each
+        table gets at most one TRUNCATE, one DELETE and one INSERT ... ON CONFLICT.
+        The caller commits.
+
+        Without `ensure_tables` the tables must exist already, as on the shard
+        threads, which leave creating them and `_replica_columns` to
+        `_prepare_shared_objects`.
+        """
+        changes = (
+            parse_change(key, value, self.replica_tables, self._value_schema(value_schema_id))
+            for _, _, key, value, _, value_schema_id in batch_data
+        )
+        for table, (truncated, table_changes) in coalesce_changes(changes).items():
+            table_name = REPLICA_TABLE_PREFIX + flat_table_name(table)
+            if not table_changes:
+                # Nothing to create the table from; only truncate one that already exists
+                cursor.execute("SELECT to_regclass(%s)", (table_name,))
+                if truncated and cursor.fetchone()[0] is not None:
+                    cursor.execute(sql.SQL("TRUNCATE {}").format(sql.Identifier(table_name)))
+                continue
+            if ensure_tables:
+                self._ensure_replica_table(cursor, table_name, table_changes)
+            if truncated:
+                cursor.execute(sql.SQL("TRUNCATE {}").format(sql.Identifier(table_name)))
+
+            key_columns = list(table_changes[0].key)
+            key_list = sql.SQL(", ").join(map(sql.Identifier, key_columns))
+            deletes = [change.key_values for change in table_changes if change.row is None]
+            upserts = [change.row for change in table_changes if change.row is not None]
+
+            if deletes:
+                delete_query = sql.SQL("DELETE FROM {} WHERE ({}) IN (VALUES %s)").format(
+                    sql.Identifier(table_name), key_list
+                )
+                execute_values(cursor, delete_query, deletes, page_size=len(deletes))
+
+            if upserts:
+                columns = list(dict.fromkeys(column for row in upserts for column in row))
+                non_key_columns = [column for column in columns if column not in key_columns]
+                if non_key_columns:
+                    conflict_action = sql.SQL("DO UPDATE SET {}").format(sql.SQL(", ").join(
+                        sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(column))
+                        for column in non_key_columns
+                    ))
+                else:
+                    conflict_action = sql.SQL("DO NOTHING")
+                upsert_query = sql.SQL("INSERT INTO {} ({}) VALUES %s ON CONFLICT ({}) {}").format(
+                    sql.Identifier(table_name),
+                    sql.SQL(", ").join(map(sql.Identifier, columns)),
+                    key_list,
+                    conflict_action,
+                )
+                rows = [
+                    tuple(
+                        json.dumps(value) if isinstance(value, (dict, list)) else value
+                        for value in (row.get(column) for column in columns)
+                    )
+                    for row in upserts
+                ]
+                execute_values(cursor, upsert_query, rows, page_size=len(rows))
+
+    def _value_schema(self, fingerprint):
+        """Look up a schema stripped in compact mode"""
+        if fingerprint is None or self.compactor is None:
+            return None
+        schema = self._parsed_schemas.get(fingerprint)
+        if schema is None:
+            schema = self._parsed_schemas[fingerprint] = json.loads(self.compactor.schemas[fingerprint])
+        return schema
+
+    def _load_payload_compressor(self):
+        """Create the payload compressor, continuing with the stored dictionaries"""
+        self.pg_cursor.execute(
+            "SELECT dictionary_id, destination, dictionary FROM raw_dictionaries ORDER BY created_at, dictionary_id"
+        )
+        dictionaries = [(row[0], row[1], bytes(row[2])) for row in self.pg_cursor.fetchall()]
         self.pg_conn.commit()
+        self.payload_compressor = PayloadCompressor(
+            level=int(PAYLOAD_ZSTD_LEVEL),
+            dict_bytes=int(PAYLOAD_DICT_KB) * 1024,
+            samples=int(PAYLOAD_DICT_SAMPLES),
+            retrain_records=int(PAYLOAD_DICT_RETRAIN_RECORDS),
+            dictionaries=dictionaries,
+        )
+        self._stored_dictionaries = {dictionary_id for dictionary_id, _, _ in dictionaries}
+
+    def _store_dictionaries(self, cursor):
+        """Insert trained dictionaries that are not in raw_dictionaries yet"""
+        if self.payload_compressor is None:
+            return set()
+        # copy() is atomic, the capture thread may train a dictionary meanwhile
+        dictionary_ids = set(self.payload_compressor.dictionaries.copy()) - self._stored_dictionaries
+        if not dictionary_ids:
+            return dictionary_ids
+        execute_values(
+            cursor,
+            "INSERT INTO raw_dictionaries (dictionary_id, destination, dictionary) VALUES %s "
+            "ON CONFLICT (dictionary_id) DO NOTHING",
+            [
+                (dictionary_id, *self.payload_compressor.dictionaries[dictionary_id])
+                for dictionary_id in dictionary_ids
+            ],
+        )
+        return dictionary_ids
+
+    def _store_schemas(self, cursor, batch_data):
+        """Insert schemas referenced by the batch that are not in raw_schemas yet"""
+        fingerprints = {fp for row in batch_data for fp in row[4:6] if fp is not None} - self._stored_schemas
+        if not fingerprints:
+            return fingerprints
+        execute_values(
+            cursor,
+            "INSERT INTO raw_schemas (fingerprint, schema) VALUES %s ON CONFLICT (fingerprint) DO NOTHING",
+            [(fp, self.compactor.schemas[fp]) for fp in fingerprints],
+        )
+        return fingerprints
+
+    @contextmanager
+    def _cursor(self, conn):
+        """The handler's cursor on its own connection, otherwise a new cursor closed afterwards"""
+        if conn is self.pg_conn:
+            yield self.pg_cursor
+        else:
+            with conn.cursor() as cursor:
+                yield cursor
+
+    def _lock_seq(self, cursor):
+        """Hold SEQ_LOCK shared until commit, so readers do not pass the seq drawn by this transaction (see dbz_reader)"""
+        cursor.execute("SELECT pg_advisory_xact_lock_shared(hashtext(%s))", (SEQ_LOCK,))
+
+    def _insert_batch(self, batch_data, conn=None, offset=None):
+        """
+        Helper method to insert a batch of records on `conn` (the handler's connection by default).
 
-    def _insert_batch(self, batch_data):
-        """Helper method to insert a batch of records"""
+        `offset` is the (partition, offset) of the batch's last record, stored in
+        the same transaction when OFFSET_STORAGE=database.
+        """
         if not batch_data:
             return
+        if conn is None:
+            conn = self.pg_conn
+        # Pooled connections belong to shard threads
+        own = conn is self.pg_conn
         
-        insert_query = """
-        INSERT INTO raw_events (uuid, destination, key, value)
-        VALUES (%s, %s, %s, %s)
+        insert_query = f"""
+        INSERT INTO raw_events ({", ".join(self.raw_columns)})
+        VALUES (%s, %s, %s, %s, %s, %s)
         """
+        if self.event_ids.deduplicates:
+            # Replayed events carry the id of their first delivery
+            insert_query += "ON CONFLICT (uuid) DO NOTHING"
         
+        with self._cursor(conn) as cursor:
+            try:
+                with metrics.INSERT_SECONDS.time(sink="postgres"):
+                    new_schemas = new_dictionaries = set()
+                    if self.sink_mode != "replica":
+                        new_schemas = self._store_schemas(cursor, batch_data)
+                        new_dictionaries = self._store_dictionaries(cursor)
+                        self._lock_seq(cursor)
+                        if self.load_mode == "insert":
+                            cursor.executemany(insert_query, batch_data)
+                        else:
+                            self._copy_batch(cursor, batch_data)
+                    if self.sink_mode != "raw":
+                        self._apply_batch(cursor, batch_data, ensure_tables=own)
+                    self._store_offset(cursor, offset)
+                with metrics.COMMIT_SECONDS.time(sink="postgres"):
+                    conn.commit()
+                self._stored_schemas |= new_schemas
+                self._stored_dictionaries |= new_dictionaries
+                metrics.ROWS_WRITTEN.inc(len(batch_data), sink="postgres")
+                print(f"Successfully stored {len(batch_data)} records")
+            except Exception as e:
+                print(f"Error processing batch: {str(e)}")
+                metrics.BATCH_ERRORS.inc(sink="postgres")
+                conn.rollback()
+                if own:
+                    # DDL issued in this transaction was rolled back too
+                    self._replica_columns.clear()
+                raise
+
+    def _store_dead_letters(self, failures, conn=None, offset=None):
+        """Insert (row, error) pairs into raw_events_dead_letter, with the offset in the same transaction"""
+        if conn is None:
+            conn = self.pg_conn
+        rows = [row for row, _ in failures]
+        with self._cursor(conn) as cursor:
+            try:
+                new_schemas = self._store_schemas(cursor, rows)
+                new_dictionaries = self._store_dictionaries(cursor)
+                execute_values(
+                    cursor,
+                    "INSERT INTO raw_events_dead_letter "
+                    "(uuid, destination, key, value, key_schema_id, value_schema_id, error) VALUES %s",
+                    [
+                        (row[0], row[1], payload_bytes(row[2]), payload_bytes(row[3]), row[4], row[5], error)
+                        for row, error in failures
+                    ],
+                )
+                self._store_offset(cursor, offset)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        self._stored_schemas |= new_schemas
+        self._stored_dictionaries |= new_dictionaries
+        for row in rows:
+            metrics.DEAD_LETTERS.inc(sink="postgres", destination=row[1])
+
+    def _write_isolated(self, batch_data, conn=None, offset=None):
+        """
+        Insert a batch on `conn` (the handler's connection by default).
+
+        Records that fail on their own go to raw_events_dead_letter. Transient
+        errors are retried after reconnecting, one committed piece at a time,
+        so pieces that are already committed are not written again.
+        """
+        # A pooled connection that broke is replaced in its slot
+        pooled = [conn]
+
+        def reconnect(error, attempt):
+            if conn is None:
+                self._write_retried(error, attempt)
+                return
+            metrics.WRITE_RETRIES.inc(sink="postgres")
+            if not self._connection_alive(pooled[0]):
+                try:
+                    pooled[0] = self.writer_pool.reconnect(pooled[0])
+                except psycopg2.Error as e:
+                    # Still unreachable; the next attempt tries again
+                    print(f"Error reconnecting to PostgreSQL: {str(e)}")
+
+        def insert(rows, rows_offset):
+            self.retry(lambda: self._insert_batch(rows, pooled[0], rows_offset), on_retry=reconnect)
+
+        def dead_letter(failures, failures_offset):
+            self.retry(lambda: self._store_dead_letters(failures, pooled[0], failures_offset), on_retry=reconnect)
+
+        if self.bisector is None:
+            insert(batch_data, offset)
+        else:
+            self.bisector.write(batch_data, insert, dead_letter, offset)
+
+    def _prepare_shared_objects(self, batch_data):
+        """
+        Create the raw_schemas rows and replica tables a batch needs, before it is sharded.
+
+        Concurrent transactions creating the same table or schema row would
+        conflict, so this runs on the handler's own connection and commits
+        before the shards start.
+        """
         try:
-            self.pg_cursor.executemany(insert_query, batch_data)
+            new_schemas = new_dictionaries = set()
+            if self.sink_mode != "replica":
+                new_schemas = self._store_schemas(self.pg_cursor, batch_data)
+                new_dictionaries = self._store_dictionaries(self.pg_cursor)
+            if self.sink_mode != "raw":
+                changes = (
+                    parse_change(key, value, self.replica_tables, self._value_schema(value_schema_id))
+                    for _, _, key, value, _, value_schema_id in batch_data
+                )
+                for table, (_, table_changes) in coalesce_changes(changes).items():
+                    if table_changes:
+                        table_name = REPLICA_TABLE_PREFIX + flat_table_name(table)
+                        self._ensure_replica_table(self.pg_cursor, table_name, table_changes)
             self.pg_conn.commit()
-            print(f"Successfully stored {len(batch_data)} records")
-        except Exception as e:
-            print(f"Error processing batch: {str(e)}")
+            self._stored_schemas |= new_schemas
+            self._stored_dictionaries |= new_dictionaries
+        except Exception:
             self.pg_conn.rollback()
+            self._replica_columns.clear()
             raise
 
+    def _batch_size_changed(self, destination, rows):
+        metrics.BATCH_SIZE_LIMIT.set(rows, sink="postgres", destination=destination)
+        print(f"Batch size for {destination}: {rows} rows")
+
+    def _batch_limits(self, destination):
+        """Return (max rows, max bytes) of an insert batch; `destination` is None for mixed batches"""
+        if self.batch_sizer is None:
+            return self.BATCH_SIZE, self.BATCH_BYTES
+        return self.batch_sizer.limits(destination)
+
+    def _write_batch(self, batch_data, offset=None, source_ts=None):
+        """
+        Write a batch on the handler's connection, or split across the shard writers.
+
+        `source_ts` is the source.ts_ms of the batch's newest event, read in
+        handleJsonBatch before the value is compressed.
+        """
+        started = time.perf_counter()
+        if self.sharded_writer is None:
+            self._write_isolated(batch_data, offset=offset)
+        else:
+            self._write_sharded_batch(batch_data, offset)
+        metrics.observe_source_lag("postgres", source_ts)
+        if self.batch_sizer is not None:
+            # Adaptive batches hold a single destination
+            self.batch_sizer.observe(
+                batch_data[0][1],
+                len(batch_data),
+                sum(len(row[2] or "") + len(row[3] or "") for row in batch_data),
+                time.perf_counter() - started,
+            )
+
+    def _write_sharded_batch(self, batch_data, offset=None):
+        """Write the shards of a batch concurrently, then commit its offset"""
+        self.retry(lambda: self._prepare_shared_objects(batch_data))
+        self.sharded_writer.write(batch_data)
+        if offset is not None:
+            # Shards commit separately, so the offset follows once all of them have
+            self.retry(lambda: self._commit_offset(offset))
+
+    def _commit_offset(self, offset):
+        """Store an offset on the handler's connection in a transaction of its own"""
+        try:
+            self._store_offset(self.pg_cursor, offset)
+            self.pg_conn.commit()
+        except Exception:
+            self.pg_conn.rollback()
+            raise
+
+    def _spool_batch(self, batch_data, offset, source_ts=None):
+        """Append a batch, with the schemas it needs that are not in raw_schemas yet, to the spool"""
+        schemas = {}
+        if self.compactor is not None:
+            schemas = {
+                fp: self.compactor.schemas[fp]
+                for row in batch_data for fp in row[4:6]
+                if fp is not None and fp not in self._stored_schemas
+            }
+        dictionaries = {}
+        if self.payload_compressor is not None:
+            dictionaries = {
+                str(dictionary_id): entry
+                for dictionary_id, entry in self.payload_compressor.dictionaries.copy().items()
+                if dictionary_id not in self._stored_dictionaries
+            }
+        payload = encode_json({
+            "rows": batch_data, "offset": offset, "source_ts": source_ts,
+            "schemas": schemas, "dictionaries": dictionaries,
+        })
+        self.spool.append(payload)
+        metrics.SPOOL_PENDING_BYTES.set(self.spool.pending_bytes(), sink="postgres")
+
+    def _load_spooled_batch(self, payload):
+        """Write one spooled batch; runs on the drainer thread"""
+        batch = decode_json(payload)
+        if batch["schemas"] and self.compactor is not None:
+            for fp, schema in batch["schemas"].items():
+                self.compactor.schemas.setdefault(fp, schema)
+        if batch.get("dictionaries") and self.payload_compressor is not None:
+            # Dictionaries trained before a restart; stored with the batch that needs them
+            for dictionary_id, (destination, dictionary) in batch["dictionaries"].items():
+                self.payload_compressor.dictionaries.setdefault(int(dictionary_id), (destination, dictionary))
+        offset = batch["offset"]
+        self._write_batch(
+            [tuple(row) for row in batch["rows"]], tuple(offset) if offset else None, batch.get("source_ts")
+        )
+        metrics.SPOOL_PENDING_BYTES.set(self.spool.pending_bytes(), sink="postgres")
+
+    def _spool_load_failed(self, error, attempt):
+        print(f"Error loading spooled batch (attempt {attempt}), retrying: {str(error)}")
+        metrics.SPOOL_LOAD_FAILURES.inc(sink="postgres")
+        self._reconnect_if_broken()
+
+    def _stage_snapshot_batch(self, batch_data, offset=None, restart=False):
+        """
+        COPY read events of an initial snapshot into raw_events_snapshot.
+
+        The staging table is UNLOGGED and has no primary key or indexes, so the
+        load writes neither WAL nor index pages. `restart` empties it first: an
+        interrupted snapshot is started over by the engine. Runs on the engine
+        thread once everything queued before the snapshot has been written.
+        Records that fail on their own go to raw_events_dead_letter.
+        """
+        if not self._snapshot_pending:
+            self._drain_pipeline()
+        if restart or not self._snapshot_pending:
+            self.retry(lambda: self._prepare_snapshot_table(restart))
+            self._snapshot_pending = True
+        def copy(rows, rows_offset):
+            self.retry(lambda: self._copy_snapshot_rows(rows, rows_offset))
+
+        def dead_letter(failures, failures_offset):
+            self.retry(lambda: self._store_dead_letters(failures, offset=failures_offset))
+
+        if self.bisector is None:
+            copy(batch_data, offset)
+        else:
+            self.bisector.write(batch_data, copy, dead_letter, offset)
+
+    def _prepare_snapshot_table(self, restart):
+        """Create raw_events_snapshot, emptied when the snapshot started over"""
+        try:
+            self.pg_cursor.execute(
+                "CREATE UNLOGGED TABLE IF NOT EXISTS raw_events_snapshot (LIKE raw_events INCLUDING DEFAULTS)"
+            )
+            if restart:
+                self.pg_cursor.execute("TRUNCATE raw_events_snapshot")
+            self.pg_conn.commit()
+        except Exception:
+            self.pg_conn.rollback()
+            raise
+
+    def _copy_snapshot_rows(self, batch_data, offset=None):
+        """COPY rows into raw_events_snapshot and commit them with their offset"""
+        cursor = self.pg_cursor
+        try:
+            with metrics.INSERT_SECONDS.time(sink="postgres"):
+                new_schemas = self._store_schemas(cursor, batch_data)
+                new_dictionaries = self._store_dictionaries(cursor)
+                self._copy_rows(cursor, "raw_events_snapshot", batch_data, binary=True)
+                self._store_offset(cursor, offset)
+            with metrics.COMMIT_SECONDS.time(sink="postgres"):
+                self.pg_conn.commit()
+        except Exception:
+            metrics.BATCH_ERRORS.inc(sink="postgres")
+            self.pg_conn.rollback()
+            raise
+        self._stored_schemas |= new_schemas
+        self._stored_dictionaries |= new_dictionaries
+        metrics.ROWS_WRITTEN.inc(len(batch_data), sink="postgres")
+        print(f"Staged {len(batch_data)} snapshot records")
+
+    def _finish_snapshot(self):
+        """
+        Move the staged snapshot into raw_events once the snapshot is complete.
+
+        An empty raw_events is replaced by the staging table, which is only now
+        made logged and given its primary key, built in one pass instead of row
+        by row. Otherwise the staged rows are merged with one INSERT ... SELECT.
+        """
+        started = time.perf_counter()
+        self.retry(self._move_snapshot)
+        self._snapshot_pending = False
+        # Recreate the view and everything else built on raw_events
+        self.retry(self._create_raw_events_table)
+        print(f"Moved the snapshot into raw_events in {time.perf_counter() - started:.1f}s")
+
+    def _move_snapshot(self):
+        """Merge or swap raw_events_snapshot into raw_events in one transaction"""
+        cursor = self.pg_cursor
+        columns = ", ".join(self.raw_columns)
+        try:
+            self._lock_seq(cursor)
+            cursor.execute("LOCK TABLE raw_events IN ACCESS EXCLUSIVE MODE")
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM raw_events)")
+            if cursor.fetchone()[0]:
+                cursor.execute(f"""
+                INSERT INTO raw_events ({columns})
+                SELECT {columns} FROM raw_events_snapshot
+                ON CONFLICT (uuid) DO NOTHING
+                """)
+                cursor.execute("DROP TABLE raw_events_snapshot")
+            else:
+                if self.event_ids.deduplicates:
+                    # Source ids repeat if the engine replayed part of the snapshot
+                    cursor.execute("""
+                    DELETE FROM raw_events_snapshot a USING raw_events_snapshot b
+                    WHERE a.uuid = b.uuid AND a.ctid > b.ctid
+                    """)
+                cursor.execute("ALTER TABLE raw_events_snapshot SET LOGGED")
+                cursor.execute("ALTER TABLE raw_events_snapshot ADD CONSTRAINT raw_events_snapshot_pkey PRIMARY KEY (uuid)")
+                cursor.execute("DROP VIEW IF EXISTS raw_events_full")
+                cursor.execute("DROP TABLE raw_events")
+                cursor.execute("ALTER TABLE raw_events_snapshot RENAME TO raw_events")
+                cursor.execute("ALTER TABLE raw_events RENAME CONSTRAINT raw_events_snapshot_pkey TO raw_events_pkey")
+            self.pg_conn.commit()
+        except Exception:
+            self.pg_conn.rollback()
+            raise
+
+    def _drain_pipeline(self):
+        """Wait until the background writer and spool drainer have written everything handed to them"""
+        if self.writer is not None:
+            self.writer.flush()
+        if self.spool_drainer is not None:
+            self.spool_drainer.drain()
+
+    def _submit_batch(self, batch_data, offset=None, source_ts=None):
+        """Insert a batch now, or hand it to the spool or background writer"""
+        if self.spool is not None:
+            self._spool_batch(batch_data, offset, source_ts)
+        elif self.writer is not None:
+            self.writer.submit((batch_data, offset, source_ts))
+        else:
+            self._write_batch(batch_data, offset, source_ts)
+
     def handleJsonBatch(self, records: List[ChangeEvent]):
         """
         Handles a batch of Debezium change events by storing them raw in PostgreSQL.
@@ -112,46 +1098,141 @@ class RawChangeHandler(BasePythonChangeHandler):
 
         print(f"Processing {len(records)} records")
         
+        metrics.BATCH_RECORDS.observe(len(records), sink="postgres")
+        started = time.perf_counter()
+        submit_seconds = 0.0
+        batch_bytes = 0
+        destination_counts = {}
+
         try:
-            batch_data = []
-            for record in records:
-                # Generate a unique UUID for each record
-                record_uuid = uuid.uuid4()
-                
-                # Get the raw data from the ChangeEvent
-                destination = record.destination()
-                # key = json.dumps(record.key()) if record.key() else None
-                # value = json.dumps(record.value()) if record.value() else None
-                key = record.key() if record.key() else None
-                value = record.value() if record.value() else None
+            if self.payload_compressor is not None:
+                # Between engine batches, so every record of a batch uses the same dictionary
+                self.payload_compressor.train()
+
+            # Insert batches being filled: one per destination with adaptive
+            # sizing, otherwise a single mixed one under the key None
+            pending = {}
+            # Snapshot read events waiting for the staging table: rows, bytes, restart
+            snapshot = [[], 0, False]
+            # Destinations, keys and values read from the engine once, empty ones as None
+            batch = read_batch(records)
+            for index, (destination, key, value) in enumerate(zip(batch.destinations, batch.keys, batch.values)):
+
+                batch_bytes += len(key or "") + len(value or "")
+                destination_counts[destination] = destination_counts.get(destination, 0) + 1
+
+                phase = snapshot_phase(value) if self.snapshot_bulk_load else None
+                if phase is None and self._snapshot_pending:
+                    # The first streaming event: the snapshot is complete
+                    submit_started = time.perf_counter()
+                    if snapshot[0]:
+                        self._stage_snapshot_batch(snapshot[0], None, snapshot[2])
+                        snapshot = [[], 0, False]
+                    self._finish_snapshot()
+                    submit_seconds += time.perf_counter() - submit_started
+
+                # Generate the primary key according to EVENT_ID_STRATEGY
+                record_uuid = self.event_ids.new_id(destination, key, value)
+
+                # source.ts_ms can no longer be read once the value is compressed
+                source_value = value
+
+                # Strip the embedded schemas in compact mode
+                key_schema_id = value_schema_id = None
+                if self.compactor is not None:
+                    key, key_schema_id = self.compactor.compact(key)
+                    value, value_schema_id = self.compactor.compact(value)
+                if self.payload_compressor is not None:
+                    key = self.payload_compressor.compress(destination, key)
+                    value = self.payload_compressor.compress(destination, value)
                 
-                batch_data.append((
-                    str(record_uuid),
+                row = (
+                    record_uuid,
                     destination,
                     key,
-                    value
-                ))
-                
-                # print(f"Storing record: {destination} | {key} | {value}")
+                    value,
+                    key_schema_id,
+                    value_schema_id
+                )
+                if phase is not None:
+                    snapshot[0].append(row)
+                    snapshot[1] += len(key or "") + len(value or "")
+                    snapshot[2] = snapshot[2] or phase == "first"
+                    if len(snapshot[0]) >= self.SNAPSHOT_BATCH_SIZE or snapshot[1] >= self.BATCH_BYTES \
+                            or phase == "last":
+                        submit_started = time.perf_counter()
+                        self._stage_snapshot_batch(
+                            snapshot[0], batch.offset(index) if self.stores_offsets else None, snapshot[2]
+                        )
+                        snapshot = [[], 0, False]
+                        if phase == "last":
+                            self._finish_snapshot()
+                        submit_seconds += time.perf_counter() - submit_started
+                    continue
+                chunk_key = destination if self.batch_sizer is not None else None
+                # Rows, bytes and the uncompressed value of the newest row
+                chunk = pending.setdefault(chunk_key, [[], 0, None])
+                chunk[0].append(row)
+                chunk[1] += len(key or "") + len(value or "")
+                chunk[2] = source_value
 
-                if len(batch_data) >= self.BATCH_SIZE:
-                    self._insert_batch(batch_data)
-                    batch_data = []  # Reset batch
+                # If the batch's row or byte limit is reached, insert
+                max_rows, max_bytes = self._batch_limits(chunk_key)
+                if len(chunk[0]) >= max_rows or chunk[1] >= max_bytes:
+                    del pending[chunk_key]
+                    # Other destinations may still hold earlier records, so the
+                    # offset may only advance once nothing else is pending
+                    offset = batch.offset(index) if self.stores_offsets and not pending else None
+                    submit_started = time.perf_counter()
+                    self._submit_batch(chunk[0], offset, source_ts_ms(chunk[2]))
+                    submit_seconds += time.perf_counter() - submit_started
             
-            # Insert các record còn lại sau khi vòng lặp kết thúc
-            if batch_data:
-                self._insert_batch(batch_data)
+            if snapshot[0]:
+                submit_started = time.perf_counter()
+                self._stage_snapshot_batch(
+                    snapshot[0], batch.offset(-1) if self.stores_offsets else None, snapshot[2]
+                )
+                submit_seconds += time.perf_counter() - submit_started
+
+            # Insert remaining records; the last batch carries the engine batch's offset
+            remaining = list(pending.values())
+            for index, (batch_data, _, source_value) in enumerate(remaining):
+                last = index == len(remaining) - 1
+                submit_started = time.perf_counter()
+                self._submit_batch(
+                    batch_data, batch.offset(-1) if self.stores_offsets and last else None, source_ts_ms(source_value)
+                )
+                submit_seconds += time.perf_counter() - submit_started
+
+            if self.writer is not None:
+                # The engine acknowledges the records once this returns, so they must be committed by then
+                submit_started = time.perf_counter()
+                self.writer.flush()
+                submit_seconds += time.perf_counter() - submit_started
+
+            metrics.CONVERT_SECONDS.observe(time.perf_counter() - started - submit_seconds, sink="postgres")
+            metrics.BATCH_BYTES.observe(batch_bytes, sink="postgres")
+            for destination, count in destination_counts.items():
+                metrics.RECORDS.inc(count, sink="postgres", destination=destination)
                         
         except Exception as e:
             print(f"Error processing records: {str(e)}")
-            self.pg_conn.rollback()
+            if self.writer is not None:
+                # Wait for the batches already queued, so none is written after the engine sees the failure
+                try:
+                    self.writer.flush()
+                except Exception:
+                    pass
+            # The connection belongs to the writer or drainer thread when pipelining
+            if self.writer is None and self.spool is None:
+                self.pg_conn.rollback()
             raise
 
 
 if __name__ == '__main__':
     props = Properties()
-    props.setProperty("name", "engine")
-    props.setProperty("snapshot.mode", "schema_only")
+    props.setProperty("name", ENGINE_NAME)
+    props.setProperty("snapshot.mode", SNAPSHOT_MODE)
     props.setProperty("topic.prefix", "dwh")
     props.setProperty("tombstones.on.delete", "false")
     props.setProperty("log.mining.strategy", "online_catalog")
@@ -162,7 +1243,7 @@ if __name__ == '__main__':
     props.setProperty("connector.class", "io.debezium.connector.oracle.OracleConnector")
     props.setProperty("offset.storage", "org.apache.kafka.connect.storage.FileOffsetBackingStore")
     props.setProperty("offset.storage.file.filename", OFFSET_FILE)
-    props.setProperty("offset.flush.interval.ms", "1000")
+    props.setProperty("offset.flush.interval.ms", str(OFFSET_FLUSH_INTERVAL_MS))
     props.setProperty("schema.history.internal", "io.debezium.storage.file.history.FileSchemaHistory")
     props.setProperty("schema.history.internal.file.filename", HISTORY_FILE)
     props.setProperty("tasks.max", "1")
@@ -186,7 +1267,21 @@ if __name__ == '__main__':
     # props.setProperty("transforms.unwrap.delete.handling.mode", "rewrite")
 
     # Create a DebeziumJsonEngine instance, passing the configuration properties and the custom change event handler.
-    engine = DebeziumJsonEngine(properties=props, handler=RawChangeHandler())
+    if int(METRICS_PORT):
+        metrics.start_http_server(int(METRICS_PORT))
+
+    handler = RawChangeHandler()
+    if handler.stores_offsets and handler.spool is None:
+        # The sink is the source of truth: resume right after its last committed batch.
+        # With a spool the offset file is, since the spool already holds what follows.
+        if CLEAR_OFFSET_AND_HISTORY_FILE:
+            handler.clear_offsets()
+        seed_offset_file(OFFSET_FILE, handler.load_offsets())
+    engine = DebeziumJsonEngine(properties=props, handler=handler)
 
     # Start the Debezium engine to begin consuming and processing change events.
-    engine.run()
+    try:
+        engine.run()
+    finally:
+        # Drain batches still queued for the background writer
+        handler.close()
@@ -0,0 +1,76 @@
+import queue
+import threading
+
+
+class BackgroundWriter:
+    """
+    Runs a write function on a dedicated thread fed by a bounded queue.
+
+    The handler hands insert batches to `submit` as it converts an engine batch,
+    so the writer thread inserts and commits the first ones while the engine
+    thread converts the rest. When the queue is full, `submit` blocks, which
+    pushes back on the engine instead of buffering without limit. The handler
+    must `flush` before returning the engine batch: the engine acknowledges the
+    records as soon as `handleJsonBatch` returns, so they have to be committed
+    by then.
+
+    A failure on the writer thread is re-raised on the next `submit` or `flush`.
+    The batches queued after the failed one are dropped without being written;
+    they belong to the same engine batch, which the engine never acknowledges
+    and replays after a restart. `flush` reports a failure once, so a retried
+    engine batch starts with a clean writer.
+    """
+    _STOP = object()
+
+    def __init__(self, write_fn, queue_depth, name="dbz-writer"):
+        if queue_depth < 1:
+            raise ValueError(f"queue_depth must be at least 1, got {queue_depth}")
+        self._write_fn = write_fn
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is self._STOP:
+                    return
+                # After a failure keep draining so a blocked submit can return;
+                # `flush` reports the failure, so none of these is acknowledged
+                if self._error is None:
+                    self._write_fn(batch)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def raise_if_failed(self):
+        """Re-raise the error of a failed write on the calling thread"""
+        if self._error is not None:
+            raise RuntimeError("Background writer failed") from self._error
+
+    def submit(self, batch):
+        """Queue a batch for writing, blocking while the queue is full"""
+        if self._closed:
+            raise RuntimeError("Background writer is closed")
+        self.raise_if_failed()
+        self._queue.put(batch)
+
+    def flush(self):
+        """Block until every queued batch has been written; raises, once, if any of them failed"""
+        self._queue.join()
+        error, self._error = self._error, None
+        if error is not None:
+            raise RuntimeError("Background writer failed") from error
+
+    def close(self):
+        """Drain the queue and stop the writer thread"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self.raise_if_failed()
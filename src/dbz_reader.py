@@ -0,0 +1,297 @@
+"""
+Read raw_events incrementally, past a watermark stored per consumer.
+
+Every raw_events row gets a sequence number (`seq`) when it is inserted, and
+raw_events is indexed on (seq) and (destination, seq), so a downstream job can
+pull only the rows written since its last run instead of scanning the table.
+Each consumer's watermark is kept in raw_events_consumers. Rows are streamed
+from a server-side cursor in chunks, with keys and values turned back into the
+JSON text the engine delivered, whatever ENVELOPE_MODE and PAYLOAD_FORMAT the
+sink used.
+
+Examples:
+    python src/dbz_reader.py --sink postgres --consumer etl --destination dwh.C__DBZUSER.CUSTOMERS
+    python src/dbz_reader.py --sink mssql --consumer etl --limit 10000 --commit
+"""
+import argparse
+import json
+import os
+import sys
+
+from dbz_compression import PayloadDecoder, load_dictionaries
+from dbz_envelope import restore_envelope
+
+DIALECTS = ("postgres", "mssql")
+# Lock the sink handlers hold shared while a transaction draws raw_events sequence
+# numbers (an advisory lock on Postgres, an application lock on MSSQL)
+SEQ_LOCK = "raw_events_seq"
+
+
+class RawEvent:
+    """A raw_events row with its key and value as the engine delivered them (JSON text)"""
+    __slots__ = ("seq", "uuid", "destination", "key", "value", "processed_at")
+
+    def __init__(self, seq, uuid, destination, key, value, processed_at):
+        self.seq = seq
+        self.uuid = uuid
+        self.destination = destination
+        self.key = key
+        self.value = value
+        self.processed_at = processed_at
+
+    def __repr__(self):
+        return f"RawEvent(seq={self.seq}, destination={self.destination}, uuid={self.uuid})"
+
+    def to_json(self):
+        """One JSON line; key and value are embedded as JSON, not as strings"""
+        return (f'{{"seq":{self.seq},"uuid":{json.dumps(self.uuid)},"destination":{json.dumps(self.destination)},'
+                f'"processed_at":{json.dumps(str(self.processed_at))},'
+                f'"key":{self.key or "null"},"value":{self.value or "null"}}}')
+
+
+class RawEventReader:
+    """
+    Streams raw_events rows past a consumer's watermark, in seq order.
+
+    `conn` is a psycopg2 or pyodbc connection to the sink database, used by the
+    reader alone; `dialect` is "postgres" or "mssql". `changes` fetches rows
+    `chunk_rows` at a time from a server-side cursor, so a large backlog is
+    never held in memory, optionally only for some `destinations`. The
+    watermark only moves on `commit`, so a consumer that fails before
+    committing reads the same rows again.
+
+    Sequence numbers are drawn when a row is inserted, so rows written
+    concurrently on several connections (*_WRITER_CONNECTIONS > 1) can commit
+    out of seq order. Each read is therefore capped at `horizon`, below which
+    every row is committed, so the watermark never passes a row that becomes
+    visible later.
+    """
+
+    def __init__(self, conn, dialect, consumer, destinations=(), chunk_rows=10000):
+        if dialect not in DIALECTS:
+            raise ValueError(f"Unsupported dialect: {dialect}. Use one of {DIALECTS}")
+        if chunk_rows < 1:
+            raise ValueError(f"chunk_rows must be at least 1, got {chunk_rows}")
+        self.conn = conn
+        self.dialect = dialect
+        self.consumer = consumer
+        self.destinations = list(destinations)
+        self.chunk_rows = chunk_rows
+        # fingerprint -> schema JSON of compact envelopes
+        self._schemas = {}
+        self._dictionaries = {}
+        self._decoder = None
+        self._param = "%s" if dialect == "postgres" else "?"
+
+    def watermark(self):
+        """The last seq committed by this consumer, 0 if it never committed"""
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(f"SELECT seq FROM raw_events_consumers WHERE consumer = {self._param}", (self.consumer,))
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        self.conn.rollback()
+        return row[0] if row else 0
+
+    def horizon(self):
+        """
+        The highest seq whose transaction, and every earlier one's, has finished.
+
+        Writers hold SEQ_LOCK shared while their transaction draws sequence
+        numbers. Taking it exclusively waits for the transactions in flight;
+        every seq drawn up to then belongs to a committed or rolled back
+        transaction, and later ones draw higher numbers.
+        """
+        cursor = self.conn.cursor()
+        try:
+            if self.dialect == "postgres":
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (SEQ_LOCK,))
+                cursor.execute("SELECT CASE WHEN is_called THEN last_value ELSE last_value - 1 END FROM raw_events_seq")
+            else:
+                cursor.execute(
+                    "EXEC sp_getapplock @Resource = ?, @LockMode = 'Exclusive', @LockOwner = 'Transaction'", (SEQ_LOCK,)
+                )
+                cursor.execute(
+                    "SELECT CONVERT(BIGINT, ISNULL(last_used_value, 0)) FROM sys.sequences WHERE name = 'raw_events_seq'"
+                )
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+            # Releases the lock
+            self.conn.rollback()
+        return row[0] if row and row[0] is not None else 0
+
+    def commit(self, seq):
+        """Store `seq` as the consumer's watermark; the next `changes` starts after it"""
+        cursor = self.conn.cursor()
+        try:
+            if self.dialect == "postgres":
+                cursor.execute("""
+                INSERT INTO raw_events_consumers (consumer, seq) VALUES (%s, %s)
+                ON CONFLICT (consumer) DO UPDATE SET seq = EXCLUDED.seq, updated_at = CURRENT_TIMESTAMP
+                """, (self.consumer, seq))
+            else:
+                cursor.execute("""
+                UPDATE raw_events_consumers SET seq = ?, updated_at = GETDATE() WHERE consumer = ?;
+                IF @@ROWCOUNT = 0
+                    INSERT INTO raw_events_consumers (consumer, seq) VALUES (?, ?);
+                """, (seq, self.consumer, self.consumer, seq))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def _load_lookups(self):
+        """Read raw_schemas and raw_dictionaries; both are committed before the rows referencing them"""
+        schema_column = "schema::text" if self.dialect == "postgres" else "[schema]"
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(f"SELECT fingerprint, {schema_column} FROM raw_schemas")
+            self._schemas = dict(cursor.fetchall())
+            self._dictionaries = load_dictionaries(cursor)
+        finally:
+            cursor.close()
+        # Built on first use, zstandard is only needed for compressed payloads
+        self._decoder = None
+
+    def _query(self, after, horizon, limit):
+        """Return the SELECT of `changes` and its parameters"""
+        p = self._param
+        if self.dialect == "postgres":
+            columns = "seq, uuid::text, destination, key::text, value::text"
+        else:
+            columns = "seq, CONVERT(NVARCHAR(36), uuid), destination, [key], [value]"
+        columns += ", key_zstd, value_zstd, key_schema_id, value_schema_id, processed_at"
+        conditions = [f"seq > {p}", f"seq <= {p}"]
+        params = [after, horizon]
+        if self.destinations:
+            if self.dialect == "postgres":
+                conditions.append("destination = ANY(%s)")
+                params.append(self.destinations)
+            else:
+                conditions.append(f"destination IN ({', '.join('?' for _ in self.destinations)})")
+                params.extend(self.destinations)
+        top = f"TOP ({int(limit)}) " if limit is not None and self.dialect == "mssql" else ""
+        query = f"SELECT {top}{columns} FROM raw_events WHERE {' AND '.join(conditions)} ORDER BY seq"
+        if limit is not None and self.dialect == "postgres":
+            query += f" LIMIT {int(limit)}"
+        return query, params
+
+    def _decode(self, blob):
+        if self._decoder is None:
+            self._decoder = PayloadDecoder(self._dictionaries)
+        return self._decoder.decode(blob)
+
+    def _event(self, row):
+        seq, uuid, destination, key, value, key_zstd, value_zstd, key_schema_id, value_schema_id, processed_at = row
+        if key_zstd is not None:
+            key = self._decode(key_zstd)
+        if value_zstd is not None:
+            value = self._decode(value_zstd)
+        if key_schema_id is not None:
+            key = restore_envelope(key, self._schemas[key_schema_id])
+        if value_schema_id is not None:
+            value = restore_envelope(value, self._schemas[value_schema_id])
+        return RawEvent(seq, uuid, destination, key, value, processed_at)
+
+    def changes(self, after=None, limit=None):
+        """
+        Yield RawEvents with seq past `after` (the stored watermark by default), at most `limit`.
+
+        Only rows up to the `horizon` taken when the read starts are returned;
+        rows committed meanwhile are read by the next call.
+
+        The connection is busy until the generator is exhausted or closed, so
+        call `commit` afterwards. To commit as you go, read `limit` rows at a
+        time and commit the last seq of each round.
+        """
+        if after is None:
+            after = self.watermark()
+        horizon = self.horizon()
+        # After the horizon: schemas and dictionaries are committed before the rows using them
+        self._load_lookups()
+        query, params = self._query(after, horizon, limit)
+        if self.dialect == "postgres":
+            # A named cursor stays on the server and is fetched chunk by chunk
+            cursor = self.conn.cursor(name="dbz_reader")
+            cursor.itersize = self.chunk_rows
+        else:
+            # pyodbc's default forward-only cursor streams the result set
+            cursor = self.conn.cursor()
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(self.chunk_rows)
+                if not rows:
+                    break
+                for row in rows:
+                    yield self._event(row)
+        finally:
+            cursor.close()
+            # End the read transaction
+            self.conn.rollback()
+
+
+def connect(sink):
+    """Connect to a sink database with the POSTGRESQL_* / MSSQL_* variables of its handler"""
+    if sink == "postgres":
+        import psycopg2
+        return psycopg2.connect(
+            host=os.getenv("POSTGRESQL_HOST", "postgres"),
+            port=os.getenv("POSTGRESQL_PORT", 5432),
+            database=os.getenv("POSTGRESQL_DB", "postgres"),
+            user=os.getenv("POSTGRESQL_USER", "postgres"),
+            password=os.getenv("POSTGRESQL_PASSWORD", "postgres123AA"),
+        )
+    import pyodbc
+    conn = pyodbc.connect(
+        f"DRIVER={{ODBC Driver 18 for SQL Server}};"
+        f"SERVER={os.getenv('MSSQL_HOST', 'mssql')},{os.getenv('MSSQL_PORT', 1433)};"
+        f"DATABASE={os.getenv('MSSQL_DB', 'raw_db')};"
+        f"UID={os.getenv('MSSQL_USER', 'SA')};"
+        f"PWD={os.getenv('MSSQL_PASSWORD', 'mssql123AA')};"
+        "TrustServerCertificate=yes;"
+    )
+    conn.autocommit = False
+    return conn
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print raw_events past a consumer's watermark as JSON lines")
+    parser.add_argument("--sink", choices=DIALECTS, default="postgres",
+                        help="Database to read, configured by the handler's env vars")
+    parser.add_argument("--consumer", required=True, help="Name the watermark is stored under")
+    parser.add_argument("--destination", action="append", default=[],
+                        help="Only rows of this destination (topic name); repeat for several")
+    parser.add_argument("--after", type=int, default=None,
+                        help="Start after this seq instead of the stored watermark")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after this many rows")
+    parser.add_argument("--chunk-rows", type=int, default=10000, help="Rows fetched from the server at a time")
+    parser.add_argument("--commit", action="store_true",
+                        help="Store the seq of the last printed row as the consumer's watermark")
+    args = parser.parse_args(argv)
+
+    conn = connect(args.sink)
+    try:
+        reader = RawEventReader(
+            conn, args.sink, args.consumer, args.destination, args.chunk_rows
+        )
+        count = 0
+        last_seq = None
+        for event in reader.changes(args.after, args.limit):
+            sys.stdout.write(event.to_json() + "\n")
+            count += 1
+            last_seq = event.seq
+        sys.stdout.flush()
+        if args.commit and last_seq is not None:
+            reader.commit(last_seq)
+        print(f"Read {count} rows for consumer {args.consumer}, last seq {last_seq}", file=sys.stderr)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+from dbz_offsets import record_offset
+
+
+def _text(payload):
+    """A key or value as a Python str; empty payloads (tombstones, keyless tables) become None"""
+    if not payload:
+        return None
+    # A Java String crosses the bridge once here instead of on every use
+    return payload if isinstance(payload, str) else str(payload)
+
+
+class BatchEvent:
+    """
+    One record of a ChangeBatch, with the ChangeEvent methods.
+
+    Only created for code that wants record objects, e.g. sinks outside this
+    repository handed a batch by the fan-out; the handlers read the batch's
+    columns directly.
+    """
+    __slots__ = ("_batch", "_index")
+
+    def __init__(self, batch, index):
+        self._batch = batch
+        self._index = index
+
+    def destination(self):
+        return self._batch.destinations[self._index]
+
+    def key(self):
+        return self._batch.keys[self._index]
+
+    def value(self):
+        return self._batch.values[self._index]
+
+    def source_offset(self):
+        return self._batch.offset(self._index)
+
+
+class ChangeBatch:
+    """
+    An engine batch read into Python in one pass.
+
+    The engine's records are Java objects and every destination(), key() and
+    value() call crosses the JPype bridge and builds a new Python string. A
+    ChangeBatch calls each of them once per record and keeps the results in
+    three parallel lists, `destinations`, `keys` and `values`, with empty keys
+    and values as None. Source offsets are only needed for the records a write
+    commits with, so they are read from the Java record on first use.
+
+    The batch is also a sequence of ChangeEvent-like records (see BatchEvent),
+    so it can be handed to any handler in place of the engine's list.
+    """
+    __slots__ = ("destinations", "keys", "values", "_records", "_offsets")
+    _UNREAD = object()
+
+    def __init__(self, records):
+        self._records = records if isinstance(records, list) else list(records)
+        self.destinations = []
+        self.keys = []
+        self.values = []
+        destinations_append = self.destinations.append
+        keys_append = self.keys.append
+        values_append = self.values.append
+        for record in self._records:
+            destinations_append(str(record.destination()))
+            keys_append(_text(record.key()))
+            values_append(_text(record.value()))
+        self._offsets = [self._UNREAD] * len(self._records)
+
+    def __len__(self):
+        return len(self.destinations)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [BatchEvent(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("ChangeBatch index out of range")
+        return BatchEvent(self, index)
+
+    def __iter__(self):
+        return (BatchEvent(self, index) for index in range(len(self)))
+
+    def offset(self, index):
+        """(source partition JSON, source offset JSON) of a record, or None; see `record_offset`"""
+        offset = self._offsets[index]
+        if offset is self._UNREAD:
+            offset = self._offsets[index] = record_offset(self._records[index])
+        return offset
+
+
+def read_batch(records):
+    """Return `records` as a ChangeBatch; a ChangeBatch (e.g. from the fan-out) is returned as is"""
+    if isinstance(records, ChangeBatch):
+        return records
+    return ChangeBatch(records)
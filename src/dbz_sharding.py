@@ -0,0 +1,118 @@
+import queue
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """
+    A fixed set of database connections created up front by `connect`.
+
+    `connection()` checks one out for the duration of a `with` block; callers
+    block while every connection is in use. A checked out connection that
+    broke can be swapped for a new one with `reconnect`.
+    """
+
+    def __init__(self, connect, size):
+        if size < 1:
+            raise ValueError(f"Pool size must be at least 1, got {size}")
+        self.size = size
+        self._connect = connect
+        self._connections = [connect() for _ in range(size)]
+        # Idle slots; a slot keeps its place when its connection is replaced
+        self._idle = queue.LifoQueue()
+        for index in range(size):
+            self._idle.put(index)
+
+    @contextmanager
+    def connection(self):
+        index = self._idle.get()
+        try:
+            yield self._connections[index]
+        finally:
+            self._idle.put(index)
+
+    def reconnect(self, conn):
+        """Replace `conn`, which the caller has checked out, with a new connection and return it"""
+        index = self._connections.index(conn)
+        replacement = self._connect()
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._connections[index] = replacement
+        return replacement
+
+    def close(self):
+        for conn in self._connections:
+            try:
+                conn.close()
+            except Exception as e:
+                print(f"Error closing pooled connection: {str(e)}")
+        self._connections = []
+
+
+class ShardedWriter:
+    """
+    Splits a batch into shards and writes them concurrently, one connection each.
+
+    Rows are assigned to a shard by destination, or by destination and record
+    key when `shard_by_key` is set, using a stable hash. A row without a key (a
+    truncate, or a table without a primary key) applies to the whole table, so
+    a destination with such a row in the batch is routed by destination alone.
+    Every change to a given key therefore goes to the same shard in its
+    original order, after or before its table's truncates, and `write` only
+    returns once every shard has committed, so batches never overlap and per-key
+    ordering holds across batches. If any shard fails, the error is raised after
+    the other shards finish; shards that did commit will be written again when
+    the engine replays the batch.
+
+    `write_fn(rows, conn)` must write and commit `rows` on `conn`. `destination`
+    and `key` pick the routing fields out of a row.
+    """
+
+    def __init__(self, write_fn, pool, destination, key, shard_by_key=False):
+        self._write_fn = write_fn
+        self._pool = pool
+        self._destination = destination
+        self._key = key
+        self._shard_by_key = shard_by_key
+        self._executor = ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix="dbz-shard")
+
+    def _shard_of(self, row, unkeyed=()):
+        destination = self._destination(row)
+        routing = (destination or "").encode("utf-8")
+        if self._shard_by_key and destination not in unkeyed:
+            key = self._key(row) or b""
+            # Keys are bytes when payloads are compressed
+            routing += b"\0" + (key if isinstance(key, bytes) else key.encode("utf-8"))
+        return zlib.crc32(routing) % self._pool.size
+
+    def split(self, rows):
+        """Group rows by shard, keeping their relative order"""
+        # Destinations with a keyless row stay in one shard
+        unkeyed = {self._destination(row) for row in rows if self._key(row) is None} if self._shard_by_key else ()
+        shards = {}
+        for row in rows:
+            shards.setdefault(self._shard_of(row, unkeyed), []).append(row)
+        return list(shards.values())
+
+    def _write_shard(self, rows):
+        with self._pool.connection() as conn:
+            self._write_fn(rows, conn)
+
+    def write(self, rows):
+        """Write all shards of a batch concurrently and wait for every commit"""
+        shards = self.split(rows)
+        if len(shards) == 1:
+            self._write_shard(shards[0])
+            return
+        futures = [self._executor.submit(self._write_shard, shard) for shard in shards]
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._pool.close()
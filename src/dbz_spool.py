@@ -0,0 +1,293 @@
+import base64
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Every frame is [payload length][crc32 of the payload][payload]
+FRAME_HEADER = struct.Struct("!II")
+SEGMENT_SUFFIX = ".seg"
+POSITION_FILE = "position.json"
+_BYTES_KEY = "$base64"
+
+
+def _encode_bytes(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {_BYTES_KEY: base64.b64encode(bytes(value)).decode("ascii")}
+    raise TypeError(f"Cannot spool {type(value).__name__}")
+
+
+def _decode_bytes(document):
+    if len(document) == 1 and _BYTES_KEY in document:
+        return base64.b64decode(document[_BYTES_KEY])
+    return document
+
+
+def encode_json(document):
+    """Serialize a document for the spool; bytes values (e.g. compressed payloads) survive the round trip"""
+    return json.dumps(document, default=_encode_bytes).encode("utf-8")
+
+
+def decode_json(payload):
+    """Inverse of `encode_json`"""
+    return json.loads(payload, object_hook=_decode_bytes)
+
+
+class SpoolFrame:
+    """A frame read from the spool; pass it to `Spool.ack` once it has been loaded"""
+    __slots__ = ("segment", "end", "payload")
+
+    def __init__(self, segment, end, payload):
+        self.segment = segment
+        self.end = end
+        self.payload = payload
+
+
+class Spool:
+    """
+    An append-only, segmented on-disk queue of batches.
+
+    Frames are appended to numbered segment files in `directory`; a new segment
+    is started once the current one reaches `segment_bytes`. The reader maps
+    segments with mmap, hands out one frame at a time and only moves its
+    position (persisted in position.json) when the frame is acknowledged, so a
+    crash re-delivers the unacknowledged frame. Segments are deleted once every
+    frame in them has been acknowledged. A frame torn by a crash while being
+    appended is cut off when the spool is reopened.
+
+    With `fsync` every append is flushed to disk before it returns, so an
+    appended batch survives a crash of the process or the host.
+    """
+
+    def __init__(self, directory, segment_bytes, fsync=True):
+        if segment_bytes < FRAME_HEADER.size + 1:
+            raise ValueError(f"Segment size too small: {segment_bytes}")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._appended = threading.Condition(self._lock)
+        os.makedirs(directory, exist_ok=True)
+
+        segments = self._segments()
+        self._read_segment, self._read_offset = self._load_position(segments)
+        # Keep numbering after the reader even when every segment was drained and removed
+        self._write_segment = max(segments[-1] if segments else 1, self._read_segment)
+        self._truncate_torn_frame(self._write_segment)
+        self._file = open(self._path(self._write_segment), "ab")
+        self._map = None
+        self._map_segment = None
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def _segments(self):
+        return sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit()
+        )
+
+    def _truncate_torn_frame(self, segment):
+        """Cut the segment after its last complete frame"""
+        path = self._path(segment)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + FRAME_HEADER.size <= len(data):
+            length, crc = FRAME_HEADER.unpack_from(data, offset)
+            end = offset + FRAME_HEADER.size + length
+            if end > len(data) or zlib.crc32(data[offset + FRAME_HEADER.size:end]) != crc:
+                break
+            offset = end
+        if offset < len(data):
+            print(f"Spool: dropping {len(data) - offset} bytes of a torn frame in {path}")
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+
+    def _load_position(self, segments):
+        try:
+            with open(os.path.join(self.directory, POSITION_FILE)) as f:
+                position = json.load(f)
+            segment, offset = position["segment"], position["offset"]
+        except (OSError, ValueError, KeyError):
+            segment, offset = (segments[0] if segments else 1), 0
+        if segments and segment < segments[0]:
+            segment, offset = segments[0], 0
+        return segment, offset
+
+    def _save_position(self):
+        path = os.path.join(self.directory, POSITION_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"segment": self._read_segment, "offset": self._read_offset}, f)
+        os.replace(path + ".tmp", path)
+
+    def append(self, payload):
+        """Append one frame (bytes) to the current segment, starting a new one when it is full"""
+        frame = FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._file.tell() > 0 and self._file.tell() + len(frame) > self.segment_bytes:
+                self._file.close()
+                self._write_segment += 1
+                self._file = open(self._path(self._write_segment), "ab")
+            self._file.write(frame)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._appended.notify_all()
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+        self._map = None
+        self._map_segment = None
+
+    def _mapped(self, segment, end):
+        """Return an mmap of `segment` covering at least `end` bytes, or None if the file is shorter"""
+        if self._map_segment != segment or len(self._map) < end:
+            self._unmap()
+            with open(self._path(segment), "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if size < end:
+                    return None
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._map_segment = segment
+        return self._map
+
+    def peek(self, timeout=None, after=None):
+        """
+        Return the next unacknowledged SpoolFrame, waiting up to `timeout` seconds.
+
+        With `after`, return the frame following that one instead, so a reader
+        can collect several frames and acknowledge only the last. Returns None
+        if nothing was appended in time. Only one thread may read.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            if after is None:
+                segment, offset = self._read_segment, self._read_offset
+            else:
+                segment, offset = after.segment, after.end
+            while True:
+                mapped = self._mapped(segment, offset + FRAME_HEADER.size) \
+                    if os.path.exists(self._path(segment)) else None
+                if mapped is not None:
+                    break
+                if segment < self._write_segment:
+                    if after is not None:
+                        # Read ahead into the next segment; it is removed by `ack`
+                        segment, offset = segment + 1, 0
+                        continue
+                    # Everything in the segment was acknowledged
+                    self._unmap()
+                    self._read_segment, self._read_offset = segment + 1, 0
+                    self._save_position()
+                    self._remove(segment)
+                    segment, offset = self._read_segment, self._read_offset
+                    continue
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._appended.wait(remaining)
+
+            start = offset + FRAME_HEADER.size
+            length, crc = FRAME_HEADER.unpack_from(mapped, offset)
+            mapped = self._mapped(segment, start + length)
+            if mapped is None:
+                raise RuntimeError(f"Spool segment {segment} ends inside a frame")
+            payload = mapped[start:start + length]
+            if zlib.crc32(payload) != crc:
+                raise RuntimeError(f"Spool segment {segment} is corrupt at offset {offset}")
+            return SpoolFrame(segment, start + length, payload)
+
+    def _remove(self, segment):
+        try:
+            os.remove(self._path(segment))
+        except FileNotFoundError:
+            pass
+
+    def ack(self, frame):
+        """Mark `frame`, and every frame before it, as loaded; the reader moves past it"""
+        with self._lock:
+            finished = self._read_segment
+            self._read_segment, self._read_offset = frame.segment, frame.end
+            self._save_position()
+            # Frames read ahead with `after` may have crossed segments
+            if finished < frame.segment:
+                if self._map_segment is not None and self._map_segment < frame.segment:
+                    self._unmap()
+                for segment in range(finished, frame.segment):
+                    self._remove(segment)
+
+    def pending_bytes(self):
+        """Bytes appended but not yet acknowledged"""
+        with self._lock:
+            total = 0
+            for segment in self._segments():
+                if segment >= self._read_segment:
+                    total += os.path.getsize(self._path(segment))
+            return max(total - self._read_offset, 0)
+
+    def close(self):
+        with self._lock:
+            self._unmap()
+            self._file.close()
+
+
+class SpoolDrainer:
+    """
+    Loads spooled batches into the sink from a dedicated thread.
+
+    `load_fn(payload)` must write and commit one frame's batch. A failure is
+    retried with exponential backoff (capped at `max_backoff` seconds) until it
+    succeeds, so the sink can be slow or down for a while without losing or
+    reordering batches; the capture side keeps appending to the spool meanwhile.
+    `on_error(exception, attempt)` is called for every failed attempt.
+    """
+
+    def __init__(self, spool, load_fn, name="dbz-spool-drainer", max_backoff=60.0, on_error=None):
+        self.spool = spool
+        self._load_fn = load_fn
+        self._max_backoff = max_backoff
+        self._on_error = on_error
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            frame = self.spool.peek(timeout=1.0)
+            if frame is None:
+                continue
+            attempt = 0
+            while True:
+                try:
+                    self._load_fn(frame.payload)
+                    break
+                except Exception as e:
+                    attempt += 1
+                    if self._on_error is not None:
+                        self._on_error(e, attempt)
+                    if self._stop.wait(min(2 ** (attempt - 1), self._max_backoff)):
+                        return
+            self.spool.ack(frame)
+
+    def drain(self, timeout=None):
+        """Wait until every appended frame has been loaded; returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.spool.pending_bytes() > 0:
+            if not self._thread.is_alive() or (deadline is not None and time.monotonic() > deadline):
+                return False
+            time.sleep(0.1)
+        return True
+
+    def close(self):
+        """Stop after the frame being loaded; frames left in the spool are loaded on the next start"""
+        self._stop.set()
+        self._thread.join()
+        self.spool.close()
@@ -0,0 +1,77 @@
+import pytest
+
+from dbz_batching import AdaptiveBatchSizer
+
+
+def _sizer(**kwargs):
+    options = dict(target_seconds=1.0, min_rows=100, max_rows=1000, max_bytes=10_000,
+                   initial_rows=200, increase_rows=100)
+    options.update(kwargs)
+    return AdaptiveBatchSizer(**options)
+
+
+def test_limits_start_at_the_initial_rows():
+    assert _sizer().limits("dwh.T") == (200, 10_000)
+
+
+def test_fast_full_batches_grow_the_limit_additively():
+    sizer = _sizer()
+    sizer.observe("dwh.T", 200, 1_000, 0.1)
+    sizer.observe("dwh.T", 300, 1_000, 0.1)
+    assert sizer.limits("dwh.T")[0] == 400
+
+
+def test_partial_batches_leave_the_limit_alone():
+    sizer = _sizer()
+    sizer.observe("dwh.T", 50, 1_000, 0.1)
+    assert sizer.limits("dwh.T")[0] == 200
+    assert sizer.snapshot() == {}
+
+
+def test_batches_cut_by_the_byte_cap_do_not_grow_the_limit():
+    sizer = _sizer()
+    sizer.observe("dwh.T", 200, 10_000, 0.1)
+    assert sizer.limits("dwh.T")[0] == 200
+
+
+def test_slow_batches_shrink_the_limit_multiplicatively():
+    sizer = _sizer(initial_rows=800)
+    sizer.observe("dwh.T", 10, 1_000, 2.0)
+    assert sizer.limits("dwh.T")[0] == 400
+    sizer.observe("dwh.T", 10, 1_000, 2.0)
+    sizer.observe("dwh.T", 10, 1_000, 2.0)
+    assert sizer.limits("dwh.T")[0] == 100
+
+
+def test_limit_stays_within_bounds():
+    sizer = _sizer(initial_rows=950)
+    sizer.observe("dwh.T", 950, 1_000, 0.1)
+    sizer.observe("dwh.T", 1000, 1_000, 0.1)
+    assert sizer.limits("dwh.T")[0] == 1000
+
+
+def test_destinations_are_sized_separately():
+    changes = []
+    sizer = _sizer(on_change=lambda destination, rows: changes.append((destination, rows)))
+    sizer.observe("dwh.NARROW", 200, 1_000, 0.1)
+    sizer.observe("dwh.WIDE", 10, 9_000, 3.0)
+    assert sizer.snapshot() == {"dwh.NARROW": 300, "dwh.WIDE": 100}
+    assert changes == [("dwh.NARROW", 300), ("dwh.WIDE", 100)]
+
+
+def test_unchanged_limit_is_not_reported():
+    changes = []
+    sizer = _sizer(initial_rows=100, on_change=lambda destination, rows: changes.append(rows))
+    sizer.observe("dwh.T", 10, 1_000, 2.0)
+    assert changes == []
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"decrease_factor": 1.0},
+    {"decrease_factor": 0},
+    {"min_rows": 0},
+    {"min_rows": 2000},
+])
+def test_invalid_settings_are_rejected(kwargs):
+    with pytest.raises(ValueError):
+        _sizer(**kwargs)
@@ -0,0 +1,148 @@
+import json
+
+import pytest
+
+from dbz_envelope import (
+    SchemaCompactor, coalesce_changes, flat_table_name, parse_change, parse_include_list,
+    restore_envelope, schema_fingerprint, snapshot_phase, source_ts_ms,
+)
+
+VALUE_SCHEMA = {
+    "type": "struct",
+    "fields": [
+        {"field": "before", "type": "struct", "fields": [{"field": "ID", "type": "int32"}]},
+        {"field": "after", "type": "struct", "fields": [
+            {"field": "ID", "type": "int32"},
+            {"field": "NAME", "type": "string"},
+        ]},
+    ],
+}
+
+
+def _value(op, after=None, before=None, snapshot="false", table="CUSTOMERS", schema=None):
+    envelope = {
+        "before": before,
+        "after": after,
+        "source": {"schema": "DBZUSER", "table": table, "snapshot": snapshot, "ts_ms": 1700000000000, "scn": "100"},
+        "op": op,
+        "ts_ms": 1700000000500,
+    }
+    if schema is not None:
+        envelope = {"schema": schema, "payload": envelope}
+    return json.dumps(envelope, separators=(",", ":"))
+
+
+def _key(identifier):
+    return json.dumps({"ID": identifier})
+
+
+def test_parse_include_list():
+    assert parse_include_list(" dbzuser.customers, ,HR.Jobs ") == {"DBZUSER.CUSTOMERS", "HR.JOBS"}
+
+
+@pytest.mark.parametrize("source_table, expected", [
+    ("C##DBZUSER.CUSTOMERS", "c__dbzuser__customers"),
+    ("HR.CUSTOMERS", "hr__customers"),
+    ("SALES.CUSTOMERS", "sales__customers"),
+    ("ORDERS", "orders"),
+])
+def test_flat_table_name_keeps_the_schema(source_table, expected):
+    assert flat_table_name(source_table) == expected
+
+
+def test_source_ts_ms():
+    assert source_ts_ms(_value("c", after={"ID": 1})) == 1700000000000
+    assert source_ts_ms(_value("c", after={"ID": 1}, schema=VALUE_SCHEMA)) == 1700000000000
+    assert source_ts_ms(None) is None
+    assert source_ts_ms(b"\x28\xb5\x2f\xfd") is None
+    assert source_ts_ms("not json") is None
+
+
+@pytest.mark.parametrize("value, expected", [
+    (_value("r", after={"ID": 1}, snapshot="first"), "first"),
+    (_value("r", after={"ID": 1}, snapshot="true"), "read"),
+    (_value("r", after={"ID": 1}, snapshot="last"), "last"),
+    (_value("r", after={"ID": 1}, snapshot="incremental"), None),
+    (_value("c", after={"ID": 1}), None),
+    # Columns named like the envelope's fields
+    (_value("c", after={"op": "r", "snapshot": "first"}), None),
+    (_value("r", after={"snapshot": "last"}, snapshot="true"), "read"),
+    (None, None),
+    (b"\x28\xb5\x2f\xfd", None),
+])
+def test_snapshot_phase(value, expected):
+    assert snapshot_phase(value) == expected
+
+
+def test_schema_fingerprint_ignores_key_order_and_whitespace():
+    reordered = json.loads(json.dumps(VALUE_SCHEMA), object_pairs_hook=lambda pairs: dict(reversed(pairs)))
+    assert schema_fingerprint(reordered) == schema_fingerprint(VALUE_SCHEMA)
+    assert len(schema_fingerprint(VALUE_SCHEMA)) == 64
+    assert schema_fingerprint({"type": "string"}) != schema_fingerprint(VALUE_SCHEMA)
+
+
+def test_compactor_strips_the_schema_and_restores_it():
+    compactor = SchemaCompactor()
+    document = _value("c", after={"ID": 1, "NAME": "a"}, schema=VALUE_SCHEMA)
+    payload, fingerprint = compactor.compact(document)
+    assert json.loads(payload) == json.loads(document)["payload"]
+    assert fingerprint == schema_fingerprint(VALUE_SCHEMA)
+    assert restore_envelope(payload, compactor.schemas[fingerprint]) == document
+
+    # The second document takes the cached fast path
+    second = _value("u", after={"ID": 1, "NAME": "b"}, schema=VALUE_SCHEMA)
+    assert compactor.compact(second) == (second[second.index(',"payload":') + 11:-1], fingerprint)
+    assert list(compactor.schemas) == [fingerprint]
+
+
+def test_compactor_passes_documents_without_a_schema_through():
+    compactor = SchemaCompactor()
+    document = _value("c", after={"ID": 1})
+    assert compactor.compact(document) == (document, None)
+    assert compactor.compact(None) == (None, None)
+    # A tombstone's null payload
+    assert compactor.compact('{"schema":{"type":"string"},"payload":null}')[0] is None
+
+
+def test_parse_change_uses_the_schema_for_column_types():
+    change = parse_change(_key(1), _value("c", after={"ID": 1, "NAME": "a"}, schema=VALUE_SCHEMA))
+    assert change.table == "DBZUSER.CUSTOMERS"
+    assert change.key_values == (1,)
+    assert change.row == {"ID": 1, "NAME": "a"}
+    assert change.field_types == {"ID": ("int32", None), "NAME": ("string", None)}
+
+
+def test_parse_change_skips_other_tables_keyless_events_and_tombstones():
+    value = _value("c", after={"ID": 1})
+    assert parse_change(_key(1), value, tables={"HR.JOBS"}) is None
+    assert parse_change(None, value) is None
+    assert parse_change(_key(1), None) is None
+
+
+def test_coalesce_changes_keeps_the_final_state_per_key():
+    changes = [
+        parse_change(_key(1), _value("c", after={"ID": 1, "NAME": "a"})),
+        parse_change(_key(2), _value("c", after={"ID": 2, "NAME": "b"})),
+        parse_change(_key(1), _value("u", after={"ID": 1, "NAME": "c"})),
+        parse_change(_key(1), _value("d", before={"ID": 1})),
+    ]
+    truncated, table_changes = coalesce_changes(changes)["DBZUSER.CUSTOMERS"]
+    assert not truncated
+    assert [(change.key_values, change.op, change.row) for change in table_changes] == [
+        ((2,), "c", {"ID": 2, "NAME": "b"}),
+        ((1,), "d", None),
+    ]
+
+
+def test_truncate_drops_earlier_changes_of_its_table():
+    changes = [
+        parse_change(_key(1), _value("c", after={"ID": 1})),
+        parse_change(_key(1), _value("c", after={"ID": 1}, table="ORDERS")),
+        parse_change(None, _value("t")),
+        parse_change(_key(2), _value("c", after={"ID": 2})),
+    ]
+    by_table = coalesce_changes(changes)
+    truncated, table_changes = by_table["DBZUSER.CUSTOMERS"]
+    assert truncated
+    assert [change.key_values for change in table_changes] == [(2,)]
+    assert by_table["DBZUSER.ORDERS"][0] is False
@@ -0,0 +1,98 @@
+import json
+import uuid
+
+import pytest
+
+from dbz_event_id import EventIdGenerator
+
+
+def _value(after, op="r", delivered_ms=1700000000500, **source):
+    envelope = {
+        "before": None,
+        "after": after,
+        "source": {"scn": "1000", "commit_scn": None, "txId": None, "rs_id": None, "ssn": 0, **source},
+        "op": op,
+        "ts_ms": delivered_ms,
+    }
+    return json.dumps(envelope)
+
+
+def test_unknown_strategy_or_layout_is_rejected():
+    with pytest.raises(ValueError):
+        EventIdGenerator("uuid1")
+    with pytest.raises(ValueError):
+        EventIdGenerator("uuid7", layout="oracle")
+
+
+def test_uuid4_ids_are_random():
+    generator = EventIdGenerator("uuid4")
+    first = generator.new_id("dwh.T", None, None)
+    assert uuid.UUID(first).version == 4
+    assert first != generator.new_id("dwh.T", None, None)
+    assert not generator.deduplicates
+
+
+def test_uuid7_ids_are_monotonic():
+    generator = EventIdGenerator("uuid7")
+    ids = [generator.new_id("dwh.T", None, None) for _ in range(5000)]
+    assert all(uuid.UUID(event_id).version == 7 for event_id in ids)
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+
+
+def test_mssql_layout_puts_the_ordered_bytes_last():
+    generator = EventIdGenerator("uuid7", layout="mssql")
+    ids = [uuid.UUID(generator.new_id("dwh.T", None, None)).bytes for _ in range(1000)]
+    # SQL Server compares bytes 10-15, then 8-9
+    ordered = [event_id[10:16] + event_id[8:10] for event_id in ids]
+    assert ordered == sorted(ordered)
+
+
+def test_source_ids_repeat_for_a_replayed_event():
+    generator = EventIdGenerator("source")
+    key = '{"ID":1}'
+    first = generator.new_id("dwh.T", key, _value({"ID": 1}, op="c", delivered_ms=1))
+    replayed = generator.new_id("dwh.T", key, _value({"ID": 1}, op="c", delivered_ms=2))
+    assert first == replayed
+    assert generator.deduplicates
+
+
+def test_source_ids_are_ordered_by_commit_scn():
+    generator = EventIdGenerator("source")
+    ids = [
+        generator.new_id("dwh.T", '{"ID":1}', _value({"ID": 1}, op="c", commit_scn=str(scn)))
+        for scn in (5, 900, 70000)
+    ]
+    assert ids == sorted(ids)
+    assert uuid.UUID(ids[0]).bytes[:8] == (5).to_bytes(8, "big")
+
+
+def test_source_ids_differ_for_different_rows_at_the_same_position():
+    generator = EventIdGenerator("source")
+    key = '{"ID":1}'
+    assert generator.new_id("dwh.T", key, _value({"ID": 1, "A": 1})) != generator.new_id("dwh.T", key, _value({"ID": 1, "A": 2}))
+
+
+def test_keyless_snapshot_rows_get_distinct_ids():
+    generator = EventIdGenerator("source")
+    # Same table, same snapshot SCN, no txId/rs_id and identical rows
+    ids = {generator.new_id("dwh.T", None, _value({"A": 1})) for _ in range(3)}
+    ids.add(generator.new_id("dwh.T", None, _value({"A": 2})))
+    assert len(ids) == 4
+    assert all(uuid.UUID(event_id).version == 7 for event_id in ids)
+
+
+def test_keyless_events_with_a_row_id_keep_source_ids():
+    generator = EventIdGenerator("source")
+    first = generator.new_id("dwh.T", None, _value({"A": 1}, op="c", delivered_ms=1, row_id="AAAR3sAAEAAAACXAAA"))
+    replayed = generator.new_id("dwh.T", None, _value({"A": 1}, op="c", delivered_ms=2, row_id="AAAR3sAAEAAAACXAAA"))
+    assert first == replayed
+    other = generator.new_id("dwh.T", None, _value({"A": 1}, op="c", row_id="AAAR3sAAEAAAACXAAB"))
+    assert other != first
+
+
+def test_events_without_a_source_position_fall_back_to_uuid7():
+    generator = EventIdGenerator("source")
+    assert uuid.UUID(generator.new_id("dwh.T", '{"ID":1}', None)).version == 7
+    assert uuid.UUID(generator.new_id("dwh.T", '{"ID":1}', json.dumps({"op": "c"}))).version == 7
+    assert uuid.UUID(generator.new_id("dwh.T", '{"ID":1}', _value({"ID": 1}, scn=None))).version == 7
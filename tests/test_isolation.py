@@ -0,0 +1,142 @@
+import pytest
+
+import dbz_isolation
+from dbz_isolation import BatchBisector, TransientRetry, describe_error, payload_bytes, MAX_ERROR_CHARS
+
+
+class PoisonError(Exception):
+    pass
+
+
+class SinkDown(Exception):
+    pass
+
+
+def _row(index):
+    return (f"id-{index}", "dwh.T", f'{{"ID":{index}}}', f'{{"after":{index}}}', None, None)
+
+
+class RecordingSink:
+    """Fails every write containing a row listed in `bad`, keeps the rest"""
+
+    def __init__(self, bad=()):
+        self.bad = set(bad)
+        self.written = []
+        self.writes = []
+        self.committed = []
+        self.dead_letters = []
+
+    def write(self, rows, offset):
+        self.writes.append((len(rows), offset))
+        if any(row[0] in self.bad for row in rows):
+            raise PoisonError("value too long")
+        self.written.extend(rows)
+        self.committed.append((len(rows), offset))
+
+    def dead_letter(self, failures, offset):
+        self.dead_letters.extend((row, error, offset) for row, error in failures)
+
+
+def _bisector():
+    return BatchBisector(lambda error: isinstance(error, PoisonError))
+
+
+def test_clean_batch_is_written_once():
+    sink = RecordingSink()
+    rows = [_row(i) for i in range(8)]
+    assert _bisector().write(rows, sink.write, sink.dead_letter, "offset") == 0
+    assert sink.writes == [(8, "offset")]
+
+
+def test_bad_records_are_isolated_and_the_rest_written_in_order():
+    rows = [_row(i) for i in range(16)]
+    sink = RecordingSink(bad={"id-3", "id-11"})
+    assert _bisector().write(rows, sink.write, sink.dead_letter, "offset") == 2
+    assert [row[0] for row, _, _ in sink.dead_letters] == ["id-3", "id-11"]
+    assert all(error == "PoisonError: value too long" for _, error, _ in sink.dead_letters)
+    assert sink.written == [row for row in rows if row[0] not in sink.bad]
+
+
+def test_offset_goes_with_the_last_record_only():
+    rows = [_row(i) for i in range(4)]
+    sink = RecordingSink(bad={"id-0"})
+    _bisector().write(rows, sink.write, sink.dead_letter, "offset")
+    assert sink.committed == [(1, None), (2, "offset")]
+    assert sink.dead_letters[0][2] is None
+
+
+def test_offset_is_stored_with_a_dead_lettered_last_record():
+    rows = [_row(i) for i in range(4)]
+    sink = RecordingSink(bad={"id-3"})
+    _bisector().write(rows, sink.write, sink.dead_letter, "offset")
+    assert sink.committed == [(2, None), (1, None)]
+    assert sink.dead_letters[0][2] == "offset"
+
+
+def test_sink_errors_are_raised_without_dead_lettering():
+    sink = RecordingSink()
+
+    def write(rows, offset):
+        raise SinkDown("connection lost")
+
+    with pytest.raises(SinkDown):
+        _bisector().write([_row(i) for i in range(4)], write, sink.dead_letter)
+    assert sink.dead_letters == []
+
+
+def test_empty_batch_is_not_written():
+    sink = RecordingSink()
+    assert _bisector().write([], sink.write, sink.dead_letter) == 0
+    assert sink.writes == []
+
+
+def test_transient_errors_are_retried(monkeypatch):
+    monkeypatch.setattr(dbz_isolation.time, "sleep", lambda seconds: None)
+    attempts = []
+    retried = []
+
+    def write():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise SinkDown("connection lost")
+        return "done"
+
+    retry = TransientRetry(lambda error: isinstance(error, SinkDown), retries=3, on_retry=lambda e, n: retried.append(n))
+    assert retry(write) == "done"
+    assert retried == [1, 2]
+
+
+def test_retries_are_limited(monkeypatch):
+    monkeypatch.setattr(dbz_isolation.time, "sleep", lambda seconds: None)
+    attempts = []
+
+    def write():
+        attempts.append(1)
+        raise SinkDown("connection lost")
+
+    with pytest.raises(SinkDown):
+        TransientRetry(lambda error: isinstance(error, SinkDown), retries=2)(write)
+    assert len(attempts) == 3
+
+
+def test_other_errors_are_not_retried():
+    attempts = []
+
+    def write():
+        attempts.append(1)
+        raise PoisonError("bad value")
+
+    with pytest.raises(PoisonError):
+        TransientRetry(lambda error: isinstance(error, SinkDown))(write)
+    assert len(attempts) == 1
+
+
+def test_describe_error_is_capped():
+    assert len(describe_error(ValueError("x" * (2 * MAX_ERROR_CHARS)))) == MAX_ERROR_CHARS
+
+
+def test_payload_bytes_keeps_lone_surrogates():
+    assert payload_bytes(None) is None
+    assert payload_bytes(b"\x01") == b"\x01"
+    assert payload_bytes("café") == "café".encode("utf-8")
+    assert payload_bytes("\ud800") == b"\xed\xa0\x80"
@@ -0,0 +1,124 @@
+import os
+import threading
+
+from dbz_spool import Spool, SpoolDrainer, encode_json, decode_json, FRAME_HEADER, SEGMENT_SUFFIX
+
+
+def _segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+
+
+def test_encode_json_round_trips_bytes():
+    document = {"rows": [["id", "dest", b"\x00\xff", "text", None]], "offset": None}
+    assert decode_json(encode_json(document)) == document
+
+
+def test_frames_are_read_in_order_and_acknowledged(tmp_path):
+    spool = Spool(str(tmp_path), 1024)
+    for payload in (b"one", b"two", b"three"):
+        spool.append(payload)
+    first = spool.peek(timeout=0)
+    assert first.payload == b"one"
+    # Not acknowledged yet: the same frame again
+    assert spool.peek(timeout=0).payload == b"one"
+    spool.ack(first)
+    assert spool.peek(timeout=0).payload == b"two"
+    spool.close()
+
+
+def test_unacknowledged_frames_are_redelivered_after_reopening(tmp_path):
+    spool = Spool(str(tmp_path), 1024)
+    spool.append(b"one")
+    spool.append(b"two")
+    spool.ack(spool.peek(timeout=0))
+    spool.close()
+
+    spool = Spool(str(tmp_path), 1024)
+    assert spool.peek(timeout=0).payload == b"two"
+    spool.close()
+
+
+def test_peek_returns_none_when_empty(tmp_path):
+    spool = Spool(str(tmp_path), 1024)
+    assert spool.peek(timeout=0) is None
+    assert spool.pending_bytes() == 0
+    spool.close()
+
+
+def test_segments_roll_over_and_are_removed_once_acknowledged(tmp_path):
+    payload = b"x" * 40
+    # Room for two frames per segment
+    spool = Spool(str(tmp_path), 2 * (FRAME_HEADER.size + len(payload)))
+    for _ in range(5):
+        spool.append(payload)
+    assert len(_segments(tmp_path)) == 3
+    assert spool.pending_bytes() == 5 * (FRAME_HEADER.size + len(payload))
+
+    for _ in range(5):
+        frame = spool.peek(timeout=0)
+        assert frame.payload == payload
+        spool.ack(frame)
+    assert spool.peek(timeout=0) is None
+    assert spool.pending_bytes() == 0
+    # Only the segment still being written to is left
+    assert len(_segments(tmp_path)) == 1
+    spool.close()
+
+
+def test_read_ahead_across_segments_is_acknowledged_at_once(tmp_path):
+    payload = b"y" * 40
+    spool = Spool(str(tmp_path), FRAME_HEADER.size + len(payload))
+    for index in range(3):
+        spool.append(payload + bytes([index]))
+    frames = [spool.peek(timeout=0)]
+    while True:
+        frame = spool.peek(timeout=0, after=frames[-1])
+        if frame is None:
+            break
+        frames.append(frame)
+    assert [frame.payload[-1] for frame in frames] == [0, 1, 2]
+    spool.ack(frames[-1])
+    assert spool.pending_bytes() == 0
+    assert len(_segments(tmp_path)) == 1
+    spool.close()
+
+
+def test_torn_frame_is_cut_off_when_reopened(tmp_path):
+    spool = Spool(str(tmp_path), 1024)
+    spool.append(b"complete")
+    spool.close()
+    segment = os.path.join(tmp_path, _segments(tmp_path)[-1])
+    with open(segment, "ab") as f:
+        # A header promising more bytes than were written
+        f.write(FRAME_HEADER.pack(100, 0) + b"torn")
+
+    spool = Spool(str(tmp_path), 1024)
+    frame = spool.peek(timeout=0)
+    assert frame.payload == b"complete"
+    spool.ack(frame)
+    assert spool.peek(timeout=0) is None
+    spool.append(b"next")
+    assert spool.peek(timeout=0).payload == b"next"
+    spool.close()
+
+
+def test_drainer_retries_a_failing_load_without_reordering(tmp_path):
+    spool = Spool(str(tmp_path), 1024, fsync=False)
+    loaded = []
+    failures = []
+    lock = threading.Lock()
+
+    def load(payload):
+        with lock:
+            if payload == b"2" and not failures:
+                failures.append(payload)
+                raise RuntimeError("sink down")
+            loaded.append(payload)
+
+    drainer = SpoolDrainer(spool, load, max_backoff=0.01)
+    for payload in (b"1", b"2", b"3"):
+        spool.append(payload)
+    assert drainer.drain(timeout=10)
+    drainer.close()
+    assert loaded == [b"1", b"2", b"3"]
+    assert failures == [b"2"]